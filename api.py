@@ -4,41 +4,122 @@
 
 """
 
-import json
 import logging
-import logging.config
 import os
+import threading
 from os.path import expanduser
 
-import requests
-import yaml
-
+import cache
 import datamodels
+import filters
+import limiter
+import logsetup
 import payloads
+import profiling
+import singleflight
 
 # The USGS API endpoint
 USGS_API_ENDPOINT = "https://earthexplorer.usgs.gov/inventory/json/v/1.4.1"
 KEY_FILE = os.path.join(expanduser("~"), ".usgs_api_key")
 abs_mod_dir = os.path.dirname(__file__)
-
-with open(os.path.join(abs_mod_dir, 'logging.conf'), 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+# Size of the HTTP connection pool shared by API calls and product downloads.
+POOL_SIZE = 20
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+# Read-only methods whose concurrent identical requests are sent once, see _post().
+COALESCED_METHODS = ['datasetfields', 'datasets', 'deletionsearch', 'downloadoptions', 'getorderproducts', 'grid2ll',
+                     'hits', 'idlookup', 'metadata', 'notifications', 'search', 'status']
 
 logger = logging.getLogger(__name__)
 
+# Callables run with (method name, payload, response) after successful search, metadata and
+# idlookup calls. Used by idstore.attach() to record entityId <-> displayId pairs.
+RESPONSE_HOOKS = []
+
+_session = None
+_session_lock = threading.Lock()
+_flights = singleflight.SingleFlight()
+_key_cache = {}
+
 class USGSError(Exception):
     pass
 
 def _get_saved_key(apiKey):
     """
+    Return apiKey, or the key saved in KEY_FILE if apiKey is None.
+    The file contents are cached and only re-read when the file changes.
     """
     if apiKey is None and os.path.exists(KEY_FILE):
-        logger.debug("Getting API key from file {}".format(KEY_FILE))
-        with open(KEY_FILE, 'r', encoding='utf-8') as f:
-            apiKey = f.read()
+        mtime = os.path.getmtime(KEY_FILE)
+        if _key_cache.get('mtime') != mtime:
+            logger.debug("Getting API key from file %s", KEY_FILE)
+            with open(KEY_FILE, 'r', encoding='utf-8') as f:
+                _key_cache['key'] = f.read()
+            _key_cache['mtime'] = mtime
+        apiKey = _key_cache['key']
     return apiKey
 
+def get_session():
+    """
+    Return the requests.Session shared by all API calls and downloads in this process.
+    Reusing the session keeps TCP/TLS connections to the USGS servers open between calls.
+    requests is imported on first use to keep the CLI start-up fast.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+def _post(url, payload):
+    """
+    POST the payload to the API endpoint URL and return the HTTP response.
+    payload is a dictionary of form fields, or a URL-encoded form body (see payloads.PayloadTemplate.form).
+    Concurrent calls are limited by the adaptive 'api' limiter (see limiter.py). Concurrent
+    identical requests to COALESCED_METHODS share one HTTP request and response (see singleflight.py).
+    """
+    if url.rsplit('/', 1)[-1] in COALESCED_METHODS:
+        key = (url, payload if isinstance(payload, str) else tuple(sorted(payload.items())))
+        return _flights.do(key, lambda: _send(url, payload))
+    return _send(url, payload)
+
+def _send(url, payload):
+    """
+    POST the payload to URL within a slot of the 'api' limiter, taken for the API method of URL.
+    """
+    headers = FORM_HEADERS if isinstance(payload, str) else None
+    with limiter.get_limiter('api').slot(url.rsplit('/', 1)[-1]) as slot:
+        response = get_session().post(url, payload, headers=headers)
+        slot['error'] = response.status_code in limiter.CONGESTION_CODES
+        # Read the body here, so a response shared by coalesced callers is complete.
+        response.content
+        return response
+
+async def call_async(method, apiKey, payload):
+    """
+    Call the API method (a function name of this module, e.g. 'hits') from asyncio code.
+    The call runs in the default executor; concurrent identical calls from threads and
+    tasks are coalesced in _post().
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, globals()[method], apiKey, payload)
+
+def _run_hooks(method, payload, response):
+    """
+    Pass a successful response to the RESPONSE_HOOKS callbacks. Hook errors are logged, not raised.
+    """
+    for hook in RESPONSE_HOOKS:
+        try:
+            hook(method, payload, response)
+        except Exception:
+            logger.exception("Response hook %s failed for %s", hook, method)
+
 def _catch_usgs_error(data):
     """
     Check the response object from USGS API for errors.
@@ -66,10 +147,10 @@ def datasetfields(apiKey, datasetName):
     payload = {
         "jsonRequest": payloads.datasetfields(apiKey, datasetName)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
 
     return response
@@ -87,10 +168,10 @@ def datasets(apiKey, payload):
     payload = {
         "jsonRequest": payloads.datasets(apiKey, **payload)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
 
     return response
@@ -107,10 +188,10 @@ def grid2ll(apiKey, payload):
     payload = {
         "jsonRequest": payloads.grid2ll(**payload)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
 
     return response
@@ -126,14 +207,15 @@ def idlookup(apiKey, payload):
         apiKey = _get_saved_key(apiKey)
     
     url = '{}/idlookup'.format(USGS_API_ENDPOINT)
-    payload = {
+    request = {
         "jsonRequest": payloads.idlookup(apiKey, **payload)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(request))
+    response = _post(url, request).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
+    _run_hooks("idlookup", payload, response)
 
     return response
 
@@ -147,22 +229,24 @@ def login(username, password, store=True):
     payload = {
         "jsonRequest": payloads.login(username, password)
     }
-    logger.debug("API call URL: {}".format(url))
+    logger.debug("API call URL: %s", url)
     logger.debug("API call payload hidden.")
-    resp = requests.post(url,payload)
-    if resp.status_code is not 200:
+    with profiling.span('auth'):
+        resp = _post(url, payload)
+    if resp.status_code != 200:
         raise USGSError(resp.text)
     response = resp.json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("Received response: %s", logsetup.body(response))
     apiKey = response["data"]
 
     if apiKey is None:
         raise USGSError(response["error"])
     
     if store:
-        logger.debug("Writing API key to file {}".format(KEY_FILE))
+        logger.debug("Writing API key to file %s", KEY_FILE)
         with open(KEY_FILE, "w") as f:
             f.write(apiKey)
+        _key_cache.clear()
         
     return response
 
@@ -180,15 +264,16 @@ def logout(apiKey=None):
     payload = {
         "jsonRequest": payloads.logout(apiKey)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url,payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
 
     if os.path.exists(KEY_FILE):
-        logger.debug("Removing API key file {}".format(KEY_FILE))
+        logger.debug("Removing API key file %s", KEY_FILE)
         os.remove(KEY_FILE)
+    _key_cache.clear()
 
     return response
 
@@ -204,10 +289,10 @@ def notifications(apiKey):
     payload = {
         "jsonRequest": payloads.notifications(apiKey)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
 
     return response
@@ -230,10 +315,10 @@ def cleardownloads(apiKey, payload=None):
         payload = {
             "jsonRequest": payloads.cleardownloads(apiKey)
         }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
     try:
-        requests.post(url, payload)
+        _post(url, payload)
         logger.debug('Download queue cleared.')
     except USGSError as exc:
         logger.exception(exc)
@@ -252,10 +337,10 @@ def deletionsearch(apiKey, payload):
     payload = {
         "jsonRequest": payloads.deletionsearch(apiKey, **payload)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
 
     return response
@@ -271,14 +356,15 @@ def metadata(apiKey, payload):
     if apiKey is None and os.path.exists(KEY_FILE):
         apiKey = _get_saved_key(apiKey)
     url = '{}/metadata'.format(USGS_API_ENDPOINT)
-    payload = {
+    request = {
         "jsonRequest": payloads.metadata(apiKey, **payload)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(request))
+    response = _post(url, request).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
+    _run_hooks("metadata", payload, response)
 
     return response
 
@@ -288,20 +374,58 @@ def search(apiKey, payload):
     Valid API key is required for this request - use login() to obtain.
     See params/search.yaml for the structure of payload.
     The request returns a SearchResponse() object - see datamodels.py.
+    Responses are served from the result cache when it is enabled, see cache.py.
     """
     if apiKey is None and os.path.exists(KEY_FILE):
         apiKey = _get_saved_key(apiKey)
     url = '{}/search'.format(USGS_API_ENDPOINT)
-    payload = {
-        "jsonRequest": payloads.search(apiKey, **payload)
-    }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
-    _catch_usgs_error(response)
+    payload = filters.compile_payload(payload)
 
-    return response
+    def fetch():
+        request = {
+            "jsonRequest": payloads.search(apiKey, **payload)
+        }
+        logger.debug("API call URL: %s", url)
+        logger.debug("API call payload: %s", logsetup.body(request))
+        with profiling.span('search'):
+            response = _post(url, request).json()
+        logger.debug("Received response: %s", logsetup.body(response))
+        _catch_usgs_error(response)
+        _run_hooks("search", payload, response)
+        return response
+
+    return cache.cached("search", payload, fetch)
+
+def search_pages(apiKey, payload):
+    """
+    Page through a product search. Generator over the search responses, one per page of
+    maxResults scenes, starting at startingNumber (default 1) until all hits are returned.
+    The request body is serialised once (see payloads.template) and only startingNumber
+    changes between pages. Pages are cached like search responses.
+    """
+    if apiKey is None and os.path.exists(KEY_FILE):
+        apiKey = _get_saved_key(apiKey)
+    url = '{}/search'.format(USGS_API_ENDPOINT)
+    payload = filters.compile_payload(payload)
+    template = payloads.template('search', apiKey, ['startingNumber'], **payload)
+    starting = payload.get('startingNumber', 1)
+    logger.debug("API call URL: %s", url)
+    def fetch(page):
+        logger.debug("Requesting search page starting at %s", page['startingNumber'])
+        with profiling.span('search'):
+            response = _post(url, template.form(startingNumber=page['startingNumber'])).json()
+        _catch_usgs_error(response)
+        _run_hooks("search", page, response)
+        return response
+
+    while True:
+        page = dict(payload, startingNumber=starting)
+        response = cache.cached("search", page, lambda: fetch(page))
+        yield response
+        data = response['data']
+        if not data or not data['numberReturned'] or data['lastRecord'] >= data['totalHits']:
+            return
+        starting = data['nextRecord']
 
 def hits(apiKey, payload):
     """
@@ -309,20 +433,26 @@ def hits(apiKey, payload):
     Valid API key is required for this request - use login() to obtain.
     See params/hits.yaml for the structure of payload.
     The request returns an integer denoting the number of scenes the search matches.
+    Responses are served from the result cache when it is enabled, see cache.py.
     """
     if apiKey is None and os.path.exists(KEY_FILE):
         apiKey = _get_saved_key(apiKey)
     url = '{}/hits'.format(USGS_API_ENDPOINT)
-    payload = {
-        "jsonRequest": payloads.hits(apiKey, **payload)
-    }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
-    _catch_usgs_error(response)
+    payload = filters.compile_payload(payload)
 
-    return response
+    def fetch():
+        request = {
+            "jsonRequest": payloads.hits(apiKey, **payload)
+        }
+        logger.debug("API call URL: %s", url)
+        logger.debug("API call payload: %s", logsetup.body(request))
+        with profiling.span('search'):
+            response = _post(url, request).json()
+        logger.debug("Received response: %s", logsetup.body(response))
+        _catch_usgs_error(response)
+        return response
+
+    return cache.cached("hits", payload, fetch)
 
 def status():
     """
@@ -336,10 +466,10 @@ def status():
     payload = {
         "jsonRequest": payloads.status()
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
 
     return response
@@ -357,10 +487,10 @@ def download(apiKey, payload):
     payload = {
         "jsonRequest": payloads.download(apiKey, **payload)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
 
     return response
@@ -378,10 +508,90 @@ def downloadoptions(apiKey, payload):
     payload = {
         "jsonRequest": payloads.downloadoptions(apiKey, **payload)
     }
-    logger.debug("API call URL: {}".format(url))
-    logger.debug("API call payload: {}".format(payload))
-    response = requests.post(url, payload).json()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
+    _catch_usgs_error(response)
+
+    return response
+
+def getorderproducts(apiKey, payload):
+    """
+    Get the orderable products of the supplied list of entity IDs.
+    Valid API key is required for this request - use login() to obtain.
+    See params/downloadoptions.yaml for the structure of payload (datasetName, entityIds).
+    Returns a list of OrderScene() objects - see datamodels.py.
+    """
+    if apiKey is None and os.path.exists(KEY_FILE):
+        apiKey = _get_saved_key(apiKey)
+    url = '{}/getorderproducts'.format(USGS_API_ENDPOINT)
+    payload = {
+        "jsonRequest": payloads.getorderproducts(apiKey, **payload)
+    }
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
+    _catch_usgs_error(response)
+
+    return response
+
+def updateorderscene(apiKey, payload):
+    """
+    Add a scene to the user's order item basket, or change its product.
+    Valid API key is required for this request - use login() to obtain.
+    payload holds datasetName, entityId, productCode and optionally outputMedia and option.
+    """
+    if apiKey is None and os.path.exists(KEY_FILE):
+        apiKey = _get_saved_key(apiKey)
+    url = '{}/updateorderscene'.format(USGS_API_ENDPOINT)
+    payload = {
+        "jsonRequest": payloads.updateorderscene(apiKey, **payload)
+    }
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
+    _catch_usgs_error(response)
+
+    return response
+
+def submitorder(apiKey):
+    """
+    Submit the scenes in the user's order item basket as an order.
+    Valid API key is required for this request - use login() to obtain.
+    The response data holds the order number.
+    """
+    if apiKey is None and os.path.exists(KEY_FILE):
+        apiKey = _get_saved_key(apiKey)
+    url = '{}/submitorder'.format(USGS_API_ENDPOINT)
+    payload = {
+        "jsonRequest": payloads.submitorder(apiKey)
+    }
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
+    _catch_usgs_error(response)
+
+    return response
+
+def clearorder(apiKey):
+    """
+    Remove all scenes from the user's order item basket.
+    Valid API key is required for this request - use login() to obtain.
+    """
+    if apiKey is None and os.path.exists(KEY_FILE):
+        apiKey = _get_saved_key(apiKey)
+    url = '{}/clearorder'.format(USGS_API_ENDPOINT)
+    payload = {
+        "jsonRequest": payloads.clearorder(apiKey)
+    }
+    logger.debug("API call URL: %s", url)
+    logger.debug("API call payload: %s", logsetup.body(payload))
+    response = _post(url, payload).json()
+    logger.debug("Received response: %s", logsetup.body(response))
     _catch_usgs_error(response)
 
     return response
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the USGS Inventory JSON API (v1.4.1) used by the benchmark suite.
+
+Emulates login, logout, status, datasetfields, search (with pagination), hits, metadata,
+idlookup, deletionsearch, downloadoptions and download, and serves the product files the download
+URLs point to. Latency, bandwidth and error injection are configurable so
+that the client can be measured offline.
+"""
+
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+API_PATH = '/inventory/json/v/1.4.1'
+FILES_PATH = '/files'
+API_KEY = '0123456789abcdef0123456789abcdef'
+PRODUCTS = ['STANDARD', 'FR_BUND', 'FR_REFL', 'FR_THERM', 'FR_QB']
+WRITE_CHUNK = 64 * 1024
+
+
+def make_scenes(count, seed=0):
+    """
+    Generate a deterministic list of Landsat 8 scenes.
+    Each scene is a dict with entityId, displayId, acquisitionDate, path and row.
+    """
+    rnd = random.Random(seed)
+    start = date(2019, 1, 1)
+    scenes = []
+    for i in range(count):
+        path = 168 + i % 66
+        row = 2 + (i // 66) % 45
+        acquired = start + timedelta(days=i // (66 * 45))
+        processed = acquired + timedelta(days=rnd.randint(0, 20))
+        tier = rnd.choice(['RT', 'T1', 'T1', 'T2'])
+        scenes.append({
+            'entityId': 'LC8{:03d}{:03d}{}{:03d}LGN00'.format(
+                path, row, acquired.year, acquired.timetuple().tm_yday),
+            'displayId': 'LC08_L1TP_{:03d}{:03d}_{}_{}_01_{}'.format(
+                path, row, acquired.strftime('%Y%m%d'), processed.strftime('%Y%m%d'), tier),
+            'acquisitionDate': str(acquired),
+            'path': path,
+            'row': row,
+        })
+    return scenes
+
+
+class MockUSGSServer(object):
+    """
+    Threaded HTTP server emulating the USGS Inventory API.
+
+    :param scenes:
+        Integer. Number of scenes in the emulated catalogue.
+    :param file_size:
+        Integer. Size in bytes of every served product file.
+    :param latency:
+        Float. Seconds added before every API response and file transfer.
+    :param bandwidth:
+        Integer. Bytes per second per file transfer. None or 0 for unlimited.
+    :param error_rate:
+        Float. Probability [0, 1] of a request failing with HTTP 503.
+    :param corrupt_rate:
+        Float. Probability [0, 1] of a product file being served with a corrupted byte.
+    :param seed:
+        Integer. Seed for scene generation and error injection.
+    """
+
+    def __init__(self, scenes=1000, file_size=1024 * 1024, latency=0.0, bandwidth=None, error_rate=0.0,
+            corrupt_rate=0.0, seed=0, host='127.0.0.1', port=0):
+        self.scenes = make_scenes(scenes, seed)
+        self.by_entity = {s['entityId']: s for s in self.scenes}
+        self.file_size = file_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.corrupt_rate = corrupt_rate
+        self.calls = {}
+        # DeletedScene dictionaries returned by deletionsearch, see delete().
+        self.deleted = []
+        # Scenes whose products must be ordered before downloadoptions reports them available,
+        # see offline(), and the scenes of submitted orders by the time they become available.
+        self.order_delay = 0.0
+        self._offline = set()
+        self._basket = set()
+        self._ready = {}
+        self._orders = 0
+        # Queued downloads per label, see api_download and api_cleardownloads.
+        self.labels = {}
+        # Seconds download URLs are accepted after they were issued, None for no limit.
+        # Expired URLs are answered with 403.
+        self.url_ttl = None
+        # Bytes after which file transfers are cut off by closing the connection, None to send
+        # whole files. Ranges ('Range: bytes=N-') are served with 206 unless ranges is False.
+        self.cut_after = None
+        self.ranges = True
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self._payload = bytes(range(256)) * (WRITE_CHUNK // 256)
+        self.file_md5 = self._file_md5()
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def endpoint(self):
+        return self.url + API_PATH
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def delete(self, entity_ids, deletion_date):
+        """
+        Report the scenes entity_ids as deleted on deletion_date (string, YYYY-MM-DD) by deletionsearch.
+        """
+        for e in entity_ids:
+            s = self.by_entity[e]
+            self.deleted.append({'acquisitionDate': s['acquisitionDate'], 'entityId': e,
+                                 'displayId': s['displayId'], 'deletionDate': deletion_date})
+
+    def offline(self, entity_ids, order_delay=0.0):
+        """
+        Report the products of entity_ids unavailable until they have been ordered, and then
+        for order_delay more seconds.
+        """
+        self._offline.update(entity_ids)
+        self.order_delay = order_delay
+
+    def _available(self, entity_id):
+        if entity_id not in self._offline:
+            return True
+        ready = self._ready.get(entity_id)
+        return ready is not None and ready <= time.monotonic()
+
+    def should_fail(self, rate=None):
+        rate = self.error_rate if rate is None else rate
+        if not rate:
+            return False
+        with self._lock:
+            return self._rnd.random() < rate
+
+    def _file_md5(self):
+        md5 = hashlib.md5()
+        remaining = self.file_size
+        while remaining > 0:
+            chunk = self._payload[:min(WRITE_CHUNK, remaining)]
+            md5.update(chunk)
+            remaining -= len(chunk)
+        return base64.b64encode(md5.digest()).decode('ascii')
+
+    # API methods. Each takes the decoded jsonRequest and returns the 'data' element.
+
+    def api_login(self, req):
+        return API_KEY
+
+    def api_logout(self, req):
+        return True
+
+    def api_status(self, req):
+        return {'build_date': '2019-01-01'}
+
+    def api_datasetfields(self, req):
+        return [{'fieldId': 20514, 'name': 'WRS Path', 'fieldLink': '', 'valueList': []},
+                {'fieldId': 20516, 'name': 'WRS Row', 'fieldLink': '', 'valueList': []}]
+
+    def api_hits(self, req):
+        return len(self.scenes)
+
+    def api_search(self, req):
+        max_results = int(req.get('maxResults', 10))
+        first = int(req.get('startingNumber', 1))
+        page = self.scenes[first - 1:first - 1 + max_results]
+        if req.get('responseFormat') == 'sceneList':
+            results = [s['entityId'] for s in page]
+        else:
+            results = [_scene_metadata(s) for s in page]
+        last = first + len(page) - 1
+        return {
+            'numberReturned': len(page),
+            'totalHits': len(self.scenes),
+            'firstRecord': first if page else 0,
+            'lastRecord': last if page else 0,
+            'nextRecord': last + 1 if last < len(self.scenes) else last,
+            'results': results,
+        }
+
+    def api_deletionsearch(self, req):
+        scenes = sorted(self.deleted, key=lambda s: s['deletionDate'])
+        tf = req.get('temporalFilter')
+        if tf:
+            scenes = [s for s in scenes if tf['startDate'] <= s['deletionDate'] <= tf['endDate']]
+        max_results = int(req.get('maxResults', 10))
+        first = int(req.get('startingNumber', 1))
+        page = scenes[first - 1:first - 1 + max_results]
+        last = first + len(page) - 1
+        return {
+            'numberReturned': len(page),
+            'totalHits': len(scenes),
+            'firstRecord': first if page else 0,
+            'lastRecord': last if page else 0,
+            'nextRecord': last + 1 if last < len(scenes) else last,
+            'results': page,
+        }
+
+    def api_metadata(self, req):
+        return [_scene_metadata(self.by_entity[e]) for e in req['entityIds'] if e in self.by_entity]
+
+    def api_idlookup(self, req):
+        if req.get('inputField', 'entityId') == 'displayId':
+            by_display = {s['displayId']: s['entityId'] for s in self.scenes}
+            return {i: by_display[i] for i in req['idList'] if i in by_display}
+        return {i: self.by_entity[i]['displayId'] for i in req['idList'] if i in self.by_entity}
+
+    def api_downloadoptions(self, req):
+        data = []
+        for e in req['entityIds']:
+            if e not in self.by_entity:
+                continue
+            data.append({
+                'entityId': e,
+                'downloadOptions': [{
+                    'available': self._available(e),
+                    'downloadCode': p,
+                    'productCode': p,
+                    'filesize': self.file_size,
+                    'productName': p,
+                    'url': None,
+                    'storageLocation': 'ONLINE',
+                } for p in PRODUCTS],
+            })
+        return data
+
+    def api_getorderproducts(self, req):
+        return [{
+            'entityId': e,
+            'orderingId': e,
+            'availableProducts': [{'productCode': p, 'productName': p, 'price': 0, 'outputMedias': ['DWNL'],
+                                   'options': ['None']} for p in PRODUCTS],
+            'product': None,
+        } for e in req['entityIds'] if e in self.by_entity]
+
+    def api_updateorderscene(self, req):
+        with self._lock:
+            self._basket.add(req['entityId'])
+
+    def api_clearorder(self, req):
+        with self._lock:
+            self._basket.clear()
+
+    def api_submitorder(self, req):
+        with self._lock:
+            ready = time.monotonic() + self.order_delay
+            for e in self._basket:
+                self._ready[e] = ready
+            self._basket.clear()
+            self._orders += 1
+            return {'orderNumber': str(self._orders)}
+
+    def api_download(self, req):
+        data = []
+        for e in req['entityIds']:
+            scene = self.by_entity.get(e)
+            if scene is None:
+                continue
+            for p in req['products']:
+                data.append({
+                    'entityId': e,
+                    'product': p,
+                    'label': req.get('label'),
+                    'url': '{}{}/{}?product={}&issued={:.3f}'.format(self.url, FILES_PATH, scene['displayId'], p,
+                                                                     time.time()),
+                })
+        with self._lock:
+            self.labels.setdefault(req.get('label'), []).extend(data)
+        return data
+
+    def api_cleardownloads(self, req):
+        with self._lock:
+            if req.get('labels'):
+                for label in req['labels']:
+                    self.labels.pop(label, None)
+            else:
+                self.labels.clear()
+
+def _scene_metadata(scene):
+    return {
+        'acquisitionDate': scene['acquisitionDate'],
+        'entityId': scene['entityId'],
+        'displayId': scene['displayId'],
+        'metadataFields': [
+            {'fieldName': 'WRS Path', 'value': str(scene['path'])},
+            {'fieldName': 'WRS Row', 'value': str(scene['row'])},
+        ],
+    }
+
+
+def _make_handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            length = int(self.headers.get('Content-Length', 0))
+            form = parse_qs(self.rfile.read(length).decode('utf-8'))
+            if server.latency:
+                time.sleep(server.latency)
+            if not path.startswith(API_PATH + '/'):
+                return self._reply(404, b'')
+            name = path[len(API_PATH) + 1:]
+            server.count(name)
+            method = getattr(server, 'api_' + name, None)
+            if method is None:
+                return self._reply(404, b'')
+            if server.should_fail():
+                return self._reply(503, b'Service Unavailable', 'text/plain')
+            req = json.loads(form.get('jsonRequest', ['{}'])[0])
+            body = {'errorCode': None, 'error': '', 'data': method(req), 'api_version': '1.4.1'}
+            self._reply(200, json.dumps(body).encode('utf-8'))
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if not path.startswith(FILES_PATH + '/'):
+                return self._reply(404, b'')
+            server.count('file')
+            issued = parse_qs(urlparse(self.path).query).get('issued')
+            if server.url_ttl is not None and issued and time.time() - float(issued[0]) > server.url_ttl:
+                server.count('expired')
+                return self._reply(403, b'Forbidden', 'text/plain')
+            if server.latency:
+                time.sleep(server.latency)
+            if server.should_fail():
+                return self._reply(503, b'Service Unavailable', 'text/plain')
+            start = 0
+            match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+            if match and server.ranges:
+                start = int(match.group(1))
+                if start >= server.file_size:
+                    return self._reply(416, b'Range Not Satisfiable', 'text/plain')
+                server.count('range')
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, server.file_size - 1, server.file_size))
+            else:
+                self.send_response(200)
+                self.send_header('Content-MD5', server.file_md5)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(server.file_size - start))
+            self.end_headers()
+            corrupt = server.should_fail(server.corrupt_rate)
+            pos = start
+            started = time.monotonic()
+            sent = 0
+            while pos < server.file_size:
+                if server.cut_after is not None and sent >= server.cut_after:
+                    server.count('cut')
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                i = pos % WRITE_CHUNK
+                chunk = server._payload[i:min(WRITE_CHUNK, i + server.file_size - pos)]
+                if corrupt:
+                    chunk = b'\xff' + chunk[1:]
+                    corrupt = False
+                self.wfile.write(chunk)
+                pos += len(chunk)
+                sent += len(chunk)
+                if server.bandwidth:
+                    ahead = sent / server.bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--scenes', type=int, default=1000)
+    parser.add_argument('--file-size', type=int, default=1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--corrupt-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    srv = MockUSGSServer(scenes=args.scenes, file_size=args.file_size, latency=args.latency,
+                         bandwidth=args.bandwidth, error_rate=args.error_rate, corrupt_rate=args.corrupt_rate,
+                         port=args.port)
+    print('Serving USGS API stand-in at {}'.format(srv.endpoint))
+    try:
+        srv.httpd.serve_forever()
+    except KeyboardInterrupt:
+        srv.stop()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Offline benchmark suite for the USGS API Client.
+
+Starts the local API stand-in from mock_server.py, points api.py at it and
+measures end-to-end throughput of:
+    - api_calls: individual api.py calls (status, hits, metadata)
+    - pagination: paging through a search result with api.search_pages
+    - download_files: rr_proc.download_files over served product files
+    - yaml_save: writing a large search response to YAML and converting it with rr_proc.search_to_dl
+    - payload_build: building paged search requests for params/search_systematic.yaml with payloads.template
+    - displayid: offline parsing of displayIds and entityIds with displayid.parse_many
+
+Results are printed and can be written to a JSON file. Passing a previous
+results file with --baseline turns the run into a regression check which
+exits non-zero if any metric got worse by more than --tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_server import API_KEY, MockUSGSServer
+
+CASES = ['api_calls', 'pagination', 'download_files', 'yaml_save', 'payload_build', 'displayid']
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def _result(value, unit, seconds, **extra):
+    res = {'value': value, 'unit': unit, 'seconds': round(seconds, 4)}
+    res.update(extra)
+    return res
+
+
+def bench_api_calls(api, apiKey, server, opts):
+    """
+    Sequential api.py calls against the stand-in. Reports calls per second.
+    """
+    entity_ids = [s['entityId'] for s in server.scenes[:opts.metadata_batch]]
+    calls = [
+        lambda: api.status(),
+        lambda: api.hits(apiKey, {'datasetName': 'LANDSAT_8_C1'}),
+        lambda: api.metadata(apiKey, {'datasetName': 'LANDSAT_8_C1', 'entityIds': entity_ids}),
+    ]
+    n = opts.api_calls
+
+    def run():
+        for i in range(n):
+            calls[i % len(calls)]()
+
+    seconds, _ = _timed(run)
+    return _result(n / seconds, 'calls/s', seconds, calls=n)
+
+
+def bench_pagination(api, apiKey, server, opts):
+    """
+    Page through the whole catalogue with search_pages(). Reports scenes per second.
+    """
+    payload = {'datasetName': 'LANDSAT_8_C1', 'maxResults': opts.page_size, 'responseFormat': 'standard'}
+
+    def run():
+        return sum(page['data']['numberReturned'] for page in api.search_pages(apiKey, payload))
+
+    seconds, fetched = _timed(run)
+    return _result(fetched / seconds, 'scenes/s', seconds, scenes=fetched, page_size=opts.page_size)
+
+
+def bench_download_files(api, apiKey, server, opts, rr_proc, write_to_yaml, work_dir):
+    """
+    Resolve download URLs with api.download and fetch them with rr_proc.download_files.
+    Reports megabytes per second.
+    """
+    entity_ids = [s['entityId'] for s in server.scenes[:opts.files]]
+    response = api.download(apiKey, {'datasetName': 'LANDSAT_8_C1', 'entityIds': entity_ids, 'products': ['STANDARD']})
+    dl_file = os.path.join(work_dir, 'download.yaml')
+    write_to_yaml(response['data'], dl_file)
+    out_dir = os.path.join(work_dir, 'products')
+    os.makedirs(out_dir, exist_ok=True)
+    seconds, _ = _timed(rr_proc.download_files, dl_file, out_dir)
+    written = sum(os.path.getsize(os.path.join(out_dir, f)) for f in os.listdir(out_dir))
+    return _result(written / seconds / 1e6, 'MB/s', seconds, files=len(os.listdir(out_dir)), bytes=written)
+
+
+def bench_yaml_save(api, apiKey, server, opts, rr_proc, write_to_yaml, work_dir):
+    """
+    Save a full search response as YAML, then convert it to a download conf file.
+    Reports scenes per second over both steps.
+    """
+    n = min(opts.yaml_scenes, len(server.scenes))
+    std = api.search(apiKey, {'datasetName': 'LANDSAT_8_C1', 'maxResults': n, 'responseFormat': 'standard'})
+    lst = api.search(apiKey, {'datasetName': 'LANDSAT_8_C1', 'maxResults': n, 'responseFormat': 'sceneList'})
+    std_file = os.path.join(work_dir, 'search_standard.yaml')
+    lst_file = os.path.join(work_dir, 'search_scenelist.yaml')
+    dl_file = os.path.join(work_dir, 'search_download.yaml')
+
+    def run():
+        write_to_yaml(std['data'], std_file)
+        write_to_yaml(lst['data'], lst_file)
+        rr_proc.search_to_dl(lst_file, dl_file)
+
+    seconds, _ = _timed(run)
+    return _result(n / seconds, 'scenes/s', seconds, scenes=n)
+
+
+def bench_payload_build(opts):
+    """
+    Build opts.payloads paged search request bodies from the systematic search criteria.
+    Reports requests per second.
+    """
+    import yaml
+    import payloads
+    with open(os.path.join(os.path.dirname(BENCH_DIR), 'params', 'search_systematic.yaml'), 'r') as f:
+        criteria = yaml.safe_load(f)
+
+    def run():
+        tpl = payloads.template('search', API_KEY, ['startingNumber'], **criteria)
+        for i in range(opts.payloads):
+            tpl.form(startingNumber=i * 100 + 1)
+
+    seconds, _ = _timed(run)
+    return _result(opts.payloads / seconds, 'requests/s', seconds, requests=opts.payloads)
+
+
+def bench_displayid(server, opts):
+    """
+    Parse the displayIds and entityIds of the whole catalogue, repeated to opts.parse_ids IDs.
+    Reports IDs per second.
+    """
+    import displayid
+    ids = [s[k] for s in server.scenes for k in ('displayId', 'entityId')]
+    ids = (ids * (opts.parse_ids // len(ids) + 1))[:opts.parse_ids]
+    seconds, records = _timed(displayid.parse_many, ids)
+    assert None not in records
+    return _result(len(ids) / seconds, 'IDs/s', seconds, ids=len(ids))
+
+
+def run_all(opts):
+    work_dir = tempfile.mkdtemp(prefix='usgs_bench_')
+    # Log files from logging.conf end up in the working directory.
+    os.chdir(work_dir)
+    import api
+    import logsetup
+    import rr_proc
+    from usgs_api_client import write_to_yaml
+    logsetup.configure()
+    logging.getLogger().setLevel(getattr(logging, opts.log_level))
+
+    server = MockUSGSServer(scenes=opts.scenes, file_size=opts.file_size, latency=opts.latency,
+                            bandwidth=opts.bandwidth, error_rate=opts.error_rate, corrupt_rate=opts.corrupt_rate)
+    results = {}
+    with server:
+        api.USGS_API_ENDPOINT = server.endpoint
+        apiKey = api.login('bench', 'bench', store=False)['data']
+        cases = {
+            'api_calls': lambda: bench_api_calls(api, apiKey, server, opts),
+            'pagination': lambda: bench_pagination(api, apiKey, server, opts),
+            'download_files': lambda: bench_download_files(api, apiKey, server, opts, rr_proc, write_to_yaml, work_dir),
+            'yaml_save': lambda: bench_yaml_save(api, apiKey, server, opts, rr_proc, write_to_yaml, work_dir),
+            'payload_build': lambda: bench_payload_build(opts),
+            'displayid': lambda: bench_displayid(server, opts),
+        }
+        for name in opts.cases or CASES:
+            results[name] = cases[name]()
+            print('{:<16} {:>12.2f} {:<10} ({:.3f} s)'.format(
+                name, results[name]['value'], results[name]['unit'], results[name]['seconds']))
+        results['_server_calls'] = dict(server.calls)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a list of regression messages for metrics worse than baseline by more than tolerance.
+    All metrics are throughputs, i.e. higher is better.
+    """
+    regressions = []
+    for name, base in baseline.items():
+        if name.startswith('_') or name not in results:
+            continue
+        current = results[name]['value']
+        if current < base['value'] * (1 - tolerance):
+            regressions.append('{}: {:.2f} {} vs baseline {:.2f} {}'.format(
+                name, current, results[name]['unit'], base['value'], base['unit']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the USGS API Client against a local API stand-in.')
+    parser.add_argument('cases', nargs='*', help='Cases to run: {}. Default: all.'.format(', '.join(CASES)))
+    parser.add_argument('--scenes', type=int, default=5000, help='Scenes in the emulated catalogue.')
+    parser.add_argument('--api-calls', type=int, default=300, help='Number of calls in api_calls.')
+    parser.add_argument('--metadata-batch', type=int, default=100, help='entityIds per metadata call.')
+    parser.add_argument('--page-size', type=int, default=500, help='maxResults per search page.')
+    parser.add_argument('--files', type=int, default=20, help='Number of files in download_files.')
+    parser.add_argument('--file-size', type=int, default=4 * 1024 * 1024, help='Bytes per served file.')
+    parser.add_argument('--yaml-scenes', type=int, default=5000, help='Scenes saved in yaml_save.')
+    parser.add_argument('--payloads', type=int, default=100000, help='Number of requests built in payload_build.')
+    parser.add_argument('--parse-ids', type=int, default=500000, help='Number of IDs parsed in displayid.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency per request.')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Bytes/s per file transfer, 0 = unlimited.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of an injected HTTP 503.')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help='Probability of a corrupted product file.')
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--save', help='Write results as JSON to this file.')
+    parser.add_argument('--baseline', help='Compare against a previously saved results file.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown vs baseline.')
+    opts = parser.parse_args(argv)
+    for name in opts.cases:
+        if name not in CASES:
+            parser.error('unknown case {}'.format(name))
+
+    if opts.save:
+        opts.save = os.path.abspath(opts.save)
+    if opts.baseline:
+        with open(opts.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    results = run_all(opts)
+
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            json.dump(results, f, indent=4)
+    if opts.baseline:
+        regressions = compare(results, baseline, opts.tolerance)
+        for msg in regressions:
+            print('REGRESSION {}'.format(msg))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Result cache for search and hits requests of the USGS API Client.
+
+Responses are keyed by a canonical hash of the method name and the payload (with compiled
+additionalCriteria, see filters.py). The apiKey is not part of the payload here, so a new
+login does not invalidate the cache. Lookups go to an in-memory LRU first and then to an
+SQLite file shared by all runs.
+
+Each method has a time-to-live (TTL). hits responses may also be served stale for STALE
+seconds after their TTL: the stale count is returned at once and refreshed in the background.
+Refreshes still running when the process exits are waited for (up to REFRESH_WAIT seconds),
+so that a short-lived CLI run still stores the fresh count.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from os.path import expanduser
+
+import filters
+
+DEFAULT_DB = os.path.join(expanduser("~"), ".usgs_api_cache.sqlite")
+# Seconds a response is fresh, per API method. Methods not listed are not cached.
+TTL = {
+    'search': 300,
+    'hits': 300,
+}
+# Seconds a response may be served after its TTL while it is refreshed, per API method.
+STALE = {
+    'hits': 3600,
+}
+# Number of responses kept in memory.
+MEMORY_SIZE = 256
+# Seconds to wait at exit for background refreshes still running.
+REFRESH_WAIT = 30
+
+logger = logging.getLogger(__name__)
+
+_refreshes = set()
+_refreshes_lock = threading.Lock()
+
+
+class ResultCache(object):
+    """
+    Two-tier (memory LRU, SQLite file) cache of API responses.
+
+    :param path:
+        String. Database file, DEFAULT_DB if not given.
+    :param memory_only:
+        Boolean. Keep the cache in memory only.
+    """
+
+    def __init__(self, path=None, memory_only=False):
+        self.path = None if memory_only else (path or DEFAULT_DB)
+        self._memory = OrderedDict()
+        self._conn = None
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def conn(self):
+        if self._conn is None and self.path:
+            import sqlite3
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                         'key TEXT PRIMARY KEY, method TEXT NOT NULL, created REAL NOT NULL, body TEXT NOT NULL)')
+            max_age = max(TTL[m] + STALE.get(m, 0) for m in TTL) if TTL else 0
+            conn.execute('DELETE FROM results WHERE created < ?', (time.time() - max_age,))
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self.conn is not None:
+                self.conn.execute('DELETE FROM results')
+                self.conn.commit()
+
+    @staticmethod
+    def key(method, payload):
+        payload = {k: v for k, v in payload.items() if k != 'apiKey'}
+        return filters.canonical_hash({'method': method, 'payload': payload})
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+            if self.conn is None:
+                return None
+            row = self.conn.execute('SELECT created, body FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            entry = (row[0], json.loads(row[1]))
+            self._remember(key, entry)
+            return entry
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > MEMORY_SIZE:
+            self._memory.popitem(last=False)
+
+    def _put(self, key, method, response):
+        import sqlite3
+        entry = (time.time(), response)
+        with self._lock:
+            self._remember(key, entry)
+            if self.conn is not None:
+                try:
+                    self.conn.execute('INSERT OR REPLACE INTO results (key, method, created, body) VALUES (?, ?, ?, ?)',
+                                      (key, method, entry[0], json.dumps(response)))
+                    self.conn.commit()
+                except sqlite3.Error:
+                    logger.exception('Could not write the %s response to %s', method, self.path)
+
+    def _refresh(self, key, method, fetch):
+        try:
+            self._put(key, method, fetch())
+            logger.debug('Refreshed cached %s response %s', method, key)
+        except Exception:
+            logger.exception('Background refresh of the %s response failed', method)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+            with _refreshes_lock:
+                _refreshes.discard(threading.current_thread())
+
+    def cached(self, method, payload, fetch):
+        """
+        Return the cached response of method for payload, or call fetch() and cache its result.
+        Methods without a TTL are passed through.
+        """
+        ttl = TTL.get(method)
+        if not ttl:
+            return fetch()
+        key = self.key(method, payload)
+        entry = self._get(key)
+        if entry is not None:
+            age = time.time() - entry[0]
+            if age <= ttl:
+                self.hits += 1
+                logger.debug('Using cached %s response (%.0f s old)', method, age)
+                return entry[1]
+            if age <= ttl + STALE.get(method, 0):
+                self.hits += 1
+                with self._lock:
+                    start = key not in self._refreshing
+                    self._refreshing.add(key)
+                if start:
+                    thread = threading.Thread(target=self._refresh, args=(key, method, fetch), daemon=True)
+                    with _refreshes_lock:
+                        _refreshes.add(thread)
+                    thread.start()
+                logger.debug('Using stale %s response (%.0f s old), refreshing', method, age)
+                return entry[1]
+        self.misses += 1
+        response = fetch()
+        self._put(key, method, response)
+        return response
+
+
+@atexit.register
+def _wait_refreshes():
+    """
+    Wait up to REFRESH_WAIT seconds for the background refreshes still running.
+    """
+    with _refreshes_lock:
+        pending = list(_refreshes)
+    if pending:
+        logger.debug('Waiting for %s cache refreshes', len(pending))
+    deadline = time.monotonic() + REFRESH_WAIT
+    for thread in pending:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Return the cache used by api.py, or None if caching is disabled.
+    """
+    return _cache
+
+
+def enable(cache=None):
+    """
+    Cache api.py search and hits responses in cache (a ResultCache on DEFAULT_DB if not given).
+    Without cache, an already enabled cache is kept.
+    """
+    global _cache
+    if cache is not None or _cache is None:
+        _cache = cache or ResultCache()
+    return _cache
+
+
+def disable():
+    global _cache
+    _cache = None
+
+
+def cached(method, payload, fetch):
+    """
+    Serve method for payload from the enabled cache, or call fetch() if caching is disabled.
+    """
+    if _cache is None:
+        return fetch()
+    return _cache.cached(method, payload, fetch)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Long-running worker mode for the USGS API Client.
+
+The worker watches a spool directory for job files and runs them concurrently in
+one process, so the imports, logging set-up, pooled HTTP session (api.get_session())
+and cached API key are shared by all jobs instead of being rebuilt for every step.
+
+Spool directory layout:
+    incoming/   job files waiting to run (written by submit())
+    running/    jobs currently being processed, each with an owner file
+                JOB_ID.HOST.PID.owner naming the worker process running it
+    done/       finished jobs, with their result
+    failed/     jobs that raised an error, with the error message
+    status.yaml worker status, refreshed on every poll
+
+A job file is a YAML mapping with an 'args' list holding the usgs_api_client command
+line (without the program name), e.g. ['search', '/path/search.yaml', '--save', '/path/out.yaml'].
+Use absolute paths in job arguments - the worker does not change directory per job.
+"""
+
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+SPOOL_DIRS = ['incoming', 'running', 'done', 'failed']
+# Commands that cannot be run as jobs.
+EXCLUDED_COMMANDS = ['serve', 'submit', 'jobs']
+JOB_SUFFIX = '.yaml'
+OWNER_SUFFIX = '.owner'
+
+logger = logging.getLogger(__name__)
+
+
+def _init_spool(spool_dir):
+    for d in SPOOL_DIRS:
+        os.makedirs(os.path.join(spool_dir, d), exist_ok=True)
+
+
+def _write_yaml(data, path):
+    """
+    Write data to path atomically, via a temporary dot-file and rename.
+    """
+    import yaml
+    tmp = os.path.join(os.path.dirname(path), '.{}.tmp'.format(os.path.basename(path)))
+    with open(tmp, 'w') as f:
+        yaml.dump(data, f, default_flow_style=False)
+    os.replace(tmp, path)
+
+
+def _owner_alive(host, pid):
+    """
+    Return False if process pid of this host is known to be gone. Processes of other hosts
+    sharing the spool cannot be checked and are taken to be alive.
+    """
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_yaml(path):
+    import yaml
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def submit(spool_dir, args):
+    """
+    Queue a job running the usgs_api_client command line args. Returns the job ID.
+    """
+    if not args or args[0] in EXCLUDED_COMMANDS:
+        raise ValueError('Cannot submit {} as a job.'.format(args[0] if args else 'an empty command'))
+    _init_spool(spool_dir)
+    job_id = '{}-{}'.format(datetime.now().strftime('%Y%m%dT%H%M%S%f'), uuid.uuid4().hex[:8])
+    _write_yaml({'id': job_id, 'args': list(args), 'submitted': datetime.now().isoformat()},
+                os.path.join(spool_dir, 'incoming', job_id + JOB_SUFFIX))
+    logger.info('Submitted job %s: %s', job_id, ' '.join(args))
+    return job_id
+
+
+def job_status(spool_dir):
+    """
+    Return a dict with the worker status and the IDs of jobs in each spool state.
+    """
+    status = {}
+    status_file = os.path.join(spool_dir, 'status.yaml')
+    if os.path.exists(status_file):
+        status['worker'] = _read_yaml(status_file)
+    for d in SPOOL_DIRS:
+        path = os.path.join(spool_dir, d)
+        status[d] = sorted(f[:-len(JOB_SUFFIX)] for f in os.listdir(path)
+                           if f.endswith(JOB_SUFFIX) and not f.startswith('.')) if os.path.isdir(path) else []
+    return status
+
+
+class Worker(object):
+    """
+    Spool directory worker. Call run() to process jobs until stop() is called or a
+    SIGTERM/SIGINT is received.
+
+    :param spool_dir:
+        String. Path to the spool directory. Created if it does not exist.
+    :param runner:
+        Callable taking the job argument list. Raises on failure, the return value is stored as the job result.
+    :param workers:
+        Integer. Maximum number of jobs running concurrently.
+    :param poll:
+        Float. Seconds between spool directory scans.
+    """
+
+    def __init__(self, spool_dir, runner, workers=4, poll=1.0):
+        self.spool_dir = spool_dir
+        self.runner = runner
+        self.workers = workers
+        self.poll = poll
+        self.started = datetime.now()
+        self.counts = {'done': 0, 'failed': 0}
+        self.running = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        _init_spool(spool_dir)
+
+    def stop(self, *args):
+        logger.info('Stopping worker, waiting for running jobs to finish.')
+        self._stop.set()
+
+    def _path(self, state, job_id):
+        return os.path.join(self.spool_dir, state, job_id + JOB_SUFFIX)
+
+    def _owner_path(self, job_id):
+        return os.path.join(self.spool_dir, 'running', '{}.{}.{}{}'.format(
+            job_id, socket.gethostname(), os.getpid(), OWNER_SUFFIX))
+
+    def _recover(self):
+        """
+        Put jobs left in running/ by a worker that is gone back in the queue. Jobs whose
+        owner process is still alive (e.g. another worker sharing the spool) are left alone.
+        """
+        running = os.path.join(self.spool_dir, 'running')
+        owned = set()
+        for f in os.listdir(running):
+            if not f.endswith(OWNER_SUFFIX):
+                continue
+            job_id, _, owner = f[:-len(OWNER_SUFFIX)].partition('.')
+            host, _, pid = owner.rpartition('.')
+            if pid.isdigit() and _owner_alive(host, int(pid)):
+                owned.add(job_id)
+            else:
+                try:
+                    os.remove(os.path.join(running, f))
+                except FileNotFoundError:
+                    pass
+        for f in os.listdir(running):
+            if f.endswith(JOB_SUFFIX) and not f.startswith('.') and f[:-len(JOB_SUFFIX)] not in owned:
+                logger.warning('Re-queueing interrupted job %s', f[:-len(JOB_SUFFIX)])
+                try:
+                    os.replace(os.path.join(running, f), os.path.join(self.spool_dir, 'incoming', f))
+                except FileNotFoundError:
+                    # Finished or recovered by another worker meanwhile.
+                    continue
+
+    def _claim(self, limit):
+        """
+        Move up to limit job files from incoming/ to running/ and return their IDs.
+        """
+        claimed = []
+        incoming = os.path.join(self.spool_dir, 'incoming')
+        for f in sorted(os.listdir(incoming)):
+            if len(claimed) >= limit:
+                break
+            if not f.endswith(JOB_SUFFIX) or f.startswith('.'):
+                continue
+            job_id = f[:-len(JOB_SUFFIX)]
+            # The owner file goes first, so that a job in running/ always has one while it runs.
+            open(self._owner_path(job_id), 'w').close()
+            try:
+                os.rename(os.path.join(incoming, f), self._path('running', job_id))
+            except FileNotFoundError:
+                # Claimed by another worker sharing the spool.
+                os.remove(self._owner_path(job_id))
+                continue
+            claimed.append(job_id)
+        return claimed
+
+    def _run_job(self, job_id):
+        job = _read_yaml(self._path('running', job_id))
+        job['started'] = datetime.now().isoformat()
+        logger.info('Running job %s: %s', job_id, ' '.join(job['args']))
+        start = time.monotonic()
+        try:
+            if not job['args'] or job['args'][0] in EXCLUDED_COMMANDS:
+                raise ValueError('Command {} cannot be run as a job.'.format(job['args'][:1]))
+            job['result'] = self.runner(job['args'])
+            state = 'done'
+        except BaseException as exc:
+            logger.exception('Job %s failed.', job_id)
+            job['error'] = '{}: {}'.format(type(exc).__name__, exc)
+            state = 'failed'
+        job['finished'] = datetime.now().isoformat()
+        job['seconds'] = round(time.monotonic() - start, 3)
+        try:
+            _write_yaml(job, self._path(state, job_id))
+        except Exception:
+            # Results that cannot be represented in YAML are dropped.
+            job.pop('result', None)
+            _write_yaml(job, self._path(state, job_id))
+        os.remove(self._path('running', job_id))
+        os.remove(self._owner_path(job_id))
+        with self._lock:
+            self.counts[state] += 1
+            del self.running[job_id]
+        logger.info('Job %s %s in %s s.', job_id, state, job['seconds'])
+
+    def _write_status(self):
+        with self._lock:
+            status = {
+                'pid': os.getpid(),
+                'started': self.started.isoformat(),
+                'updated': datetime.now().isoformat(),
+                'workers': self.workers,
+                'running': dict(self.running),
+                'done': self.counts['done'],
+                'failed': self.counts['failed'],
+                'stopping': self._stop.is_set(),
+            }
+        _write_yaml(status, os.path.join(self.spool_dir, 'status.yaml'))
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        self._recover()
+        logger.info('Worker started on spool %s with %s workers.', self.spool_dir, self.workers)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while not self._stop.is_set():
+                with self._lock:
+                    free = self.workers - len(self.running)
+                for job_id in self._claim(free):
+                    with self._lock:
+                        self.running[job_id] = datetime.now().isoformat()
+                    pool.submit(self._run_job, job_id)
+                self._write_status()
+                self._stop.wait(self.poll)
+        self._write_status()
+        logger.info('Worker stopped. Jobs done: %s, failed: %s.', self.counts['done'], self.counts['failed'])
@@ -785,8 +785,8 @@ class SearchFilterAnd(SearchFilter):
     https://earthexplorer.usgs.gov/inventory/documentation/datamodel#SearchFilterAnd
     """
 
-    def __init__(self, filterType='and', childFilters=[]):
-        self.childFilters = childFilters
+    def __init__(self, filterType='and', childFilters=None):
+        self.childFilters = childFilters if childFilters is not None else []
         super().__init__(filterType)
 
     def __repr__(self):
@@ -827,8 +827,8 @@ class SearchFilterOr(SearchFilter):
     https://earthexplorer.usgs.gov/inventory/documentation/datamodel#SearchFilterOr
     """
 
-    def __init__(self, filterType='or', childFilters=[]):
-        self.childFilters = childFilters
+    def __init__(self, filterType='or', childFilters=None):
+        self.childFilters = childFilters if childFilters is not None else []
         super().__init__(filterType)
 
     def __repr__(self):
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Deleted scene synchronisation for the USGS API Client.
+
+USGS withdraws scenes from its datasets from time to time. sync_deletions() pages through
+deletionsearch from the last synchronised deletion date (the watermark kept in the ID store,
+see idstore.py), records the deleted scenes in the store, removes them from pending download
+lists, cancels their queued downloads and optionally removes their files from a local archive.
+"""
+
+import logging
+import os
+from datetime import date
+
+import api
+import idstore
+import rr_proc
+
+# Number of deleted scenes per deletionsearch request.
+PAGE_SIZE = 5000
+
+logger = logging.getLogger(__name__)
+
+
+def deleted_scenes(apiKey, datasetName, start_date=None, end_date=None, page_size=PAGE_SIZE):
+    """
+    Generator over the DeletedScene dictionaries of datasetName deleted between start_date
+    and end_date (strings, YYYY-MM-DD). All deletions are returned if start_date is not given.
+    """
+    payload = {'datasetName': datasetName, 'maxResults': page_size, 'startingNumber': 1, 'sortOrder': 'ASC'}
+    if start_date:
+        payload['temporalFilter'] = {'dateField': 'deleted', 'startDate': start_date,
+                                     'endDate': end_date or date.today().isoformat()}
+    while True:
+        data = api.deletionsearch(apiKey, payload)['data']
+        if not data or not data['numberReturned']:
+            return
+        for scene in data['results']:
+            yield scene
+        if data['lastRecord'] >= data['totalHits']:
+            return
+        payload['startingNumber'] = data['nextRecord']
+
+
+def purge_files(archive_dir, scenes):
+    """
+    Remove the files of scenes from archive_dir. Product files are matched by displayId or
+    entityId prefix, as named by rr_proc.product_file_name(). Returns the removed paths.
+    """
+    prefixes = tuple(p for s in scenes for p in (s.get('displayId'), s.get('entityId')) if p)
+    removed = []
+    if not prefixes:
+        return removed
+    for name in os.listdir(archive_dir):
+        if name.startswith(prefixes):
+            path = os.path.join(archive_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+                removed.append(path)
+                logger.info('Removed deleted product %s', path)
+    return removed
+
+
+def sync_deletions(apiKey, datasetName, store=None, start_date=None, pending=None, purge=False, archive_dir=None):
+    """
+    Synchronise deleted scenes of datasetName since the stored watermark (or start_date, if no
+    watermark is stored yet).
+
+    :param store:
+        IdStore. Store holding the deleted scenes and watermarks. The attached store or one on
+        idstore.DEFAULT_DB if not given.
+    :param pending:
+        List of strings. Pending download lists (see rr_proc.drop_deleted) to remove deleted scenes from.
+    :param purge:
+        Boolean. Also remove the ID translations of deleted scenes and, if archive_dir is given,
+        their downloaded files.
+    Returns a summary dictionary.
+    """
+    store = store or idstore.get_store() or idstore.IdStore()
+    watermark = store.get_watermark(datasetName) or start_date
+    logger.info('Synchronising deleted scenes of %s since %s.', datasetName, watermark or 'the beginning')
+    scenes = list(deleted_scenes(apiKey, datasetName, watermark))
+    store.mark_deleted(datasetName, scenes, purge=purge)
+    entity_ids = [s['entityId'] for s in scenes]
+    summary = {'datasetName': datasetName, 'since': watermark, 'deleted': len(scenes),
+               'cancelled': rr_proc.cancel_downloads(entity_ids, datasetName) if entity_ids else 0,
+               'dropped': 0, 'purged': 0}
+    for path in pending or []:
+        dropped = rr_proc.drop_deleted(path, entity_ids)
+        if dropped:
+            logger.info('Removed %s deleted scenes from %s', dropped, path)
+        summary['dropped'] += dropped
+    if purge and archive_dir:
+        summary['purged'] = len(purge_files(archive_dir, scenes))
+    # Deletion dates may carry a time; the watermark is the date, so the last day is fetched
+    # again next time and nothing deleted later that day is missed.
+    dates = [str(s['deletionDate'])[:10] for s in scenes if s.get('deletionDate')]
+    if dates:
+        store.set_watermark(datasetName, max(dates))
+    summary['watermark'] = store.get_watermark(datasetName)
+    logger.info('{deleted} deleted scenes since {since}: {cancelled} queued downloads cancelled, '
+                '{dropped} pending entries dropped, {purged} files removed.'.format(**summary))
+    return summary
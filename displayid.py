@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Offline parser for Landsat Collection 1 scene identifiers.
+
+A displayId (Landsat Product ID) has the form LXSS_LLLL_PPPRRR_YYYYMMDD_yyyymmdd_CC_TX:
+    L         Landsat
+    X         sensor (C = OLI/TIRS, O = OLI only, T = TIRS only, E = ETM+, T = TM, M = MSS)
+    SS        satellite (e.g. 08)
+    LLLL      processing level (L1TP, L1GT, L1GS)
+    PPPRRR    WRS path and row
+    YYYYMMDD  acquisition date
+    yyyymmdd  processing date
+    CC        collection number
+    TX        collection tier (RT, T1, T2)
+An entityId (Landsat Scene ID) has the form LXSPPPRRRYYYYDDDGSIVV, with the acquisition
+date given as year and day of year, followed by the ground station and version.
+
+Everything the scheduler and the acquisition mask filter need is encoded in the ID, so no
+metadata request is made. parse_many() handles large lists: dates are decoded once per
+distinct date string, so hundreds of thousands of IDs are parsed per second.
+"""
+
+import re
+from collections import namedtuple
+from datetime import date, datetime
+
+import acq_mask
+
+DISPLAYID_RE = re.compile(r'L([COTEM])(\d{2})_(L1GT|L1GS|L1TP)_(\d{3})(\d{3})_(\d{8})_(\d{8})_(\d{2})_(RT|T1|T2)')
+ENTITYID_RE = re.compile(r'L([COTEM])(\d)(\d{3})(\d{3})(\d{4})(\d{3})([A-Z]{3})(\d{2})')
+
+DisplayId = namedtuple('DisplayId', ['display_id', 'sensor', 'satellite', 'level', 'path', 'row',
+                                     'acquired', 'processed', 'collection', 'tier'])
+EntityId = namedtuple('EntityId', ['entity_id', 'sensor', 'satellite', 'path', 'row', 'acquired', 'station', 'version'])
+
+
+def _ymd(s, dates):
+    d = dates.get(s)
+    if d is None:
+        d = dates[s] = date(int(s[:4]), int(s[4:6]), int(s[6:]))
+    return d
+
+
+def _yday(s, dates):
+    d = dates.get(s)
+    if d is None:
+        d = dates[s] = datetime.strptime(s, '%Y%j').date()
+    return d
+
+
+def _parse_display(display_id, dates, match=DISPLAYID_RE.fullmatch):
+    m = match(display_id)
+    if m is None:
+        return None
+    sensor, sat, level, path, row, acquired, processed, collection, tier = m.groups()
+    try:
+        return DisplayId(display_id, sensor, int(sat), level, int(path), int(row),
+                         _ymd(acquired, dates), _ymd(processed, dates), int(collection), tier)
+    except ValueError:
+        return None
+
+
+def _parse_entity(entity_id, dates, match=ENTITYID_RE.fullmatch):
+    m = match(entity_id)
+    if m is None:
+        return None
+    sensor, sat, path, row, year, doy, station, version = m.groups()
+    try:
+        return EntityId(entity_id, sensor, int(sat), int(path), int(row), _yday(year + doy, dates), station, int(version))
+    except ValueError:
+        return None
+
+
+def parse(display_id):
+    """
+    Parse a displayId. Returns a DisplayId record, or None if display_id is not a valid displayId.
+    """
+    if not isinstance(display_id, str):
+        return None
+    return _parse_display(display_id, {})
+
+
+def parse_entity_id(entity_id):
+    """
+    Parse an entityId. Returns an EntityId record, or None if entity_id is not a valid entityId.
+    """
+    if not isinstance(entity_id, str):
+        return None
+    return _parse_entity(entity_id, {})
+
+
+def parse_many(ids):
+    """
+    Parse a list (or any iterable, e.g. a numpy array of strings) of displayIds and/or entityIds.
+    Returns a list of DisplayId/EntityId records in the same order, with None for invalid IDs.
+    """
+    dates = {}
+    records = []
+    append = records.append
+    for i in ids:
+        i = str(i)
+        if '_' in i:
+            append(_parse_display(i, dates))
+        else:
+            append(_parse_entity(i, dates))
+    return records
+
+
+def compile_mask(mask=None):
+    """
+    Turn an acquisition mask (list of {'wrsPath', 'startRow', 'endRow'}, acq_mask.ACQ_MASK if not given)
+    into a dictionary {path: [(start row, end row)]} for in_mask().
+    """
+    compiled = {}
+    for entry in acq_mask.ACQ_MASK if mask is None else mask:
+        compiled.setdefault(int(entry['wrsPath']), []).append((int(entry['startRow']), int(entry['endRow'])))
+    return compiled
+
+
+def in_mask(record, mask):
+    """
+    Check if a parsed record lies within a mask from compile_mask().
+    """
+    if record is None:
+        return False
+    return any(start <= record.row <= end for start, end in mask.get(record.path, ()))
+
+
+def filter_mask(ids, mask=None):
+    """
+    Return the IDs from ids (displayIds and/or entityIds) acquired within the acquisition mask.
+    """
+    ids = list(ids)
+    compiled = compile_mask(mask)
+    return [i for i, record in zip(ids, parse_many(ids)) if in_mask(record, compiled)]
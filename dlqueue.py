@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+Labelled download batches for the USGS API Client.
+
+Every download request made by rr_proc.resolve_downloads() is given a label (see new_label),
+which the server attaches to the download records it queues for the user (DownloadRecord,
+DownloadLabel in datamodels.py). The ledger keeps the URLs returned for each label in an SQLite
+file, with their download status, so that:
+    - URLs still valid (less than URL_TTL seconds old, label not cleared, not failed or expired) are reused
+      instead of being requested again when the same products are resolved later;
+    - state() shows the queue per label, like the DownloadLabel objects of the API;
+    - clear_completed() removes only our own labels (LABEL_PREFIX) whose downloads have all
+      finished from the server-side download queue, leaving other downloads of the account alone.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from os.path import expanduser
+
+import api
+
+DEFAULT_DB = os.path.join(expanduser("~"), ".usgs_download_ledger.sqlite")
+# Prefix of the labels created by this client. Only these labels are cleared.
+LABEL_PREFIX = 'usgs_api_client'
+# Seconds a download URL is assumed to stay valid after it was issued.
+URL_TTL = 3600
+# Maximum number of IDs per SQL query.
+QUERY_BATCH_SIZE = 500
+# Download statuses of rr_proc.download_files() results recorded in the ledger. All are final:
+# a label without downloads left in the 'queued' status is complete.
+STATUSES = {'Downloaded': 'done', 'Failed': 'failed', 'Cancelled': 'cancelled'}
+
+logger = logging.getLogger(__name__)
+
+
+def new_label():
+    """
+    Return a new unique label for a download request, starting with LABEL_PREFIX.
+    """
+    return '{}_{}_{}'.format(LABEL_PREFIX, datetime.utcnow().strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+
+
+class DownloadLedger(object):
+    """
+    Download URLs per label and their download status, backed by SQLite.
+
+    :param path:
+        String. Database file, created if it does not exist. DEFAULT_DB if not given.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_DB
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS labels ('
+                         'label TEXT PRIMARY KEY, dataset TEXT, created REAL NOT NULL, cleared REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                         'dataset TEXT NOT NULL, entity_id TEXT NOT NULL, product TEXT NOT NULL, '
+                         'label TEXT NOT NULL, url TEXT NOT NULL, filesize INTEGER, created REAL NOT NULL, '
+                         'status TEXT NOT NULL, PRIMARY KEY (dataset, entity_id, product))')
+            conn.execute('CREATE INDEX IF NOT EXISTS downloads_url ON downloads (url)')
+            conn.execute('CREATE INDEX IF NOT EXISTS downloads_label ON downloads (label)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def record(self, label, dataset, records):
+        """
+        Store the download records (entityId, product, url, filesize) returned for label.
+        """
+        now = time.time()
+        rows = [(dataset, r['entityId'], r.get('product') or r.get('productCode'), label, r['url'],
+                 r.get('filesize'), now, 'queued') for r in records if r.get('url') and r.get('entityId')]
+        with self._lock:
+            self.conn.execute('INSERT OR IGNORE INTO labels (label, dataset, created) VALUES (?, ?, ?)',
+                              (label, dataset, now))
+            self.conn.executemany('INSERT OR REPLACE INTO downloads (dataset, entity_id, product, label, url, '
+                                  'filesize, created, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+        return len(rows)
+
+    def valid(self, dataset, entity_ids, products):
+        """
+        Return {(entityId, product): download record} of the reusable URLs of entity_ids and products:
+        issued less than URL_TTL seconds ago, label not cleared, download not failed and URL not expired.
+        """
+        entity_ids = list(entity_ids)
+        products = set(products)
+        found = {}
+        with self._lock:
+            for i in range(0, len(entity_ids), QUERY_BATCH_SIZE):
+                batch = entity_ids[i:i + QUERY_BATCH_SIZE]
+                query = ('SELECT d.entity_id, d.product, d.url, d.filesize, d.label FROM downloads d '
+                         'JOIN labels l ON l.label = d.label WHERE l.cleared IS NULL AND d.dataset = ? '
+                         'AND d.created > ? AND d.status NOT IN (?, ?) AND d.entity_id IN ({})').format(
+                             ','.join('?' * len(batch)))
+                for row in self.conn.execute(query, [dataset, time.time() - URL_TTL, 'failed', 'expired'] + batch):
+                    if row[1] in products:
+                        found[(row[0], row[1])] = {'entityId': row[0], 'product': row[1], 'url': row[2],
+                                                   'filesize': row[3], 'datasetName': dataset, 'label': row[4]}
+        return found
+
+    def update(self, results):
+        """
+        Record the outcome of downloads (results of rr_proc.download_files()) by URL.
+        """
+        rows = [(STATUSES[r['Status']], r['URL']) for r in results if r and r.get('Status') in STATUSES]
+        if not rows:
+            return
+        with self._lock:
+            self.conn.executemany('UPDATE downloads SET status = ? WHERE url = ?', rows)
+            self.conn.commit()
+
+    def expire(self, urls):
+        """
+        Record that urls expired and were replaced (see rr_proc.URLRefresher), so they are
+        neither reused nor keep their labels from completing.
+        """
+        with self._lock:
+            self.conn.executemany('UPDATE downloads SET status = ? WHERE url = ?', [('expired', u) for u in urls])
+            self.conn.commit()
+
+    def state(self, include_cleared=False):
+        """
+        Return the labels with their download counts, like DownloadLabel objects: a list of
+        {'label', 'datasetName', 'dateEntered', 'downloadCount', 'totalComplete', 'failed', 'queued',
+        'downloadSize', 'cleared'}. queued counts the downloads without a final status.
+        """
+        query = ('SELECT l.label, l.dataset, l.created, l.cleared, COUNT(d.url), '
+                 'SUM(CASE WHEN d.status = \'done\' THEN 1 ELSE 0 END), '
+                 'SUM(CASE WHEN d.status = \'failed\' THEN 1 ELSE 0 END), SUM(d.filesize), '
+                 'SUM(CASE WHEN d.status = \'queued\' THEN 1 ELSE 0 END) '
+                 'FROM labels l LEFT JOIN downloads d ON d.label = l.label {}GROUP BY l.label ORDER BY l.created').format(
+                     '' if include_cleared else 'WHERE l.cleared IS NULL ')
+        with self._lock:
+            rows = self.conn.execute(query).fetchall()
+        return [{'label': r[0], 'datasetName': r[1],
+                 'dateEntered': datetime.utcfromtimestamp(r[2]).strftime('%Y-%m-%dT%H:%M:%S'),
+                 'downloadCount': r[4], 'totalComplete': r[5] or 0, 'failed': r[6] or 0, 'queued': r[8] or 0,
+                 'downloadSize': r[7] or 0,
+                 'cleared': datetime.utcfromtimestamp(r[3]).strftime('%Y-%m-%dT%H:%M:%S') if r[3] else None}
+                for r in rows]
+
+    def completed(self):
+        """
+        Return our uncleared labels without queued downloads.
+        """
+        return [s['label'] for s in self.state()
+                if s['label'].startswith(LABEL_PREFIX) and not s['queued']]
+
+    def mark_cleared(self, labels):
+        with self._lock:
+            self.conn.executemany('UPDATE labels SET cleared = ? WHERE label = ?', [(time.time(), l) for l in labels])
+            self.conn.commit()
+
+
+_ledger = None
+_attach_lock = threading.Lock()
+
+
+def get_ledger():
+    """
+    Return the ledger used by rr_proc.py, or None.
+    """
+    return _ledger
+
+
+def attach(ledger=None):
+    """
+    Record the download requests and downloads of rr_proc.py in ledger (a DownloadLedger on
+    DEFAULT_DB if not given). Returns the ledger. Without ledger, a ledger already attached
+    is kept.
+    """
+    global _ledger
+    with _attach_lock:
+        if ledger is None and _ledger is not None:
+            return _ledger
+        _ledger = ledger or DownloadLedger()
+        return _ledger
+
+
+def clear_completed(apiKey, ledger=None):
+    """
+    Clear our labels whose downloads have all finished from the user's download queue.
+    Returns the list of cleared labels. Errors are logged, the labels are then tried again next time.
+    """
+    ledger = ledger or _ledger
+    if ledger is None:
+        return []
+    labels = ledger.completed()
+    if not labels:
+        return []
+    try:
+        api.cleardownloads(apiKey, labels)
+    except Exception:
+        logger.exception('Could not clear %s completed download labels', len(labels))
+        return []
+    ledger.mark_cleared(labels)
+    logger.info('Cleared %s completed download labels.', len(labels))
+    return labels
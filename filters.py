@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Search filter compiler for the USGS API Client.
+
+additionalCriteria of search and hits requests is a tree of SearchFilter objects (see
+datamodels.py), usually read from YAML. compile_filter() turns such a tree into its canonical
+form, which selects the same scenes with fewer clauses:
+    - nested 'and' filters in an 'and' (and 'or' in 'or') are flattened into their parent;
+    - 'and'/'or' filters with a single child are replaced by the child;
+    - a filter without clauses matches everything: it is dropped from an 'and', and an 'or'
+      containing one matches everything as well (compiles to None);
+    - duplicate clauses are dropped;
+    - 'between' filters on the same field are merged: intersected within an 'and', joined
+      when they overlap within an 'or';
+    - an 'and' with an empty intersection can never match: it is dropped from an enclosing
+      'or', and FilterError is raised only if the whole tree can never match;
+    - children are sorted, so the same criteria written in a different order compile to
+      the same tree and canonical_hash() can be used as a cache key.
+Field IDs can be checked against the datasetfields of the dataset, see dataset_field_ids().
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from os.path import expanduser
+
+import datamodels
+
+# datasetfields responses are cached in this file for FIELDS_TTL seconds.
+FIELDS_CACHE_FILE = os.path.join(expanduser("~"), ".usgs_datasetfields.json")
+FIELDS_TTL = 24 * 3600
+
+logger = logging.getLogger(__name__)
+_fields = {}
+# Compiled form of a filter that can never match.
+_NEVER = object()
+
+
+class FilterError(Exception):
+    pass
+
+
+def to_dict(node):
+    """
+    Convert a filter tree of datamodels.SearchFilter objects and/or dictionaries to dictionaries.
+    """
+    if isinstance(node, datamodels.SearchFilter):
+        node = vars(node)
+    if not isinstance(node, dict):
+        raise FilterError('Not a search filter: {!r}'.format(node))
+    node = dict(node)
+    if 'childFilters' in node:
+        node['childFilters'] = [to_dict(c) for c in node['childFilters'] or []]
+    return node
+
+
+def _key(node):
+    return json.dumps(node, sort_keys=True, separators=(',', ':'))
+
+
+def _bound(value):
+    """
+    Comparable form of a between bound: a number if value is numeric, the string otherwise.
+    """
+    try:
+        return (0, float(value))
+    except (TypeError, ValueError):
+        return (1, str(value))
+
+
+def _merge_between(children, intersect):
+    """
+    Merge 'between' filters on the same field. Returns the new list of children, or None if
+    an intersection is empty.
+    """
+    ranges = {}
+    others = []
+    for c in children:
+        if c['filterType'] == 'between':
+            ranges.setdefault(c['fieldId'], []).append(c)
+        else:
+            others.append(c)
+    merged = []
+    for field_id, items in ranges.items():
+        kinds = set(_bound(i['firstValue'])[0] for i in items) | set(_bound(i['secondValue'])[0] for i in items)
+        if len(items) == 1 or len(kinds) > 1:
+            # Mixed numeric and text bounds cannot be compared safely.
+            merged.extend(items)
+            continue
+        items = sorted(items, key=lambda i: (_bound(i['firstValue']), _bound(i['secondValue'])))
+        if intersect:
+            first = max(items, key=lambda i: _bound(i['firstValue']))['firstValue']
+            second = min(items, key=lambda i: _bound(i['secondValue']))['secondValue']
+            if _bound(first) > _bound(second):
+                return None
+            merged.append(dict(items[0], firstValue=first, secondValue=second))
+            continue
+        current = dict(items[0])
+        for i in items[1:]:
+            if _bound(i['firstValue']) <= _bound(current['secondValue']):
+                if _bound(i['secondValue']) > _bound(current['secondValue']):
+                    current['secondValue'] = i['secondValue']
+            else:
+                merged.append(current)
+                current = dict(i)
+        merged.append(current)
+    return others + merged
+
+
+def _compile(node, fields):
+    filter_type = str(node.get('filterType', '')).lower()
+    if filter_type in ('value', 'between'):
+        if 'fieldId' not in node:
+            raise FilterError('Filter without fieldId: {}'.format(node))
+        if fields is not None and int(node['fieldId']) not in fields:
+            raise FilterError('Unknown fieldId {} in filter {}'.format(node['fieldId'], node))
+        out = dict(node, filterType=filter_type, fieldId=int(node['fieldId']))
+        if filter_type == 'value' and out.get('operand') not in ('=', 'like'):
+            out['operand'] = '='
+        return out
+    if filter_type not in ('and', 'or'):
+        raise FilterError('Unknown filterType {!r}'.format(node.get('filterType')))
+
+    children = []
+    never = False
+    everything = False
+    for child in node.get('childFilters') or []:
+        child = _compile(child, fields)
+        if child is _NEVER:
+            if filter_type == 'and':
+                return _NEVER
+            never = True
+            continue
+        if child is None:
+            # A child without clauses matches everything: it can be left out of an 'and',
+            # but makes an 'or' match everything.
+            everything = everything or filter_type == 'or'
+            continue
+        if child['filterType'] == filter_type:
+            children.extend(child['childFilters'])
+        else:
+            children.append(child)
+    if everything:
+        return None
+    children = _merge_between(children, intersect=filter_type == 'and')
+    if children is None:
+        logger.debug('Empty range in %s', node)
+        return _NEVER
+    unique = {}
+    for child in children:
+        unique.setdefault(_key(child), child)
+    children = [unique[k] for k in sorted(unique)]
+    if not children:
+        # An 'or' whose every branch can never match cannot match either.
+        return _NEVER if never else None
+    if len(children) == 1:
+        return children[0]
+    return {'filterType': filter_type, 'childFilters': children}
+
+
+def compile_filter(criteria, fields=None):
+    """
+    Return the canonical form of the filter tree criteria (dictionaries from YAML and/or
+    datamodels.SearchFilter objects), or None if it has no clauses.
+    If fields (a set of fieldIds, see dataset_field_ids) is given, unknown fieldIds raise FilterError.
+    """
+    if criteria is None:
+        return None
+    criteria = to_dict(criteria)
+    compiled = _compile(criteria, fields)
+    if compiled is _NEVER:
+        raise FilterError('The criteria can never match: empty range in {}'.format(criteria))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Compiled search filter: %s -> %s bytes', len(_key(criteria)), len(_key(compiled or {})))
+    return compiled
+
+
+def compile_payload(payload, fields=None):
+    """
+    Return a copy of a search or hits payload with additionalCriteria compiled.
+    """
+    if not payload.get('additionalCriteria'):
+        return payload
+    payload = dict(payload)
+    compiled = compile_filter(payload['additionalCriteria'], fields)
+    if compiled is None:
+        del payload['additionalCriteria']
+    else:
+        payload['additionalCriteria'] = compiled
+    return payload
+
+
+def canonical_hash(obj):
+    """
+    SHA-1 hex digest of obj (e.g. a compiled filter or payload) independent of dictionary key order.
+    """
+    return hashlib.sha1(_key(obj).encode('utf-8')).hexdigest()
+
+
+def dataset_field_ids(apiKey, datasetName, cache_file=None):
+    """
+    Return the set of fieldIds of datasetName from datasetfields. Responses are cached in memory
+    and in cache_file (FIELDS_CACHE_FILE if not given) for FIELDS_TTL seconds.
+    """
+    import api
+    cache_file = cache_file or FIELDS_CACHE_FILE
+    now = time.time()
+    entry = _fields.get(datasetName)
+    if entry is None and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                entry = json.load(f).get(datasetName)
+        except ValueError:
+            logger.warning('Ignoring unreadable datasetfields cache %s', cache_file)
+    if entry is None or now - entry['time'] > FIELDS_TTL:
+        response = api.datasetfields(apiKey, datasetName)
+        entry = {'time': now, 'fieldIds': [f['fieldId'] for f in response['data'] or []]}
+        try:
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        cached[datasetName] = entry
+        with open(cache_file, 'w') as f:
+            json.dump(cached, f)
+    _fields[datasetName] = entry
+    return set(int(i) for i in entry['fieldIds'])
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Persistent entityId <-> displayId translation store for the USGS API Client.
+
+The mapping between a scene's entityId (Landsat Scene ID) and displayId (Landsat
+Product ID) never changes, so once seen it can be answered locally. The store is an
+SQLite database indexed both ways. attach() feeds it from every search, metadata and
+idlookup response made through api.py, and lookup() answers idlookup requests from the
+store, sending only the misses to the server.
+
+The store also keeps the scenes reported withdrawn by deletionsearch, and the date up to
+which deletions have been synchronised for each dataset (see deletions.py).
+"""
+
+import logging
+import os
+import threading
+from os.path import expanduser
+
+import api
+
+DEFAULT_DB = os.path.join(expanduser("~"), ".usgs_id_store.sqlite")
+# Maximum number of IDs per idlookup request and per SQL query.
+LOOKUP_BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+class IdStore(object):
+    """
+    Two-way entityId <-> displayId mapping per dataset, backed by SQLite.
+
+    :param path:
+        String. Database file, created if it does not exist. DEFAULT_DB if not given.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_DB
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS ids ('
+                         'dataset TEXT NOT NULL, entity_id TEXT NOT NULL, display_id TEXT NOT NULL, '
+                         'PRIMARY KEY (dataset, entity_id)) WITHOUT ROWID')
+            conn.execute('CREATE INDEX IF NOT EXISTS ids_display ON ids (dataset, display_id)')
+            conn.execute('CREATE TABLE IF NOT EXISTS deleted ('
+                         'dataset TEXT NOT NULL, entity_id TEXT NOT NULL, display_id TEXT, deletion_date TEXT, '
+                         'PRIMARY KEY (dataset, entity_id)) WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS watermarks (dataset TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def put_many(self, dataset, pairs):
+        """
+        Store (entityId, displayId) pairs for dataset. Returns the number of pairs given.
+        """
+        rows = [(dataset, e, d) for e, d in pairs if e and d]
+        if not rows:
+            return 0
+        with self._lock:
+            self.conn.executemany('INSERT OR IGNORE INTO ids (dataset, entity_id, display_id) VALUES (?, ?, ?)', rows)
+            self.conn.commit()
+        return len(rows)
+
+    def get(self, dataset, ids, inputField='entityId'):
+        """
+        Translate ids of type inputField ('entityId' or 'displayId') from the store.
+        Returns a dictionary {id: translation} holding only the IDs found.
+        """
+        src, dst = ('entity_id', 'display_id') if inputField == 'entityId' else ('display_id', 'entity_id')
+        found = {}
+        ids = list(ids)
+        with self._lock:
+            for i in range(0, len(ids), LOOKUP_BATCH_SIZE):
+                batch = ids[i:i + LOOKUP_BATCH_SIZE]
+                query = 'SELECT {}, {} FROM ids WHERE dataset = ? AND {} IN ({})'.format(
+                    src, dst, src, ','.join('?' * len(batch)))
+                found.update(self.conn.execute(query, [dataset] + batch).fetchall())
+        return found
+
+    def mark_deleted(self, dataset, scenes, purge=False):
+        """
+        Record scenes (DeletedScene dictionaries from a deletionsearch response) as deleted.
+        If purge is set, their ID translations are removed as well. Returns the number of scenes given.
+        """
+        rows = [(dataset, s['entityId'], s.get('displayId'), s.get('deletionDate')) for s in scenes if s.get('entityId')]
+        if not rows:
+            return 0
+        with self._lock:
+            self.conn.executemany('INSERT OR REPLACE INTO deleted (dataset, entity_id, display_id, deletion_date) '
+                                  'VALUES (?, ?, ?, ?)', rows)
+            if purge:
+                self.conn.executemany('DELETE FROM ids WHERE dataset = ? AND entity_id = ?', [r[:2] for r in rows])
+            self.conn.commit()
+        return len(rows)
+
+    def deleted(self, dataset, ids=None):
+        """
+        Return the set of deleted entityIds of dataset, restricted to ids if given.
+        """
+        with self._lock:
+            if ids is None:
+                rows = self.conn.execute('SELECT entity_id FROM deleted WHERE dataset = ?', (dataset,)).fetchall()
+                return {r[0] for r in rows}
+            ids = list(ids)
+            found = set()
+            for i in range(0, len(ids), LOOKUP_BATCH_SIZE):
+                batch = ids[i:i + LOOKUP_BATCH_SIZE]
+                query = 'SELECT entity_id FROM deleted WHERE dataset = ? AND entity_id IN ({})'.format(
+                    ','.join('?' * len(batch)))
+                found.update(r[0] for r in self.conn.execute(query, [dataset] + batch))
+            return found
+
+    def get_watermark(self, dataset):
+        """
+        Return the deletion date (string) up to which deletions of dataset are synchronised, or None.
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM watermarks WHERE dataset = ?', (dataset,)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, dataset, value):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO watermarks (dataset, value) VALUES (?, ?)', (dataset, value))
+            self.conn.commit()
+
+    def ingest(self, method, payload, response):
+        """
+        Store the ID pairs contained in an API response. Used as an api.RESPONSE_HOOKS callback.
+        """
+        import sqlite3
+        data = response.get('data')
+        dataset = payload.get('datasetName')
+        if not data or not dataset:
+            return
+        if method == 'idlookup':
+            if payload.get('inputField', 'entityId') == 'entityId':
+                pairs = data.items()
+            else:
+                pairs = ((e, d) for d, e in data.items())
+        elif method == 'search':
+            results = data.get('results') or []
+            pairs = ((r.get('entityId'), r.get('displayId')) for r in results if isinstance(r, dict))
+        elif method == 'metadata':
+            pairs = ((r.get('entityId'), r.get('displayId')) for r in data if isinstance(r, dict))
+        else:
+            return
+        try:
+            count = self.put_many(dataset, pairs)
+        except sqlite3.Error:
+            logger.exception('Could not store IDs from the %s response in %s', method, self.path)
+            return
+        if count:
+            logger.debug('Stored %s ID pairs from the %s response', count, method)
+
+
+_store = None
+_attach_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Return the store attached to api.py, or None.
+    """
+    return _store
+
+
+def attach(store=None):
+    """
+    Feed store (an IdStore on DEFAULT_DB if not given) from all search, metadata and
+    idlookup responses of api.py. Returns the store. Without store, a store already
+    attached is kept, so the call can be repeated (e.g. once per worker job).
+    """
+    global _store
+    with _attach_lock:
+        if store is None and _store is not None:
+            return _store
+        if _store is not None:
+            api.RESPONSE_HOOKS.remove(_store.ingest)
+        _store = store or IdStore()
+        api.RESPONSE_HOOKS.append(_store.ingest)
+        return _store
+
+
+def lookup(apiKey, datasetName, idList, inputField='entityId', store=None):
+    """
+    Translate idList like api.idlookup(), answering from the store where possible.
+    Only the IDs missing from the store are sent to the server, in batches of LOOKUP_BATCH_SIZE.
+    Returns a dictionary {id: translation}, like the 'data' element of an idlookup response.
+    """
+    store = store or _store or IdStore()
+    result = store.get(datasetName, idList, inputField)
+    misses = [i for i in idList if i and i not in result]
+    logger.info('%s of %s IDs found in the local store, %s to look up.', len(result), len(idList), len(misses))
+    for i in range(0, len(misses), LOOKUP_BATCH_SIZE):
+        payload = {'datasetName': datasetName, 'idList': misses[i:i + LOOKUP_BATCH_SIZE], 'inputField': inputField}
+        response = api.idlookup(apiKey, payload)
+        data = response['data'] or {}
+        if store is not _store:
+            store.ingest('idlookup', payload, response)
+        result.update(data)
+    return result
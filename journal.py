@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+Crash-safe run journal for the USGS API Client.
+
+A systematic run is a chain of commands (search --systematic, resolve, get-products) joined
+by the YAML files they write. The journal records the progress of each stage in an SQLite
+file, under a run name shared by the commands (--run), so that a run restarted after the
+process died continues where it stopped:
+    - the search dates chosen by rr_proc.update_search_params() are kept until the run
+      finishes, so a restarted run searches the same window instead of advancing it;
+    - search pages already fetched are answered from the journal;
+    - scenes already resolved keep their download records and are not resolved again;
+    - the bytes of every download made to disk durable are recorded per file, whatever the
+      run: an interrupted download continues with an HTTP Range request, a finished one is
+      not downloaded again.
+get-products finishes the run. The pages and resolved scenes of finished runs are deleted.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from os.path import expanduser
+
+DEFAULT_DB = os.path.join(expanduser("~"), ".usgs_run_journal.sqlite")
+# Bytes written to a download between fdatasync() calls that record its progress.
+SYNC_INTERVAL = 16 * 1024 * 1024
+# Seconds the records of finished downloads are kept.
+KEEP_DONE = 7 * 24 * 3600
+# Maximum number of IDs per SQL query.
+QUERY_BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+class RunJournal(object):
+    """
+    Progress of runs and downloads, backed by SQLite.
+
+    :param path:
+        String. Database file, created if it does not exist. DEFAULT_DB if not given.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_DB
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS runs ('
+                         'run TEXT PRIMARY KEY, params TEXT, stage TEXT, started REAL NOT NULL, '
+                         'updated REAL NOT NULL, finished REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS pages ('
+                         'run TEXT NOT NULL, page INTEGER NOT NULL, response TEXT NOT NULL, '
+                         'PRIMARY KEY (run, page))')
+            conn.execute('CREATE TABLE IF NOT EXISTS resolved ('
+                         'run TEXT NOT NULL, entity_id TEXT NOT NULL, records TEXT NOT NULL, '
+                         'PRIMARY KEY (run, entity_id))')
+            conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'key TEXT PRIMARY KEY, path TEXT NOT NULL, url TEXT, bytes INTEGER NOT NULL, '
+                         'size INTEGER, status TEXT NOT NULL, updated REAL NOT NULL)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def run(self, run):
+        """
+        Return the unfinished run: {'run', 'params', 'stage', 'started', 'updated'}, or None.
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT run, params, stage, started, updated FROM runs '
+                                    'WHERE run = ? AND finished IS NULL', (run,)).fetchone()
+        if row is None:
+            return None
+        return {'run': row[0], 'params': json.loads(row[1]) if row[1] else None, 'stage': row[2],
+                'started': row[3], 'updated': row[4]}
+
+    def begin(self, run, params=None):
+        """
+        Start run with params (JSON-serialisable), unless it is already in progress.
+        Returns the params of the run: those given, or those of the run in progress.
+        """
+        current = self.run(run)
+        if current is not None:
+            logger.info('Resuming run %s started %s at stage %s.', run,
+                        datetime.utcfromtimestamp(current['started']).strftime('%Y-%m-%dT%H:%M:%S'), current['stage'])
+            return current['params']
+        now = time.time()
+        with self._lock:
+            self.conn.execute('DELETE FROM pages WHERE run = ?', (run,))
+            self.conn.execute('DELETE FROM resolved WHERE run = ?', (run,))
+            self.conn.execute('INSERT OR REPLACE INTO runs (run, params, stage, started, updated) VALUES (?, ?, ?, ?, ?)',
+                              (run, json.dumps(params), 'start', now, now))
+            self.conn.commit()
+        logger.info('Started run %s.', run)
+        return params
+
+    def stage(self, run, stage):
+        """
+        Record that run has reached stage. Starts the run if it is not in progress.
+        """
+        if self.run(run) is None:
+            self.begin(run)
+        with self._lock:
+            self.conn.execute('UPDATE runs SET stage = ?, updated = ? WHERE run = ?', (stage, time.time(), run))
+            self.conn.commit()
+
+    def finish(self, run):
+        """
+        Mark run finished and drop its pages and resolved scenes.
+        """
+        with self._lock:
+            self.conn.execute('UPDATE runs SET stage = ?, finished = ? WHERE run = ? AND finished IS NULL',
+                              ('done', time.time(), run))
+            self.conn.execute('DELETE FROM pages WHERE run = ?', (run,))
+            self.conn.execute('DELETE FROM resolved WHERE run = ?', (run,))
+            self.conn.execute('DELETE FROM files WHERE status = ? AND updated < ?', ('done', time.time() - KEEP_DONE))
+            self.conn.commit()
+        logger.info('Finished run %s.', run)
+
+    def page(self, run, page, fetch):
+        """
+        Return the response to page (e.g. the startingNumber of a search) of run, calling
+        fetch() and recording the response if it has not been fetched yet.
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT response FROM pages WHERE run = ? AND page = ?', (run, page)).fetchone()
+        if row is not None:
+            logger.info('Page %s of run %s was fetched before.', page, run)
+            return json.loads(row[0])
+        response = fetch()
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO pages (run, page, response) VALUES (?, ?, ?)',
+                              (run, page, json.dumps(response)))
+            self.conn.commit()
+        return response
+
+    def resolved(self, run, entity_ids):
+        """
+        Return {entityId: [download record]} of the entity_ids already resolved in run.
+        """
+        entity_ids = list(entity_ids)
+        found = {}
+        with self._lock:
+            for i in range(0, len(entity_ids), QUERY_BATCH_SIZE):
+                batch = entity_ids[i:i + QUERY_BATCH_SIZE]
+                query = 'SELECT entity_id, records FROM resolved WHERE run = ? AND entity_id IN ({})'.format(
+                    ','.join('?' * len(batch)))
+                for row in self.conn.execute(query, [run] + batch):
+                    found[row[0]] = json.loads(row[1])
+        return found
+
+    def add_resolved(self, run, entity_ids, records):
+        """
+        Record entity_ids as resolved in run, with their download records (scenes without
+        records had no products available).
+        """
+        per_scene = {e: [] for e in entity_ids}
+        for record in records:
+            per_scene.setdefault(record.get('entityId'), []).append(record)
+        with self._lock:
+            self.conn.executemany('INSERT OR REPLACE INTO resolved (run, entity_id, records) VALUES (?, ?, ?)',
+                                  [(run, e, json.dumps(r)) for e, r in per_scene.items()])
+            self.conn.commit()
+
+    def file(self, key):
+        """
+        Return the recorded download of key: {'path', 'url', 'bytes', 'size', 'status'}, or None.
+        status is 'partial' while bytes of the temporary file path are durable, 'done' once
+        the download has been renamed to path.
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT path, url, bytes, size, status FROM files WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return {'path': row[0], 'url': row[1], 'bytes': row[2], 'size': row[3], 'status': row[4]}
+
+    def update_file(self, key, path, url, nbytes, size=None, status='partial'):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO files (key, path, url, bytes, size, status, updated) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?)', (key, path, url, nbytes, size, status, time.time()))
+            self.conn.commit()
+
+    def drop_file(self, key):
+        with self._lock:
+            self.conn.execute('DELETE FROM files WHERE key = ?', (key,))
+            self.conn.commit()
+
+    def state(self):
+        """
+        Return the unfinished runs with their progress: a list of {'run', 'stage', 'params',
+        'started', 'updated', 'pages', 'resolved'}, and the number of partial downloads.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT r.run, r.stage, r.params, r.started, r.updated, '
+                '(SELECT COUNT(*) FROM pages p WHERE p.run = r.run), '
+                '(SELECT COUNT(*) FROM resolved s WHERE s.run = r.run) '
+                'FROM runs r WHERE r.finished IS NULL ORDER BY r.started').fetchall()
+            partial = self.conn.execute('SELECT COUNT(*) FROM files WHERE status = ?', ('partial',)).fetchone()[0]
+        runs = [{'run': r[0], 'stage': r[1], 'params': json.loads(r[2]) if r[2] else None,
+                 'started': datetime.utcfromtimestamp(r[3]).strftime('%Y-%m-%dT%H:%M:%S'),
+                 'updated': datetime.utcfromtimestamp(r[4]).strftime('%Y-%m-%dT%H:%M:%S'),
+                 'pages': r[5], 'resolved': r[6]} for r in rows]
+        return runs, partial
+
+
+_journal = None
+_attach_lock = threading.Lock()
+
+
+def get_journal():
+    """
+    Return the journal used by rr_proc.py, or None.
+    """
+    return _journal
+
+
+def attach(journal=None):
+    """
+    Record the progress of runs and downloads in journal (a RunJournal on DEFAULT_DB if
+    not given). Returns the journal. Without journal, a journal already attached is kept.
+    """
+    global _journal
+    with _attach_lock:
+        if journal is None and _journal is not None:
+            return _journal
+        _journal = journal or RunJournal()
+        return _journal
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Adaptive concurrency limits for the USGS API Client.
+
+An AdaptiveLimiter caps the number of requests in flight and adjusts the cap while running
+(additive increase, multiplicative decrease):
+    - until the first sign of congestion (slow start), a successful request that ran while
+      the limit was fully used raises the limit by one, i.e. the limit doubles per round;
+    - after that, such a request raises the limit by 1/limit, i.e. by about one per round;
+    - an error (connection failure, HTTP 429 or 5xx) or a latency well above the best seen
+      lowers it by BACKOFF, at most once per round.
+Latency is measured per request, or per byte if a size is reported (downloads), so that
+adding streams is stopped once the per-stream rate drops, i.e. once the aggregate throughput
+no longer grows. Requests of different kinds (e.g. API methods) are compared only with
+requests of their own kind, so that a cheap call does not make the others look congested.
+
+api.py and rr_proc.py share the limiters returned by get_limiter(): 'api' for API calls and
+'download' for product downloads.
+
+A RateBudget caps the request rate of one consumer (e.g. one dataset of a multi-dataset search,
+see multisearch.py) independently of the shared concurrency limits.
+"""
+
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# HTTP status codes treated as a sign of server overload.
+CONGESTION_CODES = [429, 500, 502, 503, 504]
+# Factor applied to the limit on errors and latency increases.
+BACKOFF = 0.7
+# A latency above LATENCY_TOLERANCE times the lowest latency seen counts as congestion.
+LATENCY_TOLERANCE = 2.0
+# Relative growth of the lowest latency per sample, so it follows lasting changes of the server speed.
+MIN_LATENCY_DRIFT = 0.001
+# Weight of a new sample in the smoothed latency.
+SMOOTHING = 0.2
+# Initial, minimum and maximum limits per limiter name.
+LIMITS = {
+    'api': {'initial': 4, 'minimum': 1, 'maximum': 16},
+    # Downloads start at the fixed number of streams used before the limiter and may grow up to
+    # rr_proc.MAX_DOWNLOADS, which replaces the maximum.
+    'download': {'initial': 10, 'minimum': 1, 'maximum': 32},
+}
+
+logger = logging.getLogger(__name__)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class AdaptiveLimiter(object):
+    """
+    AIMD concurrency limiter. Use slot() around each request, or acquire() and release().
+
+    :param name:
+        String. Name used in logs.
+    :param initial:
+        Integer. Starting limit.
+    :param minimum:
+        Integer. Lowest limit.
+    :param maximum:
+        Integer. Highest limit.
+    """
+
+    def __init__(self, name, initial=4, minimum=1, maximum=16):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        # Lowest and smoothed latency per request kind.
+        self.min_latency = {}
+        self.latency = {}
+        self.errors = 0
+        self.requests = 0
+        self.slow_start = True
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, kind=None):
+        """
+        Wait for a free slot and take it for a request of kind (any hashable, e.g. the API
+        method; latencies are compared per kind). Returns a slot dictionary to pass to release(),
+        in which the caller can set 'error' (Boolean), 'size' (bytes transferred) and 'sample'
+        (False if the request says nothing about the server, e.g. it was not sent).
+        """
+        with self._cond:
+            while self.in_flight >= max(int(self.limit), self.minimum):
+                self._cond.wait()
+            self.in_flight += 1
+            return {'start': time.monotonic(), 'busy': self.in_flight >= int(self.limit),
+                    'error': False, 'size': None, 'sample': True, 'kind': kind}
+
+    def release(self, slot):
+        """
+        Give back a slot taken with acquire() and adjust the limit from its outcome.
+        """
+        now = time.monotonic()
+        with self._cond:
+            self.in_flight -= 1
+            if slot['sample']:
+                self.requests += 1
+                if slot['error']:
+                    self.errors += 1
+                    self._decrease(slot, 'error')
+                else:
+                    self._observe(slot, now)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, kind=None):
+        """
+        Context manager holding a slot for a request of kind. Exceptions raised in the block count as errors.
+        """
+        slot = self.acquire(kind)
+        try:
+            yield slot
+        except BaseException:
+            slot['error'] = True
+            raise
+        finally:
+            self.release(slot)
+
+    def _observe(self, slot, now):
+        latency = now - slot['start']
+        if slot['size']:
+            latency /= slot['size']
+        kind = slot.get('kind')
+        if kind not in self.min_latency:
+            self.min_latency[kind] = self.latency[kind] = latency
+        else:
+            self.min_latency[kind] = min(latency, self.min_latency[kind] * (1 + MIN_LATENCY_DRIFT))
+            self.latency[kind] = SMOOTHING * latency + (1 - SMOOTHING) * self.latency[kind]
+        if self.latency[kind] > self.min_latency[kind] * LATENCY_TOLERANCE:
+            self._decrease(slot, 'latency')
+        elif slot['busy'] and self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+            logger.debug('%s limit raised to %.2f', self.name, self.limit)
+
+    def _decrease(self, slot, reason):
+        # Requests started before the last decrease saw the old limit - do not back off twice for them.
+        if slot['start'] < self._last_decrease:
+            return
+        self.limit = max(float(self.minimum), self.limit * BACKOFF)
+        self.slow_start = False
+        self._last_decrease = time.monotonic()
+        if reason == 'latency':
+            # Start the latency average afresh at the new limit.
+            self.latency[slot.get('kind')] = self.min_latency[slot.get('kind')]
+        logger.debug('%s limit lowered to %.2f (%s)', self.name, self.limit, reason)
+
+    def stats(self):
+        """
+        Return a dictionary with the current limit, requests in flight, request and error counts.
+        """
+        with self._cond:
+            return {'limit': math.floor(self.limit), 'in_flight': self.in_flight,
+                    'requests': self.requests, 'errors': self.errors}
+
+
+class RateBudget(object):
+    """
+    Token bucket allowing rate requests per second on average and bursts of up to burst requests.
+
+    :param name:
+        String. Name used in logs.
+    :param rate:
+        Float. Requests per second.
+    :param burst:
+        Integer. Requests that may be made at once after an idle period.
+    """
+
+    def __init__(self, name, rate, burst=1):
+        if rate <= 0:
+            raise ValueError('Rate budget of {} must be positive, got {}'.format(name, rate))
+        self.name = name
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a request from the budget. Returns the number of seconds to wait before making it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait(self):
+        """
+        Take a request from the budget, sleeping until it may be made.
+        """
+        delay = self.reserve()
+        if delay:
+            logger.debug('%s rate budget: waiting %.2f s', self.name, delay)
+            time.sleep(delay)
+
+
+def get_limiter(name):
+    """
+    Return the process-wide limiter called name, created from LIMITS on first use.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name, **LIMITS.get(name, {}))
+        return _limiters[name]
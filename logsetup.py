@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Logging configuration for the USGS API Client.
+
+Library modules (api.py, rr_proc.py, ...) only create their loggers. The entry point
+calls configure() once, which reads logging.conf and applies it with dictConfig.
+
+Log calls use lazy %-style arguments, so messages below the active levels are never
+formatted. configure() moves the configured handlers behind a queue: the calling threads
+only build the message (the arguments may be changed once the call returns) and enqueue
+the record, and the formatting for each handler and file I/O happen in a background
+listener thread.
+The log files are written as one JSON object per line (JsonFormatter). Request and response
+bodies are logged through body(), which truncates large bodies.
+"""
+
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+
+abs_mod_dir = os.path.dirname(__file__)
+LOG_CONF = os.path.join(abs_mod_dir, 'logging.conf')
+# Bodies logged with body() are cut to this many characters...
+BODY_LIMIT = 2000
+# ...except for this fraction of them, which is logged in full.
+BODY_SAMPLE_RATE = 0.01
+
+_configured = False
+_lock = threading.Lock()
+_listener = None
+# Formats the tracebacks of queued records.
+_exc_formatter = logging.Formatter()
+
+# Attributes of every LogRecord; anything else was passed with extra= and is added to the JSON output.
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as single-line JSON objects with time, level, logger, thread and message
+    keys, plus the exception and any extra= fields.
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc_info'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class _Body(object):
+    """
+    Lazily serialised request or response body, see body().
+    """
+
+    __slots__ = ('data', 'limit')
+
+    def __init__(self, data, limit):
+        self.data = data
+        self.limit = limit
+
+    def __str__(self):
+        text = self.data if isinstance(self.data, str) else json.dumps(self.data, default=str)
+        if len(text) <= self.limit or random.random() < BODY_SAMPLE_RATE:
+            return text
+        return '{}... ({} more characters)'.format(text[:self.limit], len(text) - self.limit)
+
+
+def body(data, limit=None):
+    """
+    Wrap a request or response body (string or JSON-serialisable data) for a log call argument.
+    It is only serialised if the record is emitted, and cut to BODY_LIMIT characters except
+    for a BODY_SAMPLE_RATE sample.
+    """
+    return _Body(data, limit or BODY_LIMIT)
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that only merges the arguments into the message before the record is queued
+    (they may be objects the logging thread keeps changing, e.g. download items). Laying out
+    the record for each handler is left to the listener thread.
+    """
+
+    def prepare(self, record):
+        message = record.getMessage()
+        record = copy.copy(record)
+        record.message = record.msg = message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _queue_handlers():
+    """
+    Replace the handlers of the root logger (and of other loggers with handlers) by a
+    QueueHandler feeding one QueueListener thread that runs the original handlers.
+    """
+    global _listener
+    import atexit
+    import queue
+
+    loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(l, logging.Logger) and l.handlers]
+    handlers = []
+    for l in loggers:
+        for h in l.handlers:
+            if h not in handlers:
+                handlers.append(h)
+    if not handlers:
+        return
+    q = queue.SimpleQueue()
+    queue_handler = _LazyQueueHandler(q)
+    for l in loggers:
+        l.handlers = [queue_handler]
+    _listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    """
+    Flush the queued log records and stop the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def configure(conf_file=None):
+    """
+    Apply the YAML logging configuration in conf_file (logging.conf by default).
+    Only the first call has an effect, subsequent calls return immediately.
+    """
+    global _configured
+    if _configured:
+        return
+    with _lock:
+        if _configured:
+            return
+        import logging.config
+        import yaml
+        with open(conf_file or LOG_CONF, 'r') as f:
+            logging.config.dictConfig(yaml.safe_load(f.read()))
+        _queue_handlers()
+        _configured = True
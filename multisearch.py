@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Concurrent search over several datasets for the USGS API Client.
+
+Each search is a search payload (see params/search.yaml) with its own datasetName and
+criteria, optionally with a 'rate' budget in requests per second (see limiter.RateBudget).
+The searches page through api.search_pages() on one shared pool of worker threads: a worker
+fetches a single page and hands the search back to the pool, so datasets are interleaved
+and a large dataset does not hold back the others. API calls are also bounded by the
+shared 'api' limiter (see limiter.py).
+
+search_datasets() merges the results into one stream of (datasetName, result) pairs, in
+the order the pages arrive.
+"""
+
+import itertools
+import logging
+import threading
+import time
+from queue import Full, PriorityQueue, Queue
+
+import api
+import limiter
+
+# Default number of worker threads, at most one per dataset is used.
+MAX_WORKERS = 4
+# Default rate budgets in requests per second per datasetName. Searches with a 'rate' of
+# their own use that instead, datasets without a budget are only bounded by the 'api' limiter.
+DATASET_RATES = {}
+# Pages fetched ahead of the consumer, per worker.
+PAGES_AHEAD = 2
+
+logger = logging.getLogger(__name__)
+
+
+def load_searches(conf):
+    """
+    Return the list of search payloads in a multisearch configuration (see params/multisearch.yaml):
+    the 'searches' list, each entry merged over the 'defaults' dictionary.
+    """
+    defaults = conf.get('defaults') or {}
+    searches = []
+    for entry in conf.get('searches') or []:
+        search = dict(defaults)
+        search.update(entry)
+        if not search.get('datasetName'):
+            raise ValueError('Search without datasetName: {}'.format(entry))
+        searches.append(search)
+    if not searches:
+        raise ValueError('No searches in the configuration.')
+    return searches
+
+
+def search_datasets(apiKey, searches, workers=None, summary=None):
+    """
+    Run the searches (list of search payloads with a datasetName each, plus an optional 'rate')
+    concurrently. Generator over (datasetName, result) pairs for all scenes found.
+    If summary (a dictionary) is given, it is filled with {datasetName: {'totalHits', 'pages',
+    'results'}} as pages arrive. An error in any search stops all of them and is raised here.
+
+    :param workers:
+        Integer. Number of worker threads, MAX_WORKERS if not given.
+    """
+    workers = max(1, min(workers or MAX_WORKERS, len(searches)))
+    order = itertools.count()
+    tasks = PriorityQueue()
+    pages = Queue(maxsize=workers * PAGES_AHEAD)
+    stop = threading.Event()
+    remaining = [len(searches)]
+    remaining_lock = threading.Lock()
+
+    def schedule(index, budget, page_iter):
+        # Tasks are ordered by the time their next page may be requested.
+        ready = time.monotonic() + (budget.reserve() if budget else 0.0)
+        tasks.put((ready, next(order), index, budget, page_iter))
+
+    def publish(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def finish():
+        with remaining_lock:
+            remaining[0] -= 1
+            done = not remaining[0]
+        if done:
+            for _ in range(workers):
+                tasks.put((float('inf'), next(order), None, None, None))
+
+    def work():
+        while not stop.is_set():
+            ready, _, index, budget, page_iter = tasks.get()
+            if index is None:
+                return
+            delay = ready - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                response = next(page_iter)
+            except StopIteration:
+                publish((index, None, None))
+                finish()
+                continue
+            except Exception as exc:
+                logger.exception('Search of %s failed', searches[index]['datasetName'])
+                publish((index, None, exc))
+                finish()
+                continue
+            publish((index, response, None))
+            schedule(index, budget, page_iter)
+
+    for index, search in enumerate(searches):
+        payload = dict(search)
+        name = payload['datasetName']
+        rate = payload.pop('rate', None) or DATASET_RATES.get(name)
+        budget = limiter.RateBudget(name, rate) if rate else None
+        schedule(index, budget, api.search_pages(apiKey, payload))
+    logger.info('Searching %s datasets with %s workers.', len(searches), workers)
+
+    threads = [threading.Thread(target=work, name='multisearch-{}'.format(i), daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+    active = len(searches)
+    counted = set()
+    try:
+        while active:
+            index, response, error = pages.get()
+            if error is not None:
+                raise error
+            if response is None:
+                active -= 1
+                continue
+            name = searches[index]['datasetName']
+            data = response['data'] or {}
+            if summary is not None:
+                entry = summary.setdefault(name, {'totalHits': 0, 'pages': 0, 'results': 0})
+                if index not in counted:
+                    # Several searches may share a dataset, count the hits of each once.
+                    counted.add(index)
+                    entry['totalHits'] += data.get('totalHits', 0)
+                entry['pages'] += 1
+                entry['results'] += len(data.get('results') or [])
+            for result in data.get('results') or []:
+                yield name, result
+    finally:
+        stop.set()
+        # Wake up workers waiting for a task.
+        for _ in range(workers):
+            tasks.put((float('-inf'), next(order), None, None, None))
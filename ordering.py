@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Ordering of products that are not available for download, for the USGS API Client.
+
+Products that downloadoptions reports unavailable (e.g. not processed yet, or stored offline)
+have to be ordered before they can be downloaded. order_products() adds the scenes to the
+order item basket of the account, ORDER_BATCH_SIZE scenes at a time, and submits each basket
+as one order. wait_available() polls downloadoptions with exponential backoff until the
+ordered products can be downloaded, or ORDER_TIMEOUT has passed (so orders that failed or
+were rejected are not waited for forever). recover() resolves and downloads each group of products
+as soon as it becomes available, while the remaining orders are still being processed.
+
+The item basket belongs to the account and is cleared before each batch, so do not fill it
+from EarthExplorer while an order run is in progress.
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from queue import Queue
+from threading import Thread
+
+import api
+import rr_proc
+
+# Number of scenes per order.
+ORDER_BATCH_SIZE = 500
+# Number of concurrent updateorderscene requests while a basket is filled.
+ORDER_WORKERS = 4
+# Output media requested for ordered products, if the product offers it.
+OUTPUT_MEDIA = 'DWNL'
+# Seconds between availability checks: starts at POLL_INTERVAL, multiplied by POLL_BACKOFF
+# after each check without newly available products, up to MAX_POLL_INTERVAL.
+POLL_INTERVAL = 60
+POLL_BACKOFF = 2.0
+MAX_POLL_INTERVAL = 1800
+# Seconds to wait for ordered products, unless another timeout is given.
+ORDER_TIMEOUT = 3 * 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+def check_products(apiKey, dataset_name, entity_ids, prod_types):
+    """
+    Query downloadoptions for the prod_types of entity_ids.
+    Returns (options, pending): options as returned by rr_proc.get_download_options() (available
+    products only), pending a dictionary {entityId: [productCode]} of the products reported unavailable.
+    """
+    options = {}
+    pending = {}
+    for batch in rr_proc._batches(list(entity_ids), rr_proc.RESOLVE_BATCH_SIZE):
+        response = api.downloadoptions(apiKey, {'datasetName': dataset_name, 'entityIds': batch})
+        for scene in response['data'] or []:
+            available = options.setdefault(scene['entityId'], {})
+            for o in scene['downloadOptions']:
+                if o['productCode'] not in prod_types:
+                    continue
+                if o['available']:
+                    available[o['productCode']] = o
+                else:
+                    pending.setdefault(scene['entityId'], []).append(o['productCode'])
+    return options, pending
+
+
+def _basket_items(dataset_name, scene, products):
+    """
+    updateorderscene payloads ordering products of an OrderScene (getorderproducts response).
+    Products the scene cannot be ordered with are replaced by its default product.
+    """
+    offered = [p for p in scene.get('availableProducts') or [] if p['productCode'] in products]
+    if not offered and scene.get('product'):
+        default = scene['product']
+        offered = [{'productCode': default['productCode'], 'outputMedias': [default.get('outputMedia')],
+                    'options': [default.get('option')]}]
+    items = []
+    for p in offered:
+        medias = [m for m in p.get('outputMedias') or [] if m]
+        options = [o for o in p.get('options') or [] if o]
+        items.append({
+            'datasetName': dataset_name,
+            'entityId': scene['entityId'],
+            'productCode': p['productCode'],
+            'outputMedia': OUTPUT_MEDIA if OUTPUT_MEDIA in medias or not medias else medias[0],
+            'option': options[0] if options else 'None',
+        })
+    return items
+
+
+def order_products(apiKey, dataset_name, pending, batch_size=None):
+    """
+    Order the products in pending ({entityId: [productCode]}), batch_size (ORDER_BATCH_SIZE
+    if not given) scenes per order. Scenes that cannot be ordered are skipped.
+    Returns a list of orders: {'orderNumber', 'datasetName', 'entityIds', 'products', 'submitted'}.
+    """
+    orders = []
+    for batch in rr_proc._batches(sorted(pending), batch_size or ORDER_BATCH_SIZE):
+        response = api.getorderproducts(apiKey, {'datasetName': dataset_name, 'entityIds': batch})
+        items = []
+        for scene in response['data'] or []:
+            items.extend(_basket_items(dataset_name, scene, pending.get(scene['entityId'], [])))
+        skipped = len(batch) - len(set(i['entityId'] for i in items))
+        if skipped:
+            logger.warning('%s of %s scenes cannot be ordered.', skipped, len(batch))
+        if not items:
+            continue
+        api.clearorder(apiKey)
+        with ThreadPoolExecutor(max_workers=ORDER_WORKERS) as pool:
+            list(pool.map(lambda item: api.updateorderscene(apiKey, item), items))
+        data = api.submitorder(apiKey)['data']
+        order = {
+            'orderNumber': data.get('orderNumber') if isinstance(data, dict) else data,
+            'datasetName': dataset_name,
+            'entityIds': sorted(set(i['entityId'] for i in items)),
+            'products': len(items),
+            'submitted': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        logger.info('Submitted order %s: %s products of %s scenes.', order['orderNumber'], len(items),
+                    len(order['entityIds']))
+        orders.append(order)
+    return orders
+
+
+def wait_available(apiKey, dataset_name, pending, interval=None, max_interval=None, timeout=None):
+    """
+    Poll downloadoptions until the products in pending ({entityId: [productCode]}) are available.
+    Generator over (options, ready) pairs, one per check with newly available products: ready is
+    {entityId: [productCode]}, options their download options (see rr_proc.get_download_options).
+    pending is updated in place, so after timeout seconds (ORDER_TIMEOUT if not given) it holds
+    the products still missing.
+    Checks start interval (POLL_INTERVAL) seconds apart and back off up to max_interval
+    (MAX_POLL_INTERVAL) while nothing becomes available.
+    """
+    interval = interval or POLL_INTERVAL
+    max_interval = max(max_interval or MAX_POLL_INTERVAL, interval)
+    delay = interval
+    deadline = time.monotonic() + (timeout or ORDER_TIMEOUT)
+    while pending:
+        options = rr_proc.get_download_options(apiKey, dataset_name, list(pending))
+        ready = {}
+        for entity_id, products in list(pending.items()):
+            done = [p for p in products if p in options.get(entity_id, {})]
+            if not done:
+                continue
+            ready[entity_id] = done
+            pending[entity_id] = [p for p in products if p not in done]
+            if not pending[entity_id]:
+                del pending[entity_id]
+        if ready:
+            logger.info('Ordered products of %s scenes are available, %s scenes pending.', len(ready), len(pending))
+            yield options, ready
+            delay = interval
+        else:
+            delay = min(delay * POLL_BACKOFF, max_interval)
+        if not pending:
+            return
+        if time.monotonic() + delay > deadline:
+            logger.warning('Ordered products of %s scenes are still not available, giving up.', len(pending))
+            return
+        logger.debug('Next availability check in %.0f s', delay)
+        time.sleep(delay)
+
+
+def _downloader(batches, results, out_dir, download_args):
+    while True:
+        records = batches.get()
+        if records is None:
+            return
+        try:
+            results.extend(rr_proc.download_records(records, out_dir, **download_args))
+        except Exception:
+            logger.exception('Download of %s ordered products failed', len(records))
+            results.extend({'Status': 'Failed', 'URL': r.get('url')} for r in records)
+
+
+def recover(apiKey, dataset_name, entity_ids, prod_types, out_dir, timeout=None, interval=None, batch_size=None,
+            **download_args):
+    """
+    Download the prod_types of entity_ids to out_dir, ordering the products that are not available.
+    Available products are downloaded at once. Unavailable ones are ordered (order_products) and
+    downloaded group by group as wait_available() reports them, in a background thread so that
+    polling continues during downloads. download_args are passed to rr_proc.download_records().
+    Returns {'orders', 'pending', 'unorderable', 'results'}: the submitted orders, the products
+    still not available after timeout seconds (ORDER_TIMEOUT if not given), the unavailable
+    products that could not be ordered ({entityId: [productCode]}), and the status of each download.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    options, pending = check_products(apiKey, dataset_name, entity_ids, prod_types)
+    logger.info('%s scenes have products to order.', len(pending))
+    batches = Queue()
+    results = []
+    worker = Thread(target=_downloader, args=(batches, results, out_dir, dict(download_args, apiKey=apiKey)),
+                    daemon=True)
+    worker.start()
+    try:
+        available = [e for e in entity_ids if options.get(e)]
+        if available:
+            batches.put(rr_proc.resolve_downloads(apiKey, dataset_name, available, prod_types, options=options))
+
+        orders = order_products(apiKey, dataset_name, pending, batch_size) if pending else []
+        ordered = set(e for order in orders for e in order['entityIds'])
+        unorderable = {e: p for e, p in pending.items() if e not in ordered}
+        if unorderable:
+            logger.warning('Products of %s scenes are not available and cannot be ordered: %s', len(unorderable),
+                           ', '.join(sorted(unorderable)))
+        pending = {e: p for e, p in pending.items() if e in ordered}
+        for options, ready in wait_available(apiKey, dataset_name, pending, interval=interval, timeout=timeout):
+            products = sorted(set(p for done in ready.values() for p in done))
+            ready_options = {e: {p: options[e][p] for p in done} for e, done in ready.items()}
+            batches.put(rr_proc.resolve_downloads(apiKey, dataset_name, list(ready), products, options=ready_options))
+    finally:
+        # Let the downloads already queued finish, also when ordering failed.
+        batches.put(None)
+        worker.join()
+    return {'orders': orders, 'pending': pending, 'unorderable': unorderable, 'results': results}
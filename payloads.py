@@ -8,6 +8,7 @@ See https://earthexplorer.usgs.gov/inventory/documentation/json-api
 """
 
 import json
+from urllib.parse import quote_plus
 
 
 def cleardownloads(apiKey: str, labels=None):
@@ -442,7 +443,7 @@ def status():
     """
     return json.dumps({})
 
-def download(apiKey: str, datasetName: str, entityIds: list, products: list):
+def download(apiKey: str, datasetName: str, entityIds: list, products: list, label=None):
     """
     :param apiKey:
         String. Users API Key/Authentication Token. Obtained from login request - this can be ommitted
@@ -453,13 +454,20 @@ def download(apiKey: str, datasetName: str, entityIds: list, products: list):
         List of strings.
     :param products:
         List of strings. Product types to download for specified entityIds
+    :param label:
+        String. Optional. Label of the queued downloads, see DownloadLabel and cleardownloads.
     """
-    return json.dumps({
+    payload = {
         'apiKey': apiKey,
         'datasetName': datasetName,
         'entityIds': entityIds,
         'products': products
-    })
+    }
+
+    if label:
+        payload['label'] = label
+
+    return json.dumps(payload)
 
 def downloadoptions(apiKey: str, datasetName: str, entityIds: list):
     """
@@ -477,3 +485,118 @@ def downloadoptions(apiKey: str, datasetName: str, entityIds: list):
         'datasetName': datasetName,
         'entityIds': entityIds
     })
+
+def getorderproducts(apiKey: str, datasetName: str, entityIds: list):
+    """
+    :param apiKey:
+        String. Users API Key/Authentication Token. Obtained from login request - this can be ommitted
+        when using the 'X-Auth-Token' header to pass this value.
+    :param datasetName:
+        String. Identifies the dataset. Use the datasetName from datasets response.
+    :param entityIds:
+        List of strings.
+    """
+
+    return json.dumps({
+        'apiKey': apiKey,
+        'datasetName': datasetName,
+        'entityIds': entityIds
+    })
+
+def updateorderscene(apiKey: str, datasetName: str, entityId: str, productCode: str, outputMedia='DWNL', option='None'):
+    """
+    :param apiKey:
+        String. Users API Key/Authentication Token. Obtained from login request - this can be ommitted
+        when using the 'X-Auth-Token' header to pass this value.
+    :param datasetName:
+        String. Identifies the dataset. Use the datasetName from datasets response.
+    :param entityId:
+        String. The scene to add to the order item basket.
+    :param productCode:
+        String. Product to order, see the availableProducts of the getorderproducts response.
+    :param outputMedia:
+        String. Optional. Default 'DWNL' (download).
+    :param option:
+        String. Optional. Processing option of the product. Default 'None'.
+    """
+
+    return json.dumps({
+        'apiKey': apiKey,
+        'datasetName': datasetName,
+        'entityId': entityId,
+        'productCode': productCode,
+        'outputMedia': outputMedia,
+        'option': option
+    })
+
+def submitorder(apiKey: str):
+    """
+    :param apiKey:
+        String. Users API Key/Authentication Token. Obtained from login request - this can be ommitted
+        when using the 'X-Auth-Token' header to pass this value.
+    """
+
+    return json.dumps({
+        'apiKey': apiKey
+    })
+
+def clearorder(apiKey: str):
+    """
+    :param apiKey:
+        String. Users API Key/Authentication Token. Obtained from login request - this can be ommitted
+        when using the 'X-Auth-Token' header to pass this value.
+    """
+
+    return json.dumps({
+        'apiKey': apiKey
+    })
+
+class PayloadTemplate(object):
+    """
+    A request payload with its static part serialised once. Only the varying keys are
+    serialised when a request is rendered, so paged or sharded requests are cheap to build.
+    Use template() to get one.
+
+    :param static:
+        Dictionary. The payload without the varying keys.
+    :param varying:
+        List of strings. Keys supplied for each request.
+    """
+
+    def __init__(self, static, varying):
+        self.varying = list(varying)
+        self._static = json.dumps(static)[1:-1]
+        self._quoted_static = quote_plus(self._static)
+        self._keys = {k: json.dumps(k) + ': ' for k in self.varying}
+
+    def _pieces(self, values, quote):
+        pieces = [self._quoted_static if quote else self._static] if self._static else []
+        for k in self.varying:
+            value = values.get(k)
+            if value is not None:
+                piece = self._keys[k] + json.dumps(value)
+                pieces.append(quote_plus(piece) if quote else piece)
+        return pieces
+
+    def render(self, **values):
+        """
+        Return the JSON payload with the varying keys set to values. Keys set to None are left out.
+        """
+        return '{' + ', '.join(self._pieces(values, False)) + '}'
+
+    def form(self, **values):
+        """
+        Return the URL-encoded form body (jsonRequest=...) of the request, ready to be POSTed.
+        """
+        return 'jsonRequest=%7B' + '%2C+'.join(self._pieces(values, True)) + '%7D'
+
+
+def template(method, apiKey, varying, **kwargs):
+    """
+    Return a PayloadTemplate for a request built by the payload function method (e.g. 'search')
+    from apiKey and kwargs, with the keys in varying left to be supplied per request.
+    """
+    static = json.loads(globals()[method](apiKey, **kwargs))
+    for k in varying:
+        static.pop(k, None)
+    return PayloadTemplate(static, varying)
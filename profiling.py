@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Profiling support for the USGS API Client.
+
+Phases of a run (auth, search, resolve, download, save) are wrapped in span() and their wall
+time is always recorded. start() additionally runs cProfile in the calling thread and in all
+threads started afterwards (e.g. download workers); stop() merges the profiles into a pstats
+file, which can be read with pstats, snakeviz or converted to a flame graph (e.g. flameprof),
+and writes the span timings next to it as JSON.
+"""
+
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_spans = {}
+_spans_lock = threading.Lock()
+_profilers = []
+_active = False
+
+
+@contextmanager
+def span(name):
+    """
+    Context manager adding the wall time of its block to the span name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _spans_lock:
+            entry = _spans.setdefault(name, {'count': 0, 'seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += elapsed
+
+
+def spans():
+    """
+    Return {span name: {'count', 'seconds'}} for the spans recorded so far.
+    """
+    with _spans_lock:
+        return {k: dict(v) for k, v in _spans.items()}
+
+
+def _thread_profile(*args):
+    # Installed with threading.setprofile(): runs once in each new thread and replaces itself
+    # with a cProfile profiler for that thread.
+    import cProfile
+    sys.setprofile(None)
+    profiler = cProfile.Profile()
+    _profilers.append(profiler)
+    profiler.enable()
+
+
+def start():
+    """
+    Start profiling the calling thread and all threads started from now on.
+    """
+    global _active
+    import cProfile
+    if _active:
+        return
+    _active = True
+    with _spans_lock:
+        _spans.clear()
+    del _profilers[:]
+    threading.setprofile(_thread_profile)
+    profiler = cProfile.Profile()
+    _profilers.append(profiler)
+    profiler.enable()
+
+
+def stop(out_file):
+    """
+    Stop profiling and write the merged profile to out_file (pstats format) and the span
+    timings to out_file + '.spans.json'. Returns the span timings.
+    """
+    global _active
+    import pstats
+    if not _active:
+        return spans()
+    threading.setprofile(None)
+    # The first profiler belongs to the calling thread; the others are stopped when their threads end.
+    _profilers[0].disable()
+    stats = None
+    for profiler in list(_profilers):
+        try:
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        except TypeError:
+            # Profilers of threads that never ran any Python code have no data.
+            continue
+    _active = False
+    if stats is not None:
+        stats.dump_stats(out_file)
+    timings = spans()
+    with open(out_file + '.spans.json', 'w') as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+    for name, entry in sorted(timings.items(), key=lambda item: -item[1]['seconds']):
+        logger.info('Profile span %s: %.3f s in %s calls', name, entry['seconds'], entry['count'])
+    logger.info('Profile written to %s (%s threads)', out_file, len(_profilers))
+    return timings
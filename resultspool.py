@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+"""
+Append-only record spools for large backfills with the USGS API Client.
+
+A backfill over years of scenes passes millions of records between the search, resolve and
+download stages. Instead of YAML lists held in memory, each stage can write its output to a
+spool file and the next stage can read it, in the same run or a separate process, while the
+file is still being written.
+
+Spool file layout (little-endian):
+    header  MAGIC (8 bytes), format VERSION (uint32), flags (uint32, FLAG_CLOSED when complete)
+    record  payload length (uint32), CRC-32 of the payload (uint32), payload (compact JSON)
+
+Records are only ever appended. Readers map the file with mmap and walk the length prefixes,
+so memory stays flat however large the spool grows. Positions are byte offsets:
+    - the writer checkpoints its offset (with a state of its own, e.g. the next search page)
+      to PATH.ckpt; a writer re-opened after a crash truncates the file to that offset and
+      resumes from the saved state, or, without a checkpoint, drops an incomplete last record;
+    - readers only read up to the writer's last checkpoint, as the records after it are
+      replaced when the writer resumes (a spool without a writer checkpoint is read up to
+      its last complete record);
+    - each named reader checkpoints the offset it has processed to PATH.NAME.ckpt and
+      continues from there when opened again.
+
+This is unrelated to the job spool directory of the worker mode (daemon.py).
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+import api
+import rr_proc
+
+MAGIC = b'USGSRSP1'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+RECORD = struct.Struct('<II')
+# Header flag set by SpoolWriter.finish(): no more records will be appended.
+FLAG_CLOSED = 1
+# Records read between automatic checkpoints of a named reader.
+CHECKPOINT_EVERY = 1000
+# Seconds between checks for new records when following a spool that is still written.
+POLL_INTERVAL = 1.0
+# Records per download_records() call of spool_download().
+DOWNLOAD_BATCH_SIZE = 1000
+# Search result fields kept in the records written by spool_search().
+SCENE_FIELDS = ['entityId', 'displayId', 'acquisitionDate']
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolError(Exception):
+    pass
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_json(path, data):
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _read_header(buf):
+    magic, version, flags = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise SpoolError('Not a version {} record spool.'.format(VERSION))
+    return flags
+
+
+def _walk(buf, offset, size):
+    """
+    Generator over (payload, end offset) of the complete records in buf[offset:size].
+    Stops at an incomplete record or one with a wrong checksum.
+    """
+    while offset + RECORD.size <= size:
+        length, crc = RECORD.unpack_from(buf, offset)
+        start = offset + RECORD.size
+        if start + length > size:
+            return
+        payload = buf[start:start + length]
+        if zlib.crc32(payload) != crc:
+            return
+        offset = start + length
+        yield payload, offset
+
+
+def _checkpointed(path):
+    """
+    Return the offset of the last writer checkpoint of the spool path, or None if it has none.
+    """
+    return (_read_json('{}.ckpt'.format(path)) or {}).get('offset')
+
+
+def _scan(path, end=None):
+    """
+    Return (offset, count): the end of the last complete record of the spool (before offset end,
+    if given) and the number of records.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        _read_header(mm)
+        offset, count = HEADER.size, 0
+        for _, offset in _walk(mm, offset, len(mm) if end is None else min(end, len(mm))):
+            count += 1
+    return offset, count
+
+
+class SpoolWriter(object):
+    """
+    Appends records (JSON-serialisable dictionaries) to a spool file, created if it does not exist.
+    An existing spool is resumed from its last checkpoint: see the module docstring.
+    checkpoint() makes the records written so far durable, finish() marks the spool complete.
+
+    :param path:
+        String. Spool file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.checkpoint_path = '{}.ckpt'.format(path)
+        self.state = None
+        if not os.path.exists(path) or not os.path.getsize(path):
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, 0))
+            self.offset, self.count = HEADER.size, 0
+        else:
+            saved = _read_json(self.checkpoint_path)
+            if saved:
+                self.offset, self.count, self.state = saved['offset'], saved['count'], saved.get('state')
+            else:
+                self.offset, self.count = _scan(path)
+        self._file = open(path, 'r+b')
+        self.closed = bool(_read_header(self._file.read(HEADER.size)) & FLAG_CLOSED)
+        size = os.path.getsize(path)
+        if size > self.offset:
+            logger.info('Dropping %s bytes written after the last checkpoint of %s', size - self.offset, path)
+            self._file.truncate(self.offset)
+        self._file.seek(self.offset)
+        if self.count:
+            logger.info('Resuming spool %s after %s records.', path, self.count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, record):
+        if self.closed:
+            raise SpoolError('Spool {} is complete, no records can be added.'.format(self.path))
+        payload = json.dumps(record, separators=(',', ':'), default=str).encode('utf-8')
+        self._file.write(RECORD.pack(len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        self.offset += RECORD.size + len(payload)
+        self.count += 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def checkpoint(self, state=None):
+        """
+        Flush the records to disk and save the offset with state (JSON-serialisable), which
+        is available as self.state when the spool is opened again.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.state = state
+        _write_json(self.checkpoint_path, {'offset': self.offset, 'count': self.count, 'state': state})
+
+    def finish(self, state=None):
+        """
+        Checkpoint and mark the spool complete, so that readers following it stop at its end.
+        """
+        self.checkpoint(state)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, FLAG_CLOSED))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.seek(self.offset)
+        self.closed = True
+        logger.info('Spool %s complete with %s records.', self.path, self.count)
+
+    def close(self):
+        """
+        Close the file. Records written after the last checkpoint are dropped when the spool is resumed.
+        """
+        if not self._file.closed:
+            self._file.flush()
+            self._file.close()
+
+
+class SpoolReader(object):
+    """
+    Reads the records of a spool file through mmap, from the start, from offset start, or,
+    for a named reader, from the offset saved by its last checkpoint.
+    offset is the end of the records processed so far: records() and batches() advance it when
+    the next record or batch is requested, so a record is only checkpointed once the consumer
+    is done with it. position is the end of the records handed out.
+
+    :param path:
+        String. Spool file.
+    :param name:
+        String. Consumer name, checkpoints are saved to PATH.NAME.ckpt. Not saved if not given.
+    :param start:
+        Integer. Offset to start at, overrides a saved checkpoint.
+    """
+
+    def __init__(self, path, name=None, start=None):
+        self.path = path
+        self.name = name
+        self.checkpoint_path = '{}.{}.ckpt'.format(path, name) if name else None
+        if start is None and name:
+            start = (_read_json(self.checkpoint_path) or {}).get('offset')
+        self.offset = self.position = start or HEADER.size
+        # True once the end of a complete spool has been reached.
+        self.complete = False
+
+    def checkpoint(self):
+        if self.checkpoint_path:
+            _write_json(self.checkpoint_path, {'offset': self.offset})
+
+    def _read(self, follow, poll):
+        # Generator over the records from position, None whenever the end of the file is
+        # reached while following a spool that is not complete yet.
+        poll = poll or POLL_INTERVAL
+        while True:
+            if follow and not os.path.exists(self.path):
+                yield None
+                time.sleep(poll)
+                continue
+            # The checkpoint is read first: the records up to it are in the file by then.
+            checkpointed = _checkpointed(self.path)
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                closed = _read_header(mm) & FLAG_CLOSED
+                size = len(mm) if checkpointed is None else min(checkpointed, len(mm))
+                for payload, end in _walk(mm, self.position, size):
+                    self.position = end
+                    yield json.loads(payload.decode('utf-8'))
+            if closed:
+                if self.position < size:
+                    raise SpoolError('Damaged record at offset {} of {}'.format(self.position, self.path))
+                self.complete = True
+                return
+            if not follow:
+                return
+            yield None
+            time.sleep(poll)
+
+    def records(self, follow=False, poll=None):
+        """
+        Generator over the records. With follow, wait for new records until the spool is complete.
+        Named readers checkpoint every CHECKPOINT_EVERY records and at the end.
+        """
+        count = 0
+        for record in self._read(follow, poll):
+            if record is None:
+                continue
+            yield record
+            self.offset = self.position
+            count += 1
+            if count % CHECKPOINT_EVERY == 0:
+                self.checkpoint()
+        self.offset = self.position
+        self.checkpoint()
+
+    def batches(self, size, follow=False, poll=None):
+        """
+        Generator over lists of up to size records. While following, a shorter batch is
+        returned whenever the reader catches up with the writer.
+        Named readers checkpoint after each batch.
+        """
+        batch = []
+        for record in self._read(follow, poll):
+            if record is not None:
+                batch.append(record)
+                if len(batch) < size:
+                    continue
+            if batch:
+                end = self.position
+                yield batch
+                batch = []
+                self.offset = end
+                self.checkpoint()
+        if batch:
+            yield batch
+        self.offset = self.position
+        self.checkpoint()
+
+
+def info(path):
+    """
+    Return {'records', 'bytes', 'complete', 'readers'} of a spool: the number of records readers
+    can see, their size, whether the spool is complete, and the records left per named reader.
+    """
+    end, count = _scan(path, _checkpointed(path))
+    with open(path, 'rb') as f:
+        complete = bool(_read_header(f.read(HEADER.size)) & FLAG_CLOSED)
+    readers = {}
+    prefix = os.path.basename(path) + '.'
+    for name in os.listdir(os.path.dirname(os.path.abspath(path))):
+        if name.startswith(prefix) and name.endswith('.ckpt') and name != prefix + 'ckpt':
+            reader = SpoolReader(path, name[len(prefix):-len('.ckpt')])
+            readers[reader.name] = sum(1 for _ in _walk_file(path, reader.offset, end))
+    return {'records': count, 'bytes': end, 'complete': complete, 'readers': readers}
+
+
+def _walk_file(path, offset, size):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for _, end in _walk(mm, offset, min(size, len(mm))):
+            yield end
+
+
+def spool_search(apiKey, payload, path):
+    """
+    Write the scenes found by a search (payload as in params/search.yaml) to the spool path,
+    one record per scene with SCENE_FIELDS and datasetName. The spool is checkpointed after
+    each page, so an interrupted search resumes at the next page.
+    Returns the number of records in the spool.
+    """
+    dataset_name = payload['datasetName']
+    with SpoolWriter(path) as writer:
+        if writer.closed:
+            logger.info('Spool %s is already complete.', path)
+            return writer.count
+        page = dict(payload)
+        state = writer.state or {}
+        if 'nextRecord' in state:
+            if not state['nextRecord']:
+                writer.finish(state)
+                return writer.count
+            page['startingNumber'] = state['nextRecord']
+        for response in api.search_pages(apiKey, page):
+            data = response['data'] or {}
+            for result in data.get('results') or []:
+                record = {f: result.get(f) for f in SCENE_FIELDS}
+                record['datasetName'] = dataset_name
+                writer.append(record)
+            writer.checkpoint({'nextRecord': data.get('nextRecord')})
+            logger.debug('Spooled %s of %s scenes', writer.count, data.get('totalHits'))
+        writer.finish()
+        return writer.count
+
+
+def spool_resolve(apiKey, in_path, out_path, prod_types, batch_size=None, follow=False, poll=None):
+    """
+    Resolve the download URLs (rr_proc.resolve_downloads) of the prod_types of the scenes in the
+    spool in_path, batch_size (rr_proc.RESOLVE_BATCH_SIZE) scenes at a time, and write the
+    download records to the spool out_path. The input offset is saved with each output
+    checkpoint, so a resumed run neither skips nor repeats scenes. With follow, wait for
+    scenes until the input spool is complete; out_path is completed after it.
+    Returns the number of records in out_path.
+    """
+    with SpoolWriter(out_path) as writer:
+        if writer.closed:
+            logger.info('Spool %s is already complete.', out_path)
+            return writer.count
+        reader = SpoolReader(in_path, start=(writer.state or {}).get('input'))
+        for batch in reader.batches(batch_size or rr_proc.RESOLVE_BATCH_SIZE, follow=follow, poll=poll):
+            datasets = {}
+            for scene in batch:
+                datasets.setdefault(scene['datasetName'], []).append(scene['entityId'])
+            for dataset_name, entity_ids in datasets.items():
+                writer.extend(rr_proc.resolve_downloads(apiKey, dataset_name, entity_ids, prod_types))
+            writer.checkpoint({'input': reader.position})
+        if reader.complete:
+            writer.finish({'input': reader.position})
+        return writer.count
+
+
+def spool_download(in_path, out_dir, prod_types=None, lanes=None, extract_dir=None, extract_workers=None,
+                   apiKey=None, batch_size=None, follow=False, poll=None, failed_path=None):
+    """
+    Download the records of the spool in_path (written by spool_resolve) to out_dir, batch_size
+    (DOWNLOAD_BATCH_SIZE) records at a time, with rr_proc.download_records() (see there for the
+    other arguments). Progress is checkpointed after each batch as the 'download' reader of the
+    spool, so an interrupted run resumes at the first unfinished batch. The records of failed
+    downloads are appended to the spool failed_path, if given, to be retried later.
+    Returns the number of downloads per status.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    reader = SpoolReader(in_path, 'download')
+    failed = SpoolWriter(failed_path) if failed_path else None
+    totals = {}
+    try:
+        for batch in reader.batches(batch_size or DOWNLOAD_BATCH_SIZE, follow=follow, poll=poll):
+            results = rr_proc.download_records(batch, out_dir, prod_types, lanes, extract_dir, extract_workers, apiKey)
+            failed_urls = set()
+            for result in results:
+                status = result.get('Status') or 'Unknown'
+                totals[status] = totals.get(status, 0) + 1
+                if status != 'Downloaded':
+                    failed_urls.add(result.get('URL'))
+            if failed is not None and failed_urls:
+                failed.extend(r for r in batch if r.get('url') in failed_urls)
+                failed.checkpoint()
+            logger.info('Downloaded spool %s up to offset %s: %s', in_path, reader.position, totals)
+    finally:
+        if failed is not None:
+            failed.close()
+    return totals
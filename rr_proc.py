@@ -4,154 +4,976 @@ Author: Max Solomcuk, max.solomcuk@cgi.com
 Request and response processing for USGS API Client
 """
 
+import base64
+import hashlib
+import heapq
 import logging
-import logging.config
 import re
 import os
 import shutil
+import time
+import weakref
 from datetime import datetime, timedelta
-from queue import Queue
-from threading import Thread
+from queue import Empty
+from threading import Condition, Event, Lock, Thread, local
+from urllib.parse import unquote
 
-import requests
-from requests.exceptions import HTTPError, ConnectionError, Timeout
-import yaml
+import api
+import displayid
+import dlqueue
+import idstore
+import journal
+import limiter
+import profiling
+import scheduler
 
 
+# Dataset assumed by search_to_dl() and search_to_dl_opts() when neither the caller nor the input file names one.
+DEFAULT_DATASET = 'LANDSAT_8_C1'
 DISPLAYID_RE = r'L[COT]\d{2}_(L1GT|L1GS|L1TP)_\d{6}_\d{8}_\d{8}_\d{2}_(RT|T1|T2)'
-MAX_DOWNLOADS = 10
+# Upper bound for parallel downloads (and download threads). The actual number starts at the
+# initial 'download' limit in limiter.LIMITS and is adapted to the observed throughput and
+# errors, see limiter.py.
+MAX_DOWNLOADS = 32
 abs_mod_dir = os.path.dirname(__file__)
 TMP_PREFIX = "."
 TMP_SUFFIX = "_lock"
+# Digest computed while downloading. Checksums supplied by the server in another
+# supported algorithm (see _expected_checksum) take precedence.
+CHECKSUM_ALGORITHM = 'md5'
+# Size of the per-thread buffer downloads are read into.
+CHUNK_SIZE = 1024 * 1024
+# Reserve disk space for the whole file up front when its size is known.
+PREALLOCATE = True
+# Drop written data from the page cache every DROP_CACHE_INTERVAL bytes, so large downloads
+# do not push other data out of memory. Costs an fdatasync() per interval.
+DROP_PAGE_CACHE = False
+DROP_CACHE_INTERVAL = 64 * 1024 * 1024
+# Number of attempts for a product whose size or checksum does not match.
+MAX_ATTEMPTS = 3
+# HTTP status codes of download URLs that have expired or are no longer accepted. Such URLs
+# are re-resolved with a download request and the download is retried, at most MAX_REFRESHES times.
+EXPIRED_CODES = [401, 403, 410]
+MAX_REFRESHES = 2
+# Seconds to collect other expired URLs before they are re-resolved together.
+REFRESH_WINDOW = 1.0
+# File name extensions per product code. Used when the server does not send a
+# Content-Disposition file name.
+PRODUCT_EXTENSIONS = {
+    'STANDARD': '.tar.gz',
+    'FR_BUND': '.zip',
+    'FR_REFL': '.jpg',
+    'FR_THERM': '.jpg',
+    'FR_QB': '.png',
+}
+# Assumed throughput of a single download stream in bytes/s, used to predict batch completion time.
+STREAM_RATE = 10 * 1024 * 1024
+# Free space to leave on the output file system after all downloads, in bytes.
+FREE_SPACE_MARGIN = 1024 * 1024 * 1024
+# Archive types handled by the post-download extraction stage.
+ARCHIVE_EXTENSIONS = ['.tar.gz', '.tgz', '.tar', '.zip']
+# Number of entityIds per downloadoptions/download request when resolving products.
+RESOLVE_BATCH_SIZE = 1000
+CONTENT_DISPOSITION_RE = r"filename\*?=(?:UTF-8'')?\"?([^\";]+)\"?"
 
-with open(os.path.join(abs_mod_dir, 'logging.conf'), 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
 logger = logging.getLogger(__name__)
+_buffers = local()
+# Download queues of the download_files() calls in progress, see cancel_downloads().
+_active_queues = weakref.WeakSet()
 
-def search_to_dl_opts(in_file, out_file, dataset_name='LANDSAT_8_C1'):
+class ChecksumError(Exception):
+    pass
+
+class DiskSpaceError(Exception):
+    pass
+
+class ExpiredURLError(Exception):
+    pass
+
+class IncompleteDownloadError(ChecksumError):
+    pass
+
+class URLRefresher(object):
+    """
+    Re-resolves expired download URLs for the download workers.
+    Items whose URLs expire within REFRESH_WINDOW seconds of each other are resolved together,
+    with one download request per dataset and product. URLs issued by the same labelled
+    download request expire together, so the items still queued in q with a URL of the same
+    label are refreshed in the same requests. New URLs are labelled and recorded in the
+    download ledger, if one is attached (see dlqueue.py), and the URLs they replace are
+    marked expired there.
+
+    :param apiKey:
+        String. API key for the download requests, the saved key if not given.
+    :param q:
+        The download queue (scheduler.LaneQueue), optional.
+    """
+
+    def __init__(self, apiKey=None, q=None):
+        self.apiKey = apiKey
+        self.queue = q
+        self.refreshed = 0
+        self._lock = Lock()
+        self._idle = Condition(self._lock)
+        self._active = 0
+        self._batch = None
+
+    def wait_idle(self):
+        """
+        Wait until no refresh is in progress. Returns True if one was, i.e. queued items may
+        have been taken out of q for refreshing and put back since.
+        """
+        with self._lock:
+            if not self._active:
+                return False
+            while self._active:
+                self._idle.wait()
+            return True
+
+    def refresh(self, item):
+        """
+        Return a new URL for the download item (with entityId, product and dataset), or None.
+        Blocks until the batch the item joined has been resolved.
+        """
+        key = (item.get('entityId'), item.get('product'))
+        with self._lock:
+            self._active += 1
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = {'items': [], 'urls': {}, 'done': Event()}
+            batch['items'].append(item)
+        try:
+            if leader:
+                self._lead(batch)
+            else:
+                batch['done'].wait()
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._idle.notify_all()
+        return batch['urls'].get(key)
+
+    def _lead(self, batch):
+        time.sleep(REFRESH_WINDOW)
+        with self._lock:
+            self._batch = None
+        queued = []
+        labels = set(i.get('label') for i in batch['items']) - {None}
+        if self.queue is not None and labels:
+            queued = self.queue.cancel(lambda i: i.get('label') in labels and i.get('refreshes', 0) < MAX_REFRESHES)
+        items = batch['items'] + [work[1] for work in queued]
+        try:
+            batch['urls'], label = self._resolve(items)
+            for item in items:
+                if (item.get('entityId'), item.get('product')) in batch['urls']:
+                    item['label'] = label
+        except Exception:
+            logger.exception('Could not refresh %s expired download URLs', len(batch['items']))
+        finally:
+            batch['done'].set()
+            for work in queued:
+                url = batch['urls'].get((work[1].get('entityId'), work[1].get('product')))
+                if url:
+                    work[1]['url'] = url
+                    work[1]['refreshes'] = work[1].get('refreshes', 0) + 1
+                self.queue.put(work)
+
+    def _resolve(self, items):
+        """
+        Request new URLs for items. Returns {(entityId, product): url} and the label of the requests.
+        """
+        groups = {}
+        for item in items:
+            groups.setdefault((item.get('dataset'), item.get('product')), set()).add(item.get('entityId'))
+        ledger = dlqueue.get_ledger()
+        label = dlqueue.new_label() if ledger is not None else None
+        urls = {}
+        for (dataset, product), entity_ids in groups.items():
+            for batch in _batches(sorted(entity_ids), RESOLVE_BATCH_SIZE):
+                payload = {'datasetName': dataset, 'entityIds': batch, 'products': [product]}
+                if label:
+                    payload['label'] = label
+                records = api.download(self.apiKey, payload)['data'] or []
+                if label:
+                    ledger.record(label, dataset, records)
+                for record in records:
+                    urls[(record.get('entityId'), record.get('product') or product)] = record.get('url')
+        if ledger is not None:
+            ledger.expire([i['url'] for i in items if (i.get('entityId'), i.get('product')) in urls])
+        self.refreshed += len(urls)
+        logger.info('Refreshed %s of %s download URLs.', len(urls), len(items))
+        return urls, label
+
+def search_to_dl_opts(in_file, out_file, dataset_name=None):
     """
     Read a response from search query, extract entityIds and write out to a "downloadoptions" conf file.
     Assumes search() request was submitted with responseFormat = 'sceneList'.
+    dataset_name defaults to the datasetName of the input file, or DEFAULT_DATASET.
     """
+    import yaml
     with open(in_file, 'r') as f:
         sr = yaml.safe_load(f)
     output = {}
-    output['datasetName'] = dataset_name
+    output['datasetName'] = dataset_name or sr.get('datasetName') or DEFAULT_DATASET
     output['entityIds'] = sr['results']
     with open(out_file, 'w') as f:
         yaml.dump(output, f, default_flow_style=False)
 
-def search_to_dl(in_file, out_file, dataset_name='LANDSAT_8_C1', prod_types=['FR_BUND', 'STANDARD']):
+def search_to_dl(in_file, out_file, dataset_name=None, prod_types=['FR_BUND', 'STANDARD'], apiKey=None,
+        check_available=False, mask=None):
     """
     Read a response from search query, extract entityIds and write out to a "download" conf file.
     Assumes search() request was submitted with responseFormat = 'sceneList'.
+    dataset_name defaults to the datasetName of the input file, or DEFAULT_DATASET.
+    If mask is given (list of path/row ranges, see acq_mask.py), scenes outside it are dropped.
+    Path and row are taken from the entityId, without a metadata request.
+    If check_available is set, downloadoptions is queried first: scenes with none of the
+    prod_types available are dropped, and products no scene offers are removed from the list.
     """
+    import yaml
     with open(in_file, 'r') as f:
         sr = yaml.safe_load(f)
+    dataset_name = dataset_name or sr.get('datasetName') or DEFAULT_DATASET
+    entity_ids = sr['results']
+    if mask is not None:
+        entity_ids = displayid.filter_mask(entity_ids, mask)
+        logger.info('%s of %s scenes are within the acquisition mask.', len(entity_ids), len(sr['results']))
+    if check_available:
+        with profiling.span('resolve'):
+            options = get_download_options(apiKey, dataset_name, entity_ids)
+        available = {e: [p for p in prod_types if p in options.get(e, {})] for e in entity_ids}
+        entity_ids = [e for e in entity_ids if available[e]]
+        prod_types = [p for p in prod_types if any(p in a for a in available.values())]
+        logger.info('%s scenes have requested products available.', len(entity_ids))
     output = {}
     output['datasetName'] = dataset_name
     output['products'] = prod_types
-    output['entityIds'] = sr['results']
-    with open(out_file, 'w') as f:
+    output['entityIds'] = entity_ids
+    with profiling.span('save'), open(out_file, 'w') as f:
         yaml.dump(output, f, default_flow_style=False)
 
-def update_search_params(in_file, startDate=None, endDate=None):
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def get_download_options(apiKey, dataset_name, entity_ids):
+    """
+    Query downloadoptions for entity_ids in batches of RESOLVE_BATCH_SIZE.
+    Returns a dictionary {entityId: {productCode: download option}} holding only the available options.
+    """
+    options = {}
+    for batch in _batches(list(entity_ids), RESOLVE_BATCH_SIZE):
+        response = api.downloadoptions(apiKey, {'datasetName': dataset_name, 'entityIds': batch})
+        for scene in response['data'] or []:
+            options[scene['entityId']] = {o['productCode']: o for o in scene['downloadOptions'] if o['available']}
+    return options
+
+def resolve_downloads(apiKey, dataset_name, entity_ids, prod_types, options=None, run=None):
+    """
+    Get download URLs for the prod_types of entity_ids, requesting only products the server can deliver.
+    Availability is checked with downloadoptions first, unless options (the result of
+    get_download_options) is given. Scenes are grouped by their set of available
+    products and each group is resolved with batched download requests.
+    Returns a list of download records (entityId, product, url, filesize, datasetName) in the format
+    read by download_files().
+    With a download ledger attached (see dlqueue.py), URLs still valid from earlier requests are
+    reused and new requests are labelled and recorded.
+    With a run journal attached (see journal.py), the scenes resolved are recorded under run,
+    and scenes already resolved in run keep their records instead of being resolved again.
+    """
+    with profiling.span('resolve'):
+        return _resolve_downloads(apiKey, dataset_name, entity_ids, prod_types, options, run)
+
+def _resolve_downloads(apiKey, dataset_name, entity_ids, prod_types, options=None, run=None):
+    total = len(entity_ids)
+    records = []
+    jrnl = journal.get_journal() if run else None
+    if jrnl is not None:
+        done = jrnl.resolved(run, entity_ids)
+        if done:
+            logger.info('%s scenes were resolved before in run %s.', len(done), run)
+            records.extend(r for e in entity_ids for r in done.get(e, []))
+            entity_ids = [e for e in entity_ids if e not in done]
+    if options is None:
+        options = get_download_options(apiKey, dataset_name, entity_ids)
+    ledger = dlqueue.get_ledger()
+    reused = ledger.valid(dataset_name, entity_ids, prod_types) if ledger is not None else {}
+    groups = {}
+    dropped = 0
+    for entity_id in entity_ids:
+        products = tuple(p for p in prod_types if p in options.get(entity_id, {}))
+        dropped += len(prod_types) - len(products)
+        records.extend(reused[(entity_id, p)] for p in products if (entity_id, p) in reused)
+        products = tuple(p for p in products if (entity_id, p) not in reused)
+        if products:
+            groups.setdefault(products, []).append(entity_id)
+    if dropped:
+        logger.info('Skipping %s unavailable products.', dropped)
+    if reused:
+        logger.info('Reusing %s download URLs of earlier requests.', len(reused))
+    if jrnl is not None:
+        grouped = set(e for group in groups.values() for e in group)
+        jrnl.add_resolved(run, [e for e in entity_ids if e not in grouped],
+                          [r for r in reused.values() if r['entityId'] not in grouped])
+
+    label = dlqueue.new_label() if ledger is not None and groups else None
+    for products, group in groups.items():
+        for batch in _batches(group, RESOLVE_BATCH_SIZE):
+            payload = {'datasetName': dataset_name, 'entityIds': batch, 'products': list(products)}
+            if label:
+                payload['label'] = label
+            response = api.download(apiKey, payload)
+            new = []
+            for record in response['data'] or []:
+                option = options.get(record.get('entityId'), {}).get(record.get('product'), {})
+                record.setdefault('filesize', option.get('filesize'))
+                record.setdefault('datasetName', dataset_name)
+                if label:
+                    record.setdefault('label', label)
+                new.append(record)
+            if label:
+                ledger.record(label, dataset_name, new)
+            if jrnl is not None:
+                ids = set(batch)
+                jrnl.add_resolved(run, batch, new + [r for r in reused.values() if r['entityId'] in ids])
+            records.extend(new)
+    logger.info('Resolved %s download URLs for %s scenes.', len(records), total)
+    return records
+
+def product_file_name(scene_id, product):
+    """
+    Local file name for a product of a scene, based on PRODUCT_EXTENSIONS.
+    Unknown products get the product code appended instead of an extension.
+    """
+    if product in PRODUCT_EXTENSIONS:
+        return '{}{}'.format(scene_id, PRODUCT_EXTENSIONS[product])
+    return '{}_{}'.format(scene_id, product)
+
+def _content_disposition_name(headers):
+    """
+    Return the file name from a Content-Disposition header, or None.
+    """
+    match = re.search(CONTENT_DISPOSITION_RE, headers.get('Content-Disposition', ''))
+    if match:
+        return os.path.basename(unquote(match.group(1).strip())) or None
+    return None
+
+def order_by_size(items):
+    """
+    Sort download items largest first (longest processing time first), so that large files
+    start early and the workers finish at about the same time. Items without a known filesize
+    are treated as average-sized.
+    """
+    known = [int(i['filesize']) for i in items if i.get('filesize')]
+    average = sum(known) / len(known) if known else 0
+    return sorted(items, key=lambda i: int(i['filesize']) if i.get('filesize') else average, reverse=True)
+
+def predict_duration(items, num_workers, rate=None):
+    """
+    Predict the wall time in seconds to download the size-ordered items with num_workers parallel
+    streams of rate bytes/s each (STREAM_RATE by default), by simulating the queue.
+    Returns None if no file sizes are known.
+    """
+    rate = rate or STREAM_RATE
+    if num_workers < 1 or not any(i.get('filesize') for i in items):
+        return None
+    known = [int(i['filesize']) for i in items if i.get('filesize')]
+    average = sum(known) / len(known)
+    finish = [0.0] * num_workers
+    for item in items:
+        size = int(item['filesize']) if item.get('filesize') else average
+        heapq.heapreplace(finish, finish[0] + size / rate)
+    return max(finish)
+
+def check_disk_space(out_dir, items):
+    """
+    Raise DiskSpaceError if the items with known filesize do not fit in out_dir,
+    keeping FREE_SPACE_MARGIN bytes free. Downloads the run journal (see journal.py)
+    records as finished need no space, partial ones only their remaining bytes.
+    """
+    jrnl = journal.get_journal()
+    needed = 0
+    for item in items:
+        if not item.get('filesize'):
+            continue
+        size = int(item['filesize'])
+        entry = jrnl.file(os.path.join(out_dir, item['file name'])) if jrnl is not None else None
+        if entry and os.path.exists(entry['path']):
+            size = 0 if entry['status'] == 'done' else max(0, size - entry['bytes'])
+        needed += size
+    if not needed:
+        return
+    free = shutil.disk_usage(out_dir).free
+    logger.debug('%s bytes to download, %s bytes free in %s', needed, free, out_dir)
+    if needed + FREE_SPACE_MARGIN > free:
+        raise DiskSpaceError('Not enough space in {}: {} bytes needed plus a {} byte margin, {} bytes free.'.format(
+            out_dir, needed, FREE_SPACE_MARGIN, free))
+
+def update_search_params(in_file, startDate=None, endDate=None, run=None):
     """
     Update the systematic search parameter file to use the most recent date, or the date 
     specified by startDate and endDate.
+    With a run journal attached (see journal.py), the dates are recorded under run, and an
+    unfinished run keeps its dates, so a restarted run searches the same window.
+    Returns the dates: {'startDate', 'endDate'}.
     """
+    import yaml
     today = datetime.now().date()
     td = timedelta(days=1)
     yesterday = today - td
+    dates = {'startDate': str(startDate or yesterday), 'endDate': str(endDate or today)}
+    jrnl = journal.get_journal() if run else None
+    if jrnl is not None:
+        dates = jrnl.begin(run, dates) or dates
+        jrnl.stage(run, 'search')
     with open(in_file, 'r') as f:
         data = yaml.safe_load(f)
     
-    data['metadataUpdateFilter']['startDate'] = str(yesterday)
-    data['metadataUpdateFilter']['endDate'] = str(today)
+    data['metadataUpdateFilter']['startDate'] = dates['startDate']
+    data['metadataUpdateFilter']['endDate'] = dates['endDate']
     
     with open(in_file, 'w') as f:
         yaml.dump(data, f, default_flow_style=False)
+    return dates
+
+def extract_archive(path, dest_dir):
+    """
+    Test and unpack a downloaded .tar.gz/.tar/.zip archive into dest_dir/<archive name>.
+    Runs in a worker process of PostProcessor. Reading every member checks the archive
+    (gzip and zip CRCs) as a side effect of unpacking it.
+    Returns a dictionary with the archive path, target directory, size, file count and duration.
+    Raises on corrupt archives.
+    """
+    import tarfile
+    import zipfile
+    start = time.monotonic()
+    name = os.path.basename(path)
+    ext = next(e for e in ARCHIVE_EXTENSIONS if name.endswith(e))
+    target = os.path.join(dest_dir, name[:-len(ext)])
+    os.makedirs(target, exist_ok=True)
+    if ext == '.zip':
+        with zipfile.ZipFile(path) as zf:
+            # extractall() checks the CRC of every member it unpacks.
+            try:
+                zf.extractall(target)
+            except zipfile.BadZipFile as exc:
+                raise zipfile.BadZipFile('Corrupt archive {}: {}'.format(path, exc))
+            count = len(zf.infolist())
+    else:
+        with tarfile.open(path, 'r:*') as tf:
+            if hasattr(tarfile, 'data_filter'):
+                tf.extractall(target, filter='data')
+            else:
+                tf.extractall(target)
+            count = len(tf.getmembers())
+            # Read up to the end of the compressed stream so the gzip CRC gets checked.
+            while tf.fileobj.read(CHUNK_SIZE):
+                pass
+    return {'archive': path, 'target': target, 'bytes': os.path.getsize(path), 'files': count,
+            'seconds': time.monotonic() - start}
+
+class PostProcessor(object):
+    """
+    Post-download stage: tests and unpacks archives in a process pool while downloads continue.
+    Non-archive files are ignored. Call close() to wait for the pool and log throughput and errors.
 
-def download_files(in_file, out_dir, prod_types=None):
+    :param dest_dir:
+        String. Directory the archives are unpacked into.
+    :param workers:
+        Integer. Number of worker processes. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, dest_dir, workers=None):
+        from concurrent.futures import ProcessPoolExecutor
+        self.dest_dir = dest_dir
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.results = []
+        self.errors = []
+        self._futures = []
+        self._start = time.monotonic()
+
+    def submit(self, path):
+        if not any(path.endswith(e) for e in ARCHIVE_EXTENSIONS):
+            return None
+        logger.debug('Queueing %s for extraction', path)
+        future = self.pool.submit(extract_archive, path, self.dest_dir)
+        future.add_done_callback(lambda f, path=path: self._done(path, f))
+        self._futures.append(future)
+        return future
+
+    def _done(self, path, future):
+        exc = future.exception()
+        if exc is not None:
+            logger.error('Extraction failed for %s: %s', path, exc)
+            self.errors.append({'archive': path, 'error': '{}: {}'.format(type(exc).__name__, exc)})
+        else:
+            logger.debug('Extracted %s to %s', path, future.result()['target'])
+            self.results.append(future.result())
+
+    def close(self):
+        """
+        Wait for all extractions and return a summary dictionary.
+        """
+        self.pool.shutdown(wait=True)
+        seconds = time.monotonic() - self._start
+        total = sum(r['bytes'] for r in self.results)
+        summary = {
+            'archives': len(self.results),
+            'errors': len(self.errors),
+            'bytes': total,
+            'seconds': round(seconds, 3),
+            'MB/s': round(total / seconds / 1e6, 2) if seconds else None,
+        }
+        logger.info('Extracted %(archives)s archives (%(bytes)s bytes) in %(seconds)s s, %(MB/s)s MB/s, %(errors)s errors',
+                    summary)
+        for error in self.errors:
+            logger.error('Extraction error: %(archive)s: %(error)s', error)
+        return summary
+
+def download_files(in_file, out_dir, prod_types=None, lanes=None, extract_dir=None, extract_workers=None, apiKey=None):
     """
     Read a YAML file with download URLs and download all that match prod_type filter.
     If prod_types is not provided, download all.
+    Entries with a known filesize are checked against the free space in out_dir and
+    downloaded largest first. Downloads are split into priority lanes by collection tier,
+    dataset or acquisition age - see scheduler.py; scheduler.DEFAULT_LANES if lanes is not given.
+    If extract_dir is given, downloaded archives are tested and unpacked there by a pool of
+    extract_workers processes, overlapped with the remaining downloads.
+    URLs rejected as expired (EXPIRED_CODES) are re-resolved with apiKey and retried.
+    Returns a list with the status of each download.
     """
-    q = Queue(maxsize=0)
-    urls = []
+    import yaml
     with open(in_file, 'r') as f:
-        logger.debug('Reading {}'.format(in_file))
+        logger.debug('Reading %s', in_file)
         data = yaml.safe_load(f)
+    return download_records(data, out_dir, prod_types, lanes, extract_dir, extract_workers, apiKey)
+
+def download_records(data, out_dir, prod_types=None, lanes=None, extract_dir=None, extract_workers=None, apiKey=None):
+    """
+    Download a list of download URL records (entityId, product, url, ...), e.g. from
+    resolve_downloads(). See download_files() for the other arguments.
+    """
+    with profiling.span('download'):
+        return _download_files(data, out_dir, prod_types, lanes, extract_dir, extract_workers, apiKey)
+
+def _download_files(data, out_dir, prod_types, lanes, extract_dir, extract_workers, apiKey=None):
+    urls = []
+    display_id_re = re.compile(DISPLAYID_RE)
+    store = idstore.get_store()
+    deleted = set()
+    if store is not None:
+        for dataset in set(entity.get('datasetName') for entity in data):
+            deleted.update(store.deleted(dataset, [entity.get('entityId') for entity in data]))
     for entity in data:
+        if prod_types and entity['product'] not in prod_types:
+            continue
+        if entity.get('entityId') in deleted:
+            logger.info('Skipping %s, the scene has been deleted.', entity['entityId'])
+            continue
         url = entity['url']
-        display_id = re.compile(DISPLAYID_RE).search(url).group()
-        if entity['product'] == 'FR_BUND':
-            file_name = '{}.zip'.format(display_id)
-        elif entity['product'] == 'STANDARD':
-            file_name = '{}.tar.gz'.format(display_id)
-        # Check extensions for FR_REFL, FR_THERM, FR_QB and add cases.
-        logger.debug('Adding entry to the download list. URL: {}, file name: {}'.format(url, file_name))
-        urls.append({'url': url, 'file name': file_name})
+        match = display_id_re.search(url)
+        display_id = match.group() if match else None
+        parsed = displayid.parse(display_id)
+        file_name = product_file_name(display_id or entity.get('entityId'), entity['product'])
+        logger.debug('Adding entry to the download list. URL: %s, file name: %s', url, file_name)
+        urls.append({'url': url, 'file name': file_name, 'checksum': entity.get('checksum'),
+                     'filesize': entity.get('filesize'), 'attempts': 0,
+                     'entityId': entity.get('entityId'), 'product': entity['product'], 'label': entity.get('label'),
+                     'tier': parsed.tier if parsed else None, 'dataset': entity.get('datasetName'),
+                     'acquired': parsed.acquired if parsed else None})
 
+    check_disk_space(out_dir, urls)
+    urls = order_by_size(urls)
     num_threads = min(MAX_DOWNLOADS, len(urls))
-    logger.debug('Number of parallel downloads set to {}'.format(num_threads))
+    dl_limiter = limiter.get_limiter('download')
+    dl_limiter.maximum = MAX_DOWNLOADS
+    logger.debug('Number of download threads set to %s, current limit %s', num_threads, dl_limiter.stats()['limit'])
+    predicted = predict_duration(urls, num_threads)
+    if predicted is not None:
+        logger.info('Predicted download time for %s files: %.0f s', len(urls), predicted)
+    q = scheduler.LaneQueue(lanes, max(num_threads, 1))
     results = [{} for x in urls]
     for i in range(len(urls)):
-        logger.debug('Populating download queue with {}'.format(urls[i]))
+        logger.debug('Populating download queue with %s', urls[i])
         q.put((i, urls[i]))
+    _active_queues.add(q)
     
+    post = PostProcessor(extract_dir, extract_workers) if extract_dir else None
+    refresher = URLRefresher(apiKey, q)
+    start = time.monotonic()
     for i in range(num_threads):
-        logger.debug('Starting thread {}'.format(i))
-        worker = Thread(target=download_product, args=(q, results, out_dir))
+        logger.debug('Starting thread %s', i)
+        worker = Thread(target=download_product, args=(q, results, out_dir, post, dl_limiter, refresher))
         worker.setDaemon(True)
         worker.start()
     
     q.join()
+    _active_queues.discard(q)
+    if post:
+        post.close()
+    for i in range(len(urls)):
+        if not results[i]:
+            results[i] = {'Status': 'Cancelled', 'URL': urls[i]['url'], 'File Name': urls[i]['file name']}
+    ledger = dlqueue.get_ledger()
+    if ledger is not None:
+        ledger.update(results)
     logger.debug(results)
-    logger.info('All downloads processed')
+    for name, lane in q.stats().items():
+        logger.info('Lane %s: %s downloads processed with %s worker slots', name, lane['done'], lane['slots'])
+    logger.info('Download concurrency limit is now %(limit)s (%(errors)s errors in %(requests)s requests)',
+                dl_limiter.stats())
+    logger.info('All downloads processed in %.0f s', time.monotonic() - start)
+    return results
+
+def cancel_downloads(entity_ids, dataset=None):
+    """
+    Remove queued downloads of entity_ids (optionally only those of dataset) from all
+    download_files() calls in progress. Downloads already started are not interrupted.
+    Returns the number of cancelled downloads.
+    """
+    entity_ids = set(entity_ids)
+
+    def match(item):
+        return item.get('entityId') in entity_ids and (dataset is None or item.get('dataset') == dataset)
+
+    cancelled = 0
+    for q in list(_active_queues):
+        for work in q.cancel(match):
+            logger.info('Cancelled download of %s', work[1]['url'])
+            cancelled += 1
+    return cancelled
+
+def drop_deleted(in_file, entity_ids, out_file=None):
+    """
+    Remove entity_ids from a pending download list: a "download" conf file (see params/download.yaml)
+    or a list of download URL records (the input of download_files). Written back to in_file
+    unless out_file is given. Returns the number of entries removed.
+    """
+    import yaml
+    entity_ids = set(entity_ids)
+    with open(in_file, 'r') as f:
+        data = yaml.safe_load(f)
+    if isinstance(data, dict):
+        before = len(data.get('entityIds') or [])
+        data['entityIds'] = [e for e in data.get('entityIds') or [] if e not in entity_ids]
+        removed = before - len(data['entityIds'])
+    else:
+        before = len(data or [])
+        data = [r for r in data or [] if r.get('entityId') not in entity_ids]
+        removed = before - len(data)
+    if removed or out_file:
+        with open(out_file or in_file, 'w') as f:
+            yaml.dump(data, f, default_flow_style=False)
+    return removed
 
-def download_product(q, result, out_dir=None):
+def download_product(q, result, out_dir=None, post=None, dl_limiter=None, refresher=None):
     """
     Threaded function for downloading products
+    Downloaded files are handed to the post-download stage post (a PostProcessor), if given.
+    Each download takes a slot of dl_limiter (an AdaptiveLimiter) if given, so fewer
+    downloads than threads may run at a time.
+    Expired URLs get a new URL from refresher (a URLRefresher), if given, and are re-queued.
+    Scenes the attached ID store (see idstore.py) has since marked deleted, e.g. by sync-deletions
+    running in another process, are skipped and reported as cancelled.
     """
-    while not q.empty():
-        work = q.get()
+    store = idstore.get_store()
+    while True:
+        slot = dl_limiter.acquire() if dl_limiter else {}
         try:
-            logger.info('Trying to download from {} to {}\\{}'.format(work[1]['url'], out_dir, work[1]['file name']))
-            download(work[1]['url'], out_dir, work[1]['file name'])
-            result[work[0]] = {'Status': 'Downloaded', 'URL': work[1]['url'], 'File Name': work[1]['file name']}
+            work = q.get(block=False)
+        except Empty:
+            if dl_limiter:
+                slot['sample'] = False
+                dl_limiter.release(slot)
+            # Items being refreshed are out of the queue for a while - wait for them to come back.
+            if refresher is not None and refresher.wait_idle():
+                continue
+            break
+        if store is not None and work[1].get('entityId') and store.deleted(work[1].get('dataset'), [work[1]['entityId']]):
+            logger.info('Cancelled download of %s, the scene has been deleted.', work[1]['url'])
+            if dl_limiter:
+                slot['sample'] = False
+                dl_limiter.release(slot)
+            q.task_done()
+            continue
+        try:
+            logger.info('Trying to download from %s to %s\\%s', work[1]['url'], out_dir, work[1]['file name'])
+            work[1]['attempts'] += 1
+            path = download(work[1]['url'], out_dir, work[1]['file name'], work[1].get('checksum'), work[1].get('filesize'),
+                            slot=slot)
+            status = 'Downloaded' if path else 'Failed'
+            file_name = os.path.basename(path) if path else work[1]['file name']
+            result[work[0]] = {'Status': status, 'URL': work[1]['url'], 'File Name': file_name}
+            if path and post:
+                post.submit(path)
+        except ChecksumError:
+            slot['sample'] = False
+            if work[1]['attempts'] < MAX_ATTEMPTS:
+                logger.exception('Integrity check failed, re-queueing %s', work[1]['url'])
+                q.put(work)
+            else:
+                logger.exception('Integrity check failed %s times, giving up on %s', MAX_ATTEMPTS, work[1]['url'])
+                result[work[0]] = {'Status': 'Failed', 'URL': work[1]['url'], 'File Name': work[1]['file name']}
+        except ExpiredURLError:
+            slot['sample'] = False
+            url = None
+            if refresher and work[1].get('entityId') and work[1].get('refreshes', 0) < MAX_REFRESHES:
+                url = refresher.refresh(work[1])
+            if url:
+                logger.info('Download URL of %s expired, retrying with a new URL', work[1]['file name'])
+                work[1]['refreshes'] = work[1].get('refreshes', 0) + 1
+                work[1]['url'] = url
+                q.put(work)
+            else:
+                logger.error('Download URL expired and could not be refreshed: %s', work[1]['url'])
+                result[work[0]] = {'Status': 'Failed', 'URL': work[1]['url'], 'File Name': work[1]['file name']}
         except:
-            logger.exception('Download failed! {}'.format(work[1]['url']))
+            logger.exception('Download failed! %s', work[1]['url'])
             result[work[0]] = {'Status': 'Failed', 'URL': work[1]['url'], 'File Name': work[1]['file name']}
+            slot['error'] = True
+        if dl_limiter:
+            dl_limiter.release(slot)
         q.task_done()
     return True
 
-def download(url, out_dir, local_file):
+def _get_buffer():
+    """
+    Return this thread's reusable download buffer as a memoryview.
+    """
+    if getattr(_buffers, 'view', None) is None or len(_buffers.view) != CHUNK_SIZE:
+        _buffers.view = memoryview(bytearray(CHUNK_SIZE))
+    return _buffers.view
+
+def _stream_to_file(r, f, hasher, filesize=None, start=0, progress=None):
+    """
+    Copy the body of the streamed response r to the open file f from offset start (where f
+    is positioned), updating hasher on the way.
+    Data is read with urllib3's readinto() into a preallocated per-thread buffer; encoded
+    bodies (gzip, deflate) are decoded on the way. A connection closed or reset early ends the
+    copy like the end of the body. If progress is given, the file is synced every
+    journal.SYNC_INTERVAL bytes and progress(offset) is called with the durable file length.
+    Returns the number of bytes written.
+    """
+    from urllib3.exceptions import ProtocolError
+
+    view = _get_buffer()
+    r.raw.decode_content = True
+    # Return short reads instead of raising, so bytes received before a cut are kept.
+    r.raw.enforce_content_length = False
+    readinto = r.raw.readinto
+
+    fd = f.fileno()
+    if filesize and PREALLOCATE and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, int(filesize))
+        except OSError:
+            logger.debug('Preallocation not supported for %s', f.name)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    size = 0
+    synced = 0
+    reported = 0
+    while True:
+        try:
+            n = readinto(view)
+        except ProtocolError:
+            # Connection reset mid-body; the caller's size check reports it.
+            logger.debug('Connection closed after %s bytes of %s', start + size, f.name)
+            break
+        if not n:
+            break
+        chunk = view[:n]
+        hasher.update(chunk)
+        f.write(chunk)
+        size += n
+        if DROP_PAGE_CACHE and size - synced >= DROP_CACHE_INTERVAL and hasattr(os, 'posix_fadvise'):
+            f.flush()
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, start + synced, size - synced, os.POSIX_FADV_DONTNEED)
+            synced = size
+        if progress and size - reported >= journal.SYNC_INTERVAL:
+            f.flush()
+            os.fdatasync(fd)
+            progress(start + size)
+            reported = size
+    f.flush()
+    if filesize and PREALLOCATE:
+        # Short downloads must not leave preallocated zeros at the end of the file.
+        f.truncate(start + size)
+    if DROP_PAGE_CACHE and hasattr(os, 'posix_fadvise'):
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, start + synced, 0, os.POSIX_FADV_DONTNEED)
+    return size
+
+def _restart_download(jrnl, key, entry, url, out_dir, local_file, checksum, filesize, slot):
+    logger.info('Cannot resume %s, downloading it again', entry['path'])
+    jrnl.drop_file(key)
+    os.remove(entry['path'])
+    return download(url, out_dir, local_file, checksum, filesize, slot)
+
+def _content_range_total(headers, offset):
+    """
+    Return the full length from the Content-Range header of a partial response starting at
+    offset, or None if the range does not start there or the length is unknown.
+    """
+    match = re.match(r'bytes (\d+)-\d+/(\d+)', headers.get('Content-Range', ''))
+    if not match or int(match.group(1)) != offset:
+        return None
+    return int(match.group(2))
+
+def _hash_prefix(f, hasher, length):
+    """
+    Update hasher with the first length bytes of the open file f, leaving f positioned at length.
+    """
+    view = _get_buffer()
+    f.seek(0)
+    remaining = length
+    while remaining:
+        n = f.readinto(view[:min(len(view), remaining)])
+        if not n:
+            raise IOError('{} is shorter than {} bytes'.format(f.name, length))
+        hasher.update(view[:n])
+        remaining -= n
+
+def _expected_checksum(headers):
+    """
+    Return (algorithm, hex digest) of a checksum supplied in the response headers, or (None, None).
+    Understands Digest (RFC 3230), Content-MD5 and X-Checksum-* headers.
+    """
+    digest = headers.get('Digest')
+    if digest:
+        for part in digest.split(','):
+            algo, _, value = part.strip().partition('=')
+            algo = {'md5': 'md5', 'sha-256': 'sha256', 'sha-512': 'sha512'}.get(algo.lower())
+            if algo and value:
+                return algo, base64.b64decode(value).hex()
+    if headers.get('Content-MD5'):
+        return 'md5', base64.b64decode(headers['Content-MD5']).hex()
+    for algo in ['sha256', 'md5']:
+        value = headers.get('X-Checksum-{}'.format(algo.capitalize()))
+        if value:
+            return algo, value.lower()
+    return None, None
+
+def download(url, out_dir, local_file, checksum=None, filesize=None, slot=None):
     """
     Download data from URL to local file as stream.
+    A file name sent by the server in Content-Disposition replaces local_file.
+    The file is hashed while it is written, so the integrity check needs no second read.
+    The result is compared with checksum ('algorithm:hexdigest' or a bare hex digest of
+    CHECKSUM_ALGORITHM), or with a checksum supplied in the response headers, and the size
+    with the length the response announces (Content-Length, or the full length in Content-Range),
+    or with filesize if it announces none. ChecksumError is raised and the temp file removed on mismatch.
+    ExpiredURLError is raised if the server rejects the URL with one of EXPIRED_CODES.
+    The outcome is recorded in slot (see limiter.AdaptiveLimiter.acquire), if given.
+    With a run journal attached (see journal.py), the durable length of the temp file is
+    recorded while it is written: a download interrupted earlier continues with a Range
+    request (the header checksum of a partial response is not used), and one finished
+    earlier is not repeated. A transfer cut short then raises IncompleteDownloadError and
+    keeps the temp file for the next attempt.
     [TODO] Currently uses a hacked-in temporary file name. Improve later by making it configurable.
     """
-    tmp_local_file = '{}{}{}'.format(TMP_PREFIX, local_file, TMP_SUFFIX)
-    tmp_local_fullpath = os.path.join(os.sep, out_dir + os.sep, tmp_local_file)
-    final_local_fullpath = os.path.join(os.sep, out_dir + os.sep, local_file)
+    from requests.exceptions import HTTPError, ConnectionError, Timeout
+
+    slot = {} if slot is None else slot
+    jrnl = journal.get_journal()
+    key = os.path.join(out_dir, local_file)
+    entry = jrnl.file(key) if jrnl is not None else None
+    if entry and entry['status'] == 'done':
+        if os.path.exists(entry['path']) and os.path.getsize(entry['path']) == entry['bytes']:
+            logger.info('Already downloaded: %s', entry['path'])
+            return entry['path']
+        entry = None
+    offset = 0
+    if entry and entry['bytes'] and os.path.exists(entry['path']) and os.path.getsize(entry['path']) >= entry['bytes']:
+        offset = entry['bytes']
     try:
-        r = requests.get(url, stream=True)
+        r = api.get_session().get(url, stream=True, headers={'Range': 'bytes={}-'.format(offset)} if offset else None)
         r.raise_for_status()
     except HTTPError:
-        logger.exception('Server responded with an HTTP error for {}!'.format(url))
+        if r.status_code == 416 and offset:
+            r.close()
+            return _restart_download(jrnl, key, entry, url, out_dir, local_file, checksum, filesize, slot)
+        if r.status_code in EXPIRED_CODES:
+            r.close()
+            raise ExpiredURLError('HTTP {} for {}'.format(r.status_code, url))
+        slot['error'] = r.status_code in limiter.CONGESTION_CODES
+        slot['sample'] = slot['error']
+        logger.exception('Server responded with an HTTP error for %s!', url)
     except ConnectionError:
-        logger.exception('Error while trying to open {}!'.format(url))
+        slot['error'] = True
+        logger.exception('Error while trying to open %s!', url)
     else:
+        local_file = _content_disposition_name(r.headers) or local_file
+        tmp_local_file = '{}{}{}'.format(TMP_PREFIX, local_file, TMP_SUFFIX)
+        tmp_local_fullpath = os.path.join(os.sep, out_dir + os.sep, tmp_local_file)
+        final_local_fullpath = os.path.join(os.sep, out_dir + os.sep, local_file)
+        total = _content_range_total(r.headers, offset) if offset and r.status_code == 206 else None
+        if r.status_code == 206 and total is None:
+            r.close()
+            return _restart_download(jrnl, key, entry, url, out_dir, local_file, checksum, filesize, slot)
+        if total is None:
+            offset = 0
+        else:
+            tmp_local_fullpath = entry['path']
+            logger.info('Resuming download of %s at byte %s', tmp_local_fullpath, offset)
+        if checksum:
+            algo, _, expected = checksum.rpartition(':')
+            algo, expected = algo or CHECKSUM_ALGORITHM, expected.lower()
+        elif offset:
+            algo, expected = CHECKSUM_ALGORITHM, None
+        else:
+            algo, expected = _expected_checksum(r.headers)
+            algo = algo or CHECKSUM_ALGORITHM
+        # The metadata filesize may differ from what the server delivers; trust the response.
+        if total:
+            length = total
+        elif 'Content-Encoding' not in r.headers and 'Content-Length' in r.headers:
+            length = int(r.headers['Content-Length'])
+        else:
+            length = int(filesize) if filesize else None
+        if filesize and length != int(filesize):
+            logger.debug('%s announces %s bytes, metadata says %s', url, length, filesize)
+        filesize = length
+        hasher = hashlib.new(algo)
+        if jrnl is not None and 'Content-Encoding' not in r.headers:
+            progress = lambda nbytes: jrnl.update_file(key, tmp_local_fullpath, url, nbytes, filesize)
+        else:
+            progress = None
         try:
             with r:
-                logger.debug('Opening download stream for {}'.format(url))
-                with open(tmp_local_fullpath, 'wb') as f:
-                    logger.debug('Starting to write to temp file {}'.format(tmp_local_fullpath))
-                    shutil.copyfileobj(r.raw, f)
-            logger.debug('Finished downloading {}'.format(url))
-            logger.debug('Renaming temp file to {}'.format(final_local_fullpath))
+                logger.debug('Opening download stream for %s', url)
+                with open(tmp_local_fullpath, 'r+b' if offset else 'wb') as f:
+                    if offset:
+                        _hash_prefix(f, hasher, offset)
+                        f.truncate(offset)
+                    logger.debug('Starting to write to temp file %s', tmp_local_fullpath)
+                    size = offset + _stream_to_file(r, f, hasher, filesize, offset, progress)
+                    if progress and filesize is not None and size < int(filesize):
+                        os.fdatasync(f.fileno())
+                        progress(size)
+            slot['size'] = size - offset
+            logger.debug('Finished downloading %s, %s bytes, %s %s', url, size, algo, hasher.hexdigest())
+            if progress and filesize is not None and size < int(filesize):
+                raise IncompleteDownloadError('Incomplete download of {}: {} of {} bytes, the rest can be resumed'.format(
+                    url, size, filesize))
+            if filesize is not None and size != int(filesize):
+                os.remove(tmp_local_fullpath)
+                if jrnl is not None:
+                    jrnl.drop_file(key)
+                raise ChecksumError('Size mismatch for {}: expected {} bytes, got {}'.format(url, filesize, size))
+            if expected and hasher.hexdigest() != expected:
+                os.remove(tmp_local_fullpath)
+                if jrnl is not None:
+                    jrnl.drop_file(key)
+                raise ChecksumError('{} mismatch for {}: expected {}, got {}'.format(algo, url, expected, hasher.hexdigest()))
+            logger.debug('Renaming temp file to %s', final_local_fullpath)
             os.rename(tmp_local_fullpath, final_local_fullpath)
+            if jrnl is not None:
+                jrnl.update_file(key, final_local_fullpath, url, size, filesize, 'done')
             return final_local_fullpath
         except Timeout:
-            logger.exception('Request timed out: {}'.format(url))
+            slot['error'] = True
+            logger.exception('Request timed out: %s', url)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Download scheduling for the USGS API Client.
+
+LaneQueue is a drop-in replacement for queue.Queue in rr_proc.download_files. Download items
+are sorted into lanes (e.g. near-real-time scenes and backfill) and each lane is given a
+weighted share of the download workers. Lanes are listed in priority order: a free worker
+takes the next item from the first lane that is below its share, or from the first non-empty
+lane if all lanes with work are at their share, so no worker idles while there is work.
+
+A lane is a dictionary with these keys (all but name optional):
+    name:          String. Lane name used in logs.
+    share:         Float. Fraction of the workers the lane is entitled to.
+    tiers:         List of strings. Collection tiers (RT, T1, T2) taken by the lane.
+    datasets:      List of strings. Dataset names taken by the lane.
+    max_age_days:  Integer. Only scenes acquired at most this many days ago.
+An item goes to the first lane whose criteria all match, or to the last lane if none match.
+"""
+
+import logging
+import math
+import threading
+from queue import Empty
+from collections import deque
+from datetime import date
+
+# Near-real-time scenes first, tier 1/2 backfill takes the remaining workers.
+DEFAULT_LANES = [
+    {'name': 'realtime', 'share': 0.7, 'tiers': ['RT']},
+    {'name': 'backfill', 'share': 0.3},
+]
+
+logger = logging.getLogger(__name__)
+
+
+def load_lanes(conf_file):
+    """
+    Read lane definitions from the 'lanes' list of a YAML file (see params/lanes.yaml).
+    """
+    import yaml
+    with open(conf_file, 'r') as f:
+        return yaml.safe_load(f)['lanes']
+
+
+def lane_matches(lane, item, today=None):
+    """
+    Check if a download item fits the lane criteria. The item is a dictionary with optional
+    'tier', 'dataset' and 'acquired' (datetime.date) keys, see rr_proc.download_files.
+    Tier and acquisition date are parsed from the displayId with displayid.parse().
+    """
+    if lane.get('tiers') and item.get('tier') not in lane['tiers']:
+        return False
+    if lane.get('datasets') and item.get('dataset') not in lane['datasets']:
+        return False
+    if lane.get('max_age_days') is not None:
+        acquired = item.get('acquired')
+        if acquired is None or ((today or date.today()) - acquired).days > lane['max_age_days']:
+            return False
+    return True
+
+
+class LaneQueue(object):
+    """
+    Multi-lane work queue with the get/put/task_done/empty/join interface of queue.Queue.
+
+    :param lanes:
+        List of lane dictionaries, in priority order. DEFAULT_LANES if not given.
+    :param workers:
+        Integer. Number of workers taking items from the queue, used to turn shares into slots.
+    """
+
+    def __init__(self, lanes=None, workers=1):
+        self.lanes = [dict(lane) for lane in (lanes or DEFAULT_LANES)]
+        total = sum(lane.get('share', 1.0) for lane in self.lanes) or 1.0
+        for lane in self.lanes:
+            lane['slots'] = max(1, math.floor(lane.get('share', 1.0) / total * workers + 0.5))
+            lane['items'] = deque()
+            lane['active'] = 0
+            lane['done'] = 0
+        self._today = date.today()
+        self._taken = {}
+        self._unfinished = 0
+        self._cond = threading.Condition()
+
+    def classify(self, item):
+        """
+        Return the lane the item belongs to.
+        """
+        for lane in self.lanes:
+            if lane_matches(lane, item, self._today):
+                return lane
+        return self.lanes[-1]
+
+    def put(self, work):
+        """
+        Add work to the queue. work is an (index, item) tuple, as in rr_proc.download_files.
+        """
+        lane = self.classify(work[1])
+        with self._cond:
+            lane['items'].append(work)
+            self._unfinished += 1
+            self._cond.notify()
+
+    def _pick(self):
+        candidates = [lane for lane in self.lanes if lane['items']]
+        if not candidates:
+            return None
+        for lane in candidates:
+            if lane['active'] < lane['slots']:
+                return lane
+        return candidates[0]
+
+    def get(self, block=True):
+        with self._cond:
+            lane = self._pick()
+            while lane is None:
+                if not block:
+                    raise Empty
+                self._cond.wait()
+                lane = self._pick()
+            lane['active'] += 1
+            self._taken.setdefault(threading.get_ident(), []).append(lane)
+            return lane['items'].popleft()
+
+    def task_done(self):
+        """
+        Mark the last item taken by the calling thread as processed.
+        """
+        with self._cond:
+            lane = self._taken[threading.get_ident()].pop()
+            lane['active'] -= 1
+            lane['done'] += 1
+            self._unfinished -= 1
+            if self._unfinished == 0:
+                self._cond.notify_all()
+
+    def cancel(self, predicate):
+        """
+        Remove the queued (not yet taken) items for which predicate(item) is true.
+        Returns the removed (index, item) tuples.
+        """
+        removed = []
+        with self._cond:
+            for lane in self.lanes:
+                keep = deque()
+                for work in lane['items']:
+                    (removed if predicate(work[1]) else keep).append(work)
+                lane['items'] = keep
+            self._unfinished -= len(removed)
+            if removed and self._unfinished == 0:
+                self._cond.notify_all()
+        return removed
+
+    def empty(self):
+        with self._cond:
+            return not any(lane['items'] for lane in self.lanes)
+
+    def qsize(self):
+        with self._cond:
+            return sum(len(lane['items']) for lane in self.lanes)
+
+    def join(self):
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def stats(self):
+        """
+        Return {lane name: {'slots', 'queued', 'active', 'done'}}.
+        """
+        with self._cond:
+            return {lane['name']: {'slots': lane['slots'], 'queued': len(lane['items']),
+                                   'active': lane['active'], 'done': lane['done']} for lane in self.lanes}
+
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Request coalescing for the USGS API Client.
+
+A SingleFlight group runs at most one call per key at a time. Callers asking for a key that
+is already in flight wait for that call and all receive its result (or its exception), so
+concurrent identical requests reach the server once. Works for threads (do) and asyncio
+tasks (do_async); synchronous functions called from asyncio share the in-flight calls of
+threaded callers.
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Group of coalesced calls, keyed by any hashable value.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._async_calls = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        """
+        Return fn(), sharing the call with concurrent callers of the same key.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.shared += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+        if not leader:
+            logger.debug('Waiting for in-flight call %s', key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, fn):
+        """
+        Await fn(), sharing the call with concurrent callers of the same key.
+        fn is a coroutine function, or a plain function run in the default executor
+        (shared with threaded callers of do()).
+        """
+        import asyncio
+        import inspect
+        if not inspect.iscoroutinefunction(fn):
+            return await asyncio.get_running_loop().run_in_executor(None, self.do, key, fn)
+        loop = asyncio.get_running_loop()
+        calls = self._async_calls.setdefault(loop, {})
+        future = calls.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+        future = calls[key] = loop.create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Mark the exception as retrieved when nobody else waits for it.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del calls[key]
+            if not calls:
+                self._async_calls.pop(loop, None)
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    """
+    Keep the local databases and key file of the client in tmp_path, with nothing attached.
+    """
+    import api
+    import cache
+    import dlqueue
+    import filters
+    import idstore
+    import journal
+    monkeypatch.setattr(api, 'KEY_FILE', str(tmp_path / 'key'))
+    monkeypatch.setattr(api, 'RESPONSE_HOOKS', [])
+    monkeypatch.setattr(filters, 'FIELDS_CACHE_FILE', str(tmp_path / 'fields.json'))
+    for module in (cache, dlqueue, idstore, journal):
+        monkeypatch.setattr(module, 'DEFAULT_DB', str(tmp_path / '{}.sqlite'.format(module.__name__)))
+    monkeypatch.setattr(cache, '_cache', None)
+    monkeypatch.setattr(dlqueue, '_ledger', None)
+    monkeypatch.setattr(idstore, '_store', None)
+    monkeypatch.setattr(journal, '_journal', None)
+    return tmp_path
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """
+    A running benchmarks.mock_server.MockUSGSServer with 20 small scenes, used as the API endpoint.
+    """
+    import api
+    from mock_server import MockUSGSServer
+    srv = MockUSGSServer(scenes=20, file_size=20000).start()
+    monkeypatch.setattr(api, 'USGS_API_ENDPOINT', srv.endpoint)
+    yield srv
+    srv.stop()
@@ -0,0 +1,43 @@
+import json
+import os
+import subprocess
+import sys
+
+import run_benchmarks
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(run_benchmarks.__file__)), 'run_benchmarks.py')
+SMALL = ['--scenes', '200', '--api-calls', '10', '--page-size', '50', '--files', '4', '--file-size', '10000',
+         '--yaml-scenes', '100', '--payloads', '100', '--parse-ids', '200']
+
+
+def _run(tmp_path, *args):
+    env = dict(os.environ, HOME=str(tmp_path))
+    return subprocess.run([sys.executable, SCRIPT] + SMALL + list(args), env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=120)
+
+
+def test_all_cases_run_against_the_stand_in(tmp_path):
+    results_file = tmp_path / 'results.json'
+    proc = _run(tmp_path, '--save', str(results_file))
+    assert proc.returncode == 0, proc.stdout
+    results = json.loads(results_file.read_text())
+    assert set(run_benchmarks.CASES) <= set(results)
+    assert all(results[name]['value'] > 0 for name in run_benchmarks.CASES)
+    assert results['_server_calls']['download'] >= 1
+
+
+def test_baseline_check_fails_on_regressions(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'_server_calls': {}, 'displayid': {'value': 1e12, 'unit': 'IDs/s'}}))
+    proc = _run(tmp_path, 'displayid', '--baseline', str(baseline))
+    assert proc.returncode == 1
+    assert 'REGRESSION displayid' in proc.stdout
+
+
+def test_compare_allows_the_tolerance():
+    baseline = {'a': {'value': 100.0, 'unit': 'x/s'}, 'b': {'value': 100.0, 'unit': 'x/s'},
+                'c': {'value': 100.0, 'unit': 'x/s'}, '_server_calls': {'value': 1}}
+    results = {'a': {'value': 85.0, 'unit': 'x/s'}, 'b': {'value': 75.0, 'unit': 'x/s'}}
+    regressions = run_benchmarks.compare(results, baseline, 0.2)
+    assert len(regressions) == 1
+    assert regressions[0].startswith('b: 75.00')
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import api
+import cache
+
+
+class Fetch(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return {'data': self.calls}
+
+
+def test_responses_are_cached_without_the_api_key(tmp_path):
+    results = cache.ResultCache(str(tmp_path / 'cache.sqlite'))
+    fetch = Fetch()
+    assert results.cached('search', {'apiKey': 'a', 'datasetName': 'DS'}, fetch) == {'data': 1}
+    assert results.cached('search', {'datasetName': 'DS', 'apiKey': 'b'}, fetch) == {'data': 1}
+    assert results.cached('search', {'datasetName': 'OTHER'}, fetch) == {'data': 2}
+    assert results.cached('metadata', {'datasetName': 'DS'}, fetch) == {'data': 3}
+    assert (results.hits, results.misses) == (1, 2)
+
+
+def test_responses_are_shared_through_the_file(tmp_path):
+    fetch = Fetch()
+    cache.ResultCache(str(tmp_path / 'cache.sqlite')).cached('hits', {'datasetName': 'DS'}, fetch)
+    assert cache.ResultCache(str(tmp_path / 'cache.sqlite')).cached('hits', {'datasetName': 'DS'}, fetch) == {'data': 1}
+    assert cache.ResultCache(memory_only=True).cached('hits', {'datasetName': 'DS'}, fetch) == {'data': 2}
+
+
+def test_memory_keeps_the_latest_responses(monkeypatch):
+    monkeypatch.setattr(cache, 'MEMORY_SIZE', 2)
+    results = cache.ResultCache(memory_only=True)
+    fetch = Fetch()
+    for name in ('a', 'b', 'a', 'c', 'a', 'b'):
+        results.cached('search', {'datasetName': name}, fetch)
+    assert fetch.calls == 4
+
+
+def test_expired_responses_are_fetched_again(monkeypatch):
+    monkeypatch.setattr(cache, 'TTL', {'search': 0.05})
+    results = cache.ResultCache(memory_only=True)
+    fetch = Fetch()
+    results.cached('search', {}, fetch)
+    time.sleep(0.1)
+    assert results.cached('search', {}, fetch) == {'data': 2}
+
+
+def test_stale_counts_are_served_and_refreshed_in_the_background(monkeypatch):
+    monkeypatch.setattr(cache, 'TTL', {'hits': 0.05})
+    results = cache.ResultCache(memory_only=True)
+    fetch = Fetch()
+    results.cached('hits', {}, fetch)
+    time.sleep(0.1)
+    release = threading.Event()
+
+    def slow_fetch():
+        release.wait(5)
+        return fetch()
+
+    assert results.cached('hits', {}, slow_fetch) == {'data': 1}
+    assert results.cached('hits', {}, slow_fetch) == {'data': 1}
+    release.set()
+    cache._wait_refreshes()
+    assert fetch.calls == 2
+    assert results.cached('hits', {}, fetch) == {'data': 2}
+
+
+def test_api_calls_use_the_enabled_cache(server):
+    cache.enable(cache.ResultCache(memory_only=True))
+    for _ in range(3):
+        assert api.hits('key', {'datasetName': 'LANDSAT_8_C1'})['data'] == 20
+    assert server.calls['hits'] == 1
@@ -0,0 +1,75 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+import yaml
+
+import api
+import daemon
+
+
+def _wait(predicate, timeout=10):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end, 'timed out'
+        time.sleep(0.02)
+
+
+def test_submit_rejects_worker_commands(tmp_path):
+    for args in ([], ['serve', str(tmp_path)], ['jobs', str(tmp_path)]):
+        with pytest.raises(ValueError):
+            daemon.submit(str(tmp_path), args)
+
+
+def test_worker_runs_jobs_and_records_results(tmp_path):
+    sessions = []
+
+    def runner(args):
+        if args[0] == 'fail':
+            raise RuntimeError('bad job')
+        sessions.append(api.get_session())
+        return {'args': args}
+
+    ok = daemon.submit(str(tmp_path), ['status'])
+    bad = daemon.submit(str(tmp_path), ['fail'])
+    also_ok = daemon.submit(str(tmp_path), ['status', '--again'])
+    worker = daemon.Worker(str(tmp_path), runner, workers=2, poll=0.02)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    try:
+        _wait(lambda: sum(worker.counts.values()) == 3)
+    finally:
+        worker.stop()
+        thread.join()
+    status = daemon.job_status(str(tmp_path))
+    assert status['done'] == sorted([ok, also_ok])
+    assert status['failed'] == [bad]
+    assert status['incoming'] == status['running'] == []
+    assert status['worker']['done'] == 2 and status['worker']['stopping']
+    assert os.listdir(str(tmp_path / 'running')) == []
+    with open(str(tmp_path / 'failed' / (bad + daemon.JOB_SUFFIX))) as f:
+        assert yaml.safe_load(f)['error'] == 'RuntimeError: bad job'
+    with open(str(tmp_path / 'done' / (ok + daemon.JOB_SUFFIX))) as f:
+        assert yaml.safe_load(f)['result'] == {'args': ['status']}
+    assert sessions[0] is sessions[1]
+
+
+def _running_job(spool, pid):
+    job_id = daemon.submit(str(spool), ['status'])
+    os.replace(str(spool / 'incoming' / (job_id + daemon.JOB_SUFFIX)),
+               str(spool / 'running' / (job_id + daemon.JOB_SUFFIX)))
+    owner = '{}.{}.{}{}'.format(job_id, socket.gethostname(), pid, daemon.OWNER_SUFFIX)
+    open(str(spool / 'running' / owner), 'w').close()
+    return job_id, owner
+
+
+def test_jobs_of_gone_workers_are_requeued(tmp_path):
+    orphan, orphan_owner = _running_job(tmp_path, 2 ** 22 + 1)
+    owned, owned_owner = _running_job(tmp_path, os.getpid())
+    daemon.Worker(str(tmp_path), lambda args: None)._recover()
+    status = daemon.job_status(str(tmp_path))
+    assert status['incoming'] == [orphan]
+    assert status['running'] == [owned]
+    assert sorted(os.listdir(str(tmp_path / 'running'))) == sorted([owned + daemon.JOB_SUFFIX, owned_owner])
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import yaml
+
+import deletions
+import idstore
+import mock_server
+import rr_proc
+
+PRODUCT = mock_server.PRODUCTS[0]
+
+
+def _ids(server):
+    return [s['entityId'] for s in server.scenes]
+
+
+def test_deleted_scenes_are_paged(server):
+    ids = _ids(server)
+    server.delete(ids[:5], '2020-01-02')
+    server.delete(ids[5:6], '2020-01-05')
+    scenes = list(deletions.deleted_scenes('key', 'LANDSAT_8_C1', page_size=2))
+    assert [s['entityId'] for s in scenes] == ids[:6]
+    assert server.calls['deletionsearch'] == 3
+    assert [s['entityId'] for s in deletions.deleted_scenes('key', 'LANDSAT_8_C1', '2020-01-03')] == ids[5:6]
+
+
+def test_deletions_are_synchronised_from_the_watermark(server, tmp_path):
+    ids = _ids(server)
+    server.delete(ids[:3], '2020-01-02')
+    server.delete(ids[3:5], '2020-01-05')
+    store = idstore.IdStore(str(tmp_path / 'ids.sqlite'))
+    pending = tmp_path / 'pending.yaml'
+    pending.write_text(yaml.dump({'datasetName': 'LANDSAT_8_C1', 'entityIds': ids[:10]}))
+    archive = tmp_path / 'archive'
+    archive.mkdir()
+    for i in (0, 9):
+        (archive / rr_proc.product_file_name(server.scenes[i]['displayId'], PRODUCT)).write_bytes(b'x')
+
+    summary = deletions.sync_deletions('key', 'LANDSAT_8_C1', store=store, pending=[str(pending)], purge=True,
+                                       archive_dir=str(archive))
+    assert (summary['deleted'], summary['dropped'], summary['purged']) == (5, 5, 1)
+    assert summary['watermark'] == '2020-01-05'
+    assert store.deleted('LANDSAT_8_C1') == set(ids[:5])
+    assert yaml.safe_load(pending.read_text())['entityIds'] == ids[5:10]
+    assert [p.name for p in archive.iterdir()] == [rr_proc.product_file_name(server.scenes[9]['displayId'], PRODUCT)]
+
+    server.delete(ids[5:6], '2020-01-07')
+    summary = deletions.sync_deletions('key', 'LANDSAT_8_C1', store=store)
+    assert (summary['since'], summary['deleted'], summary['watermark']) == ('2020-01-05', 3, '2020-01-07')
+
+
+def test_deleted_scenes_are_not_downloaded(server, tmp_path):
+    ids = _ids(server)
+    store = idstore.attach(idstore.IdStore(str(tmp_path / 'ids.sqlite')))
+    records = rr_proc.resolve_downloads('key', 'LANDSAT_8_C1', ids[:4], [PRODUCT])
+    server.delete(ids[:2], '2020-01-02')
+    deletions.sync_deletions('key', 'LANDSAT_8_C1', store=store)
+    results = rr_proc.download_records(records, str(tmp_path))
+    assert len(results) == 2
+    assert set(r['Status'] for r in results) == {'Downloaded'}
+
+
+def test_queued_downloads_of_deleted_scenes_are_cancelled(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(rr_proc, 'MAX_DOWNLOADS', 1)
+    ids = _ids(server)
+    records = rr_proc.resolve_downloads('key', 'LANDSAT_8_C1', ids[:4], [PRODUCT])
+    server.latency = 0.3
+    results = []
+    worker = threading.Thread(target=lambda: results.extend(rr_proc.download_records(records, str(tmp_path))))
+    worker.start()
+    while not server.calls.get('file'):
+        time.sleep(0.01)
+    # The first transfer is held up by the latency, the other downloads are still queued.
+    server.latency = 0
+    server.delete(ids[:4], '2020-01-02')
+    summary = deletions.sync_deletions('key', 'LANDSAT_8_C1')
+    worker.join()
+    assert summary['cancelled'] == 3
+    assert sorted(r['Status'] for r in results) == ['Cancelled'] * 3 + ['Downloaded']
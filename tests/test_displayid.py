@@ -0,0 +1,38 @@
+from datetime import date
+
+import displayid
+
+DISPLAY_ID = 'LC08_L1TP_168039_20190103_20190130_01_T1'
+ENTITY_ID = 'LC81680392019003LGN00'
+
+
+def test_display_ids_are_parsed():
+    record = displayid.parse(DISPLAY_ID)
+    assert record == displayid.DisplayId(DISPLAY_ID, 'C', 8, 'L1TP', 168, 39, date(2019, 1, 3), date(2019, 1, 30), 1,
+                                         'T1')
+
+
+def test_entity_ids_are_parsed():
+    record = displayid.parse_entity_id(ENTITY_ID)
+    assert record == displayid.EntityId(ENTITY_ID, 'C', 8, 168, 39, date(2019, 1, 3), 'LGN', 0)
+
+
+def test_invalid_ids_give_none():
+    for bad in (None, '', 'LC08_L1TP_168039_20190132_20190130_01_T1', DISPLAY_ID + 'X', 'LC81680392019400LGN00'):
+        assert displayid.parse(bad) is None
+        assert displayid.parse_entity_id(bad) is None
+
+
+def test_mixed_lists_are_parsed_in_order():
+    records = displayid.parse_many([ENTITY_ID, DISPLAY_ID, 'junk', DISPLAY_ID])
+    assert [type(r).__name__ if r else None for r in records] == ['EntityId', 'DisplayId', None, 'DisplayId']
+    assert records[1] == records[3] == displayid.parse(DISPLAY_ID)
+
+
+def test_ids_are_filtered_by_the_acquisition_mask():
+    inside = 'LC08_L1TP_168039_20190103_20190130_01_T1'
+    below = 'LC08_L1TP_168040_20190103_20190130_01_T1'
+    other_path = 'LC81670392019003LGN00'
+    assert displayid.filter_mask([inside, below, other_path, ENTITY_ID, 'junk']) == [inside, ENTITY_ID]
+    mask = [{'wrsPath': '167', 'startRow': '39', 'endRow': '39'}]
+    assert displayid.filter_mask([inside, other_path], mask) == [other_path]
@@ -0,0 +1,51 @@
+import time
+
+import dlqueue
+import rr_proc
+import mock_server
+
+PRODUCT = mock_server.PRODUCTS[0]
+
+
+def _record(entity_id, url):
+    return {'entityId': entity_id, 'product': PRODUCT, 'url': url, 'filesize': 10}
+
+
+def test_valid_urls_are_reused_until_they_fail_or_expire(tmp_path, monkeypatch):
+    ledger = dlqueue.DownloadLedger(str(tmp_path / 'ledger.sqlite'))
+    label = dlqueue.new_label()
+    ledger.record(label, 'DS', [_record('a', 'u1'), _record('b', 'u2'), _record('c', 'u3')])
+    ledger.update([{'Status': 'Failed', 'URL': 'u2'}])
+    ledger.expire(['u3'])
+    assert sorted(ledger.valid('DS', ['a', 'b', 'c'], [PRODUCT])) == [('a', PRODUCT)]
+    monkeypatch.setattr(dlqueue, 'URL_TTL', 0)
+    time.sleep(0.01)
+    assert ledger.valid('DS', ['a'], [PRODUCT]) == {}
+
+
+def test_labels_complete_once_no_download_is_queued(tmp_path):
+    ledger = dlqueue.DownloadLedger(str(tmp_path / 'ledger.sqlite'))
+    label = dlqueue.new_label()
+    ledger.record(label, 'DS', [_record('a', 'u1'), _record('b', 'u2'), _record('c', 'u3')])
+    ledger.record('other_label', 'DS', [_record('d', 'u4')])
+    ledger.update([{'Status': 'Downloaded', 'URL': 'u1'}, {'Status': 'Cancelled', 'URL': 'u2'}])
+    assert ledger.completed() == []
+    ledger.update([{'Status': 'Failed', 'URL': 'u3'}, {'Status': 'Downloaded', 'URL': 'u4'}])
+    assert ledger.completed() == [label]
+    state = {s['label']: s for s in ledger.state()}
+    assert (state[label]['downloadCount'], state[label]['totalComplete'], state[label]['failed'],
+            state[label]['queued']) == (3, 1, 1, 0)
+
+
+def test_resolved_urls_are_labelled_reused_and_cleared(server, tmp_path):
+    ledger = dlqueue.attach(dlqueue.DownloadLedger(str(tmp_path / 'ledger.sqlite')))
+    ids = [s['entityId'] for s in server.scenes]
+    records = rr_proc.resolve_downloads('key', 'LANDSAT_8_C1', ids[:5], [PRODUCT])
+    again = rr_proc.resolve_downloads('key', 'LANDSAT_8_C1', ids[:5], [PRODUCT])
+    assert server.calls['download'] == 1
+    assert [r['url'] for r in again] == [r['url'] for r in records]
+    results = rr_proc.download_records(records, str(tmp_path))
+    ledger.update(results)
+    label = records[0]['label']
+    assert dlqueue.clear_completed('key') == [label]
+    assert label not in server.labels
@@ -0,0 +1,91 @@
+import pytest
+
+import filters
+
+
+def value(field_id, value):
+    return {'filterType': 'value', 'fieldId': field_id, 'value': value}
+
+
+def between(field_id, first, second):
+    return {'filterType': 'between', 'fieldId': field_id, 'firstValue': first, 'secondValue': second}
+
+
+def and_(*children):
+    return {'filterType': 'and', 'childFilters': list(children)}
+
+
+def or_(*children):
+    return {'filterType': 'or', 'childFilters': list(children)}
+
+
+def test_flattens_nested_filters_and_unwraps_single_children():
+    compiled = filters.compile_filter(and_(and_(value(1, 'a')), and_(value(2, 'b'))))
+    assert compiled == and_(dict(value(1, 'a'), operand='='), dict(value(2, 'b'), operand='='))
+    assert filters.compile_filter(or_(value(1, 'a'))) == dict(value(1, 'a'), operand='=')
+
+
+def test_child_order_and_duplicates_do_not_change_the_result():
+    first = filters.compile_filter(and_(value(1, 'a'), value(2, 'b'), value(1, 'a')))
+    second = filters.compile_filter(and_(value(2, 'b'), value(1, 'a')))
+    assert first == second
+    assert filters.canonical_hash(first) == filters.canonical_hash(second)
+
+
+def test_between_filters_are_intersected_in_and():
+    assert filters.compile_filter(and_(between(1, 1, 10), between(1, 5, 20))) == between(1, 5, 10)
+
+
+def test_overlapping_between_filters_are_joined_in_or():
+    assert filters.compile_filter(or_(between(1, 1, 10), between(1, 5, 20))) == between(1, 1, 20)
+
+
+def test_empty_intersection_raises_at_the_root():
+    with pytest.raises(filters.FilterError):
+        filters.compile_filter(and_(between(1, 1, 2), between(1, 5, 6)))
+
+
+def test_empty_intersection_in_an_or_branch_is_dropped():
+    compiled = filters.compile_filter(or_(and_(between(1, 1, 2), between(1, 5, 6)), value(2, 'x')))
+    assert compiled == dict(value(2, 'x'), operand='=')
+
+
+def test_never_matching_branches_only_raise_when_all_are_empty():
+    empty = and_(between(1, 1, 2), between(1, 5, 6))
+    with pytest.raises(filters.FilterError):
+        filters.compile_filter(or_(empty, empty))
+    with pytest.raises(filters.FilterError):
+        filters.compile_filter(and_(or_(empty, empty), value(2, 'x')))
+
+
+def test_match_all_branch_makes_the_or_match_everything():
+    assert filters.compile_filter(or_(and_(), value(2, 'x'))) is None
+    assert filters.compile_payload({'additionalCriteria': or_(and_(), value(2, 'x'))}) == {}
+
+
+def test_match_all_branch_is_dropped_from_an_and():
+    assert filters.compile_filter(and_(and_(), value(2, 'x'))) == dict(value(2, 'x'), operand='=')
+
+
+def test_unknown_field_ids_are_rejected():
+    with pytest.raises(filters.FilterError):
+        filters.compile_filter(value(3, 'x'), fields={1, 2})
+
+
+def test_equal_criteria_hash_the_same():
+    first = filters.compile_payload({'datasetName': 'DS', 'additionalCriteria': and_(value(1, 'a'), value(2, 'b'))})
+    second = filters.compile_payload({'additionalCriteria': and_(value(2, 'b'), value(1, 'a')), 'datasetName': 'DS'})
+    assert filters.canonical_hash(first) == filters.canonical_hash(second)
+    assert filters.canonical_hash(first) != filters.canonical_hash(dict(first, datasetName='OTHER'))
+
+
+def test_dataset_fields_are_cached_in_memory_and_on_disk(server, monkeypatch):
+    monkeypatch.setattr(filters, '_fields', {})
+    assert filters.dataset_field_ids('key', 'LANDSAT_8_C1') == {20514, 20516}
+    assert filters.dataset_field_ids('key', 'LANDSAT_8_C1') == {20514, 20516}
+    filters._fields.clear()
+    assert filters.dataset_field_ids('key', 'LANDSAT_8_C1') == {20514, 20516}
+    assert server.calls['datasetfields'] == 1
+    monkeypatch.setattr(filters, 'FIELDS_TTL', -1)
+    filters.dataset_field_ids('key', 'LANDSAT_8_C1')
+    assert server.calls['datasetfields'] == 2
@@ -0,0 +1,40 @@
+import api
+import idstore
+
+
+def test_store_translates_both_ways(tmp_path):
+    store = idstore.IdStore(str(tmp_path / 'ids.sqlite'))
+    assert store.put_many('DS', [('e1', 'd1'), ('e2', 'd2'), ('e3', None)]) == 2
+    assert store.get('DS', ['e1', 'e2', 'e3']) == {'e1': 'd1', 'e2': 'd2'}
+    assert store.get('DS', ['d2'], inputField='displayId') == {'d2': 'e2'}
+    assert store.get('OTHER', ['e1']) == {}
+
+
+def test_attached_store_learns_from_responses_and_answers_lookups(server):
+    store = idstore.attach()
+    assert idstore.attach() is store
+    assert api.RESPONSE_HOOKS == [store.ingest]
+    api.search('key', {'datasetName': 'LANDSAT_8_C1', 'maxResults': 10})
+    ids = [s['entityId'] for s in server.scenes]
+    result = idstore.lookup('key', 'LANDSAT_8_C1', ids[:12] + ['unknown'])
+    assert server.calls['idlookup'] == 1
+    assert result == {e: server.by_entity[e]['displayId'] for e in ids[:12]}
+    displays = [server.by_entity[e]['displayId'] for e in ids[:12]]
+    assert idstore.lookup('key', 'LANDSAT_8_C1', displays, inputField='displayId') == dict(zip(displays, ids))
+    assert server.calls['idlookup'] == 1
+
+
+def test_deleted_scenes_and_watermarks(tmp_path):
+    store = idstore.IdStore(str(tmp_path / 'ids.sqlite'))
+    store.put_many('DS', [('e1', 'd1'), ('e2', 'd2')])
+    scenes = [{'entityId': 'e1', 'displayId': 'd1', 'deletionDate': '2020-01-02'},
+              {'entityId': 'e2', 'deletionDate': '2020-01-03'}]
+    assert store.mark_deleted('DS', scenes[:1]) == 1
+    assert store.get('DS', ['e1']) == {'e1': 'd1'}
+    store.mark_deleted('DS', scenes[1:], purge=True)
+    assert store.get('DS', ['e1', 'e2']) == {'e1': 'd1'}
+    assert store.deleted('DS') == {'e1', 'e2'}
+    assert store.deleted('DS', ['e2', 'e3']) == {'e2'}
+    assert store.get_watermark('DS') is None
+    store.set_watermark('DS', '2020-01-03')
+    assert store.get_watermark('DS') == '2020-01-03'
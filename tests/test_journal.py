@@ -0,0 +1,94 @@
+import os
+
+import pytest
+import yaml
+
+import journal
+import mock_server
+import rr_proc
+
+PRODUCT = mock_server.PRODUCTS[0]
+
+
+@pytest.fixture
+def jrnl(tmp_path):
+    return journal.attach(journal.RunJournal(str(tmp_path / 'journal.sqlite')))
+
+
+def test_unfinished_runs_keep_their_params_and_pages(jrnl):
+    assert jrnl.begin('daily', {'startDate': '2020-01-01'}) == {'startDate': '2020-01-01'}
+    assert jrnl.begin('daily', {'startDate': '2020-01-02'}) == {'startDate': '2020-01-01'}
+    fetched = []
+    assert jrnl.page('daily', 1, lambda: fetched.append(1) or {'data': 1}) == {'data': 1}
+    assert jrnl.page('daily', 1, lambda: fetched.append(1) or {'data': 2}) == {'data': 1}
+    jrnl.add_resolved('daily', ['e1', 'e2'], [{'entityId': 'e1', 'url': 'u1'}])
+    assert jrnl.resolved('daily', ['e1', 'e2', 'e3']) == {'e1': [{'entityId': 'e1', 'url': 'u1'}], 'e2': []}
+    jrnl.stage('daily', 'resolve')
+    runs, partial = jrnl.state()
+    assert [(r['run'], r['stage'], r['pages'], r['resolved']) for r in runs] == [('daily', 'resolve', 1, 2)]
+    jrnl.finish('daily')
+    assert jrnl.state() == ([], 0)
+    assert jrnl.resolved('daily', ['e1']) == {}
+    assert jrnl.begin('daily', {'startDate': '2020-01-02'}) == {'startDate': '2020-01-02'}
+    assert fetched == [1]
+
+
+def test_restarted_runs_search_the_same_window(jrnl, tmp_path):
+    conf = tmp_path / 'search.yaml'
+    conf.write_text(yaml.dump({'datasetName': 'LANDSAT_8_C1', 'metadataUpdateFilter': {}}))
+    rr_proc.update_search_params(str(conf), '2020-01-01', '2020-01-02', run='daily')
+    assert rr_proc.update_search_params(str(conf), '2020-01-05', '2020-01-06', run='daily') == {
+        'startDate': '2020-01-01', 'endDate': '2020-01-02'}
+    assert yaml.safe_load(conf.read_text())['metadataUpdateFilter'] == {'startDate': '2020-01-01',
+                                                                         'endDate': '2020-01-02'}
+    jrnl.finish('daily')
+    assert rr_proc.update_search_params(str(conf), '2020-01-05', '2020-01-06', run='daily')['startDate'] == '2020-01-05'
+
+
+def test_resolved_scenes_are_not_resolved_again(jrnl, server):
+    ids = [s['entityId'] for s in server.scenes]
+    server.offline(ids[:2])
+    first = rr_proc.resolve_downloads('key', 'LANDSAT_8_C1', ids[:10], [PRODUCT], run='daily')
+    again = rr_proc.resolve_downloads('key', 'LANDSAT_8_C1', ids, [PRODUCT], run='daily')
+    assert len(first) == 8 and len(again) == 18
+    assert again[:8] == first
+    assert server.calls['downloadoptions'] == 2
+    assert server.calls['download'] == 2
+    assert rr_proc.resolve_downloads('key', 'LANDSAT_8_C1', ids, [PRODUCT]) is not None
+
+
+def _url(server):
+    # Large enough to be cut after the first chunk written by the server.
+    server.file_size = 3 * mock_server.WRITE_CHUNK
+    server.file_md5 = server._file_md5()
+    return '{}{}/{}?product={}'.format(server.url, mock_server.FILES_PATH, server.scenes[0]['displayId'], PRODUCT)
+
+
+def test_interrupted_downloads_resume_with_a_range_request(jrnl, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, 'SYNC_INTERVAL', 4096)
+    url = _url(server)
+    server.cut_after = mock_server.WRITE_CHUNK
+    with pytest.raises(rr_proc.IncompleteDownloadError):
+        rr_proc.download(url, str(tmp_path), 'scene.tar.gz')
+    entry = jrnl.file(os.path.join(str(tmp_path), 'scene.tar.gz'))
+    assert entry['status'] == 'partial' and entry['bytes'] == mock_server.WRITE_CHUNK
+    server.cut_after = None
+    path = rr_proc.download(url, str(tmp_path), 'scene.tar.gz')
+    assert server.calls['range'] == 1
+    assert os.path.getsize(path) == server.file_size
+    assert [name for name in os.listdir(str(tmp_path)) if not name.startswith('journal.sqlite')] == ['scene.tar.gz']
+    assert rr_proc.download(url, str(tmp_path), 'scene.tar.gz') == path
+    assert server.calls['file'] == 2
+
+
+def test_downloads_restart_when_the_server_ignores_ranges(jrnl, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, 'SYNC_INTERVAL', 4096)
+    url = _url(server)
+    server.cut_after = mock_server.WRITE_CHUNK
+    with pytest.raises(rr_proc.IncompleteDownloadError):
+        rr_proc.download(url, str(tmp_path), 'scene.tar.gz')
+    server.cut_after = None
+    server.ranges = False
+    path = rr_proc.download(url, str(tmp_path), 'scene.tar.gz')
+    assert os.path.getsize(path) == server.file_size
+    assert jrnl.file(os.path.join(str(tmp_path), 'scene.tar.gz'))['status'] == 'done'
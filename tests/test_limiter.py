@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+import limiter
+import rr_proc
+
+
+def _release(lim, slot, latency, **outcome):
+    slot['start'] = time.monotonic() - latency
+    slot.update(outcome)
+    lim.release(slot)
+
+
+def _saturate(lim, requests, latency, **outcome):
+    """
+    Keep the limit fully used while the given number of requests of the given latency complete.
+    """
+    slots = []
+    for _ in range(requests):
+        while len(slots) < int(lim.limit):
+            slots.append(lim.acquire())
+        _release(lim, slots.pop(0), latency, **outcome)
+    for slot in slots:
+        slot['sample'] = False
+        lim.release(slot)
+
+
+def test_slow_start_raises_the_limit_by_one_per_busy_request():
+    lim = limiter.AdaptiveLimiter('test', initial=2, maximum=64)
+    _saturate(lim, 2, 0.01)
+    assert lim.limit == 3
+    _saturate(lim, 12, 0.01)
+    assert lim.limit >= 9
+
+
+def test_requests_below_the_limit_do_not_raise_it():
+    lim = limiter.AdaptiveLimiter('test', initial=4)
+    for _ in range(10):
+        _release(lim, lim.acquire(), 0.01)
+    assert lim.limit == 4
+
+
+def test_errors_back_off_once_per_round_then_grow_linearly():
+    lim = limiter.AdaptiveLimiter('test', initial=10, maximum=16)
+    slots = [lim.acquire() for _ in range(10)]
+    for slot in slots:
+        _release(lim, slot, 0.01, error=True)
+    assert lim.limit == pytest.approx(7)
+    assert not lim.slow_start
+    assert lim.stats() == {'limit': 7, 'in_flight': 0, 'requests': 10, 'errors': 10}
+    _saturate(lim, 14, 0.01)
+    assert 7.5 < lim.limit < 9
+    # Errors of requests started before the last decrease are not counted again.
+    _release(lim, lim.acquire(), 10, error=True)
+    assert 7.5 < lim.limit < 9
+    lim.limit = 1.2
+    _release(lim, lim.acquire(), 0, error=True)
+    assert lim.limit == 1
+
+
+def test_latency_is_compared_per_kind_and_per_byte():
+    lim = limiter.AdaptiveLimiter('test', initial=4)
+    _release(lim, lim.acquire('fast'), 0.01)
+    _release(lim, lim.acquire('slow'), 1.0)
+    _release(lim, lim.acquire('big'), 0.01, size=1000)
+    _release(lim, lim.acquire('big'), 1.0, size=100000)
+    assert lim.limit == 4
+    for _ in range(5):
+        _release(lim, lim.acquire('fast'), 0.1)
+    assert lim.limit < 4
+
+
+def test_unsampled_requests_are_ignored():
+    lim = limiter.AdaptiveLimiter('test', initial=4)
+    _release(lim, lim.acquire(), 0.01, error=True, sample=False)
+    assert lim.limit == 4
+    assert lim.stats()['requests'] == 0
+
+
+def test_acquire_waits_for_a_free_slot():
+    lim = limiter.AdaptiveLimiter('test', initial=1, maximum=1)
+    first = lim.acquire()
+    taken = threading.Event()
+    waiter = threading.Thread(target=lambda: (lim.release(lim.acquire()), taken.set()))
+    waiter.start()
+    assert not taken.wait(0.1)
+    lim.release(first)
+    assert taken.wait(5)
+    waiter.join()
+
+
+def test_slot_counts_exceptions_as_errors():
+    lim = limiter.AdaptiveLimiter('test', initial=4)
+    with pytest.raises(RuntimeError):
+        with lim.slot():
+            raise RuntimeError
+    assert lim.stats()['errors'] == 1
+
+
+def test_download_limit_can_grow_beyond_its_start():
+    settings = limiter.LIMITS['download']
+    assert settings['initial'] < settings['maximum'] >= rr_proc.MAX_DOWNLOADS
+    lim = limiter.AdaptiveLimiter('download', **settings)
+    _saturate(lim, 100, 0.01)
+    assert lim.limit == settings['maximum']
+
+
+def test_rate_budget_allows_bursts_then_paces():
+    with pytest.raises(ValueError):
+        limiter.RateBudget('test', 0)
+    budget = limiter.RateBudget('test', rate=10, burst=2)
+    assert budget.reserve() == budget.reserve() == 0
+    assert budget.reserve() == pytest.approx(0.1, abs=0.01)
+    assert budget.reserve() == pytest.approx(0.2, abs=0.01)
@@ -0,0 +1,81 @@
+import io
+import json
+import logging
+import logging.handlers
+import queue
+
+import logsetup
+
+
+def _queued_logger(name, *formatters):
+    q = queue.SimpleQueue()
+    streams = []
+    handlers = []
+    for formatter in formatters:
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(formatter)
+        streams.append(stream)
+        handlers.append(handler)
+    logger = logging.getLogger(name)
+    logger.handlers = [logsetup._LazyQueueHandler(q)]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger, logging.handlers.QueueListener(q, *handlers), streams
+
+
+def test_message_is_built_before_the_arguments_change():
+    logger, listener, (stream,) = _queued_logger('test_logsetup.args', logging.Formatter('%(message)s'))
+    item = {'url': 'first'}
+    logger.info('Downloading %s', item)
+    item['url'] = 'second'
+    listener.start()
+    listener.stop()
+    assert stream.getvalue() == "Downloading {'url': 'first'}\n"
+
+
+def test_exceptions_reach_text_and_json_handlers():
+    logger, listener, (text, js) = _queued_logger('test_logsetup.exc', logging.Formatter('%(message)s'),
+                                                  logsetup.JsonFormatter())
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception('Failed %s', 1)
+    listener.start()
+    listener.stop()
+    assert text.getvalue().startswith('Failed 1\nTraceback')
+    record = json.loads(js.getvalue())
+    assert record['message'] == 'Failed 1'
+    assert 'ZeroDivisionError' in record['exc_info']
+
+
+def test_json_formatter_adds_extra_fields():
+    record = logging.LogRecord('x', logging.INFO, __file__, 1, 'Scene %s', ('LC08',), None)
+    record.entityId = 'LC08'
+    data = json.loads(logsetup.JsonFormatter().format(record))
+    assert data['message'] == 'Scene LC08'
+    assert data['entityId'] == 'LC08'
+
+
+def test_body_is_cut_to_the_limit(monkeypatch):
+    monkeypatch.setattr(logsetup, 'BODY_SAMPLE_RATE', 0.0)
+    assert str(logsetup.body('x' * 10, limit=4)) == 'xxxx... (6 more characters)'
+    assert str(logsetup.body({'a': 1})) == '{"a": 1}'
+
+
+def test_bodies_are_only_serialised_when_emitted():
+    serialised = []
+
+    class Data(object):
+        def __str__(self):
+            serialised.append(1)
+            return 'data'
+
+    logger, listener, (stream,) = _queued_logger('test_logsetup.lazy', logging.Formatter('%(message)s'))
+    listener.start()
+    logger.debug('Body: %s', logsetup.body({'a': Data()}))
+    assert serialised == []
+    logger.info('Body: %s', logsetup.body({'a': Data()}))
+    listener.stop()
+    assert serialised == [1]
+    assert stream.getvalue() == 'Body: {"a": "data"}\n'
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+import api
+import multisearch
+
+
+def test_searches_are_merged_over_the_defaults():
+    conf = {'defaults': {'maxResults': 10, 'datasetName': 'DS'},
+            'searches': [{'datasetName': 'LANDSAT_8_C1'}, {'maxResults': 5}]}
+    assert multisearch.load_searches(conf) == [{'maxResults': 10, 'datasetName': 'LANDSAT_8_C1'},
+                                              {'maxResults': 5, 'datasetName': 'DS'}]
+    with pytest.raises(ValueError):
+        multisearch.load_searches({'searches': [{'maxResults': 5}]})
+    with pytest.raises(ValueError):
+        multisearch.load_searches({'defaults': {'datasetName': 'DS'}})
+
+
+def test_datasets_are_searched_concurrently(server):
+    searches = [{'datasetName': 'LANDSAT_8_C1', 'maxResults': 5}, {'datasetName': 'LANDSAT_7', 'maxResults': 5},
+                {'datasetName': 'LANDSAT_7', 'maxResults': 10}]
+    summary = {}
+    results = list(multisearch.search_datasets('key', searches, workers=3, summary=summary))
+    assert len(results) == 60
+    assert summary == {'LANDSAT_8_C1': {'totalHits': 20, 'pages': 4, 'results': 20},
+                       'LANDSAT_7': {'totalHits': 40, 'pages': 6, 'results': 40}}
+    names = [name for name, _ in results]
+    # Pages of the datasets are interleaved, not returned one dataset after the other.
+    assert names.index('LANDSAT_7') < 20 and names.index('LANDSAT_8_C1') < 20
+
+
+def test_rate_budgets_pace_their_search(server):
+    start = time.monotonic()
+    results = list(multisearch.search_datasets('key', [{'datasetName': 'LANDSAT_8_C1', 'maxResults': 5, 'rate': 10}]))
+    assert len(results) == 20
+    # Four pages and the final empty check: the first request is free, the others wait 0.1 s each.
+    assert time.monotonic() - start >= 0.35
+
+
+def test_a_failing_search_stops_the_others(server, monkeypatch):
+    pages = api.search_pages
+
+    def search_pages(apiKey, payload):
+        if payload['datasetName'] == 'BROKEN':
+            time.sleep(0.1)
+            raise api.USGSError('no such dataset')
+        for page in pages(apiKey, payload):
+            yield page
+
+    monkeypatch.setattr(api, 'search_pages', search_pages)
+    searches = [{'datasetName': 'LANDSAT_8_C1', 'maxResults': 1, 'rate': 20}, {'datasetName': 'BROKEN'}]
+    with pytest.raises(api.USGSError):
+        list(multisearch.search_datasets('key', searches, workers=2))
+    assert server.calls['search'] < 20
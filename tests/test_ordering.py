@@ -0,0 +1,61 @@
+import pytest
+
+import mock_server
+import ordering
+
+PRODUCT = mock_server.PRODUCTS[0]
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(ordering, 'ORDER_BATCH_SIZE', 4)
+    monkeypatch.setattr(ordering, 'POLL_BACKOFF', 1.0)
+
+
+def _ids(server):
+    return [s['entityId'] for s in server.scenes]
+
+
+def test_available_and_ordered_products_are_downloaded(server, tmp_path):
+    ids = _ids(server)
+    server.offline(ids[10:], order_delay=0.2)
+    summary = ordering.recover('key', 'LANDSAT_8_C1', ids, [PRODUCT], str(tmp_path / 'out'), interval=0.1)
+    assert len(summary['orders']) == 3
+    assert summary['pending'] == {}
+    assert summary['unorderable'] == {}
+    assert len(summary['results']) == 20
+    assert set(r['Status'] for r in summary['results']) == {'Downloaded'}
+
+
+def test_unorderable_scenes_are_reported(server, tmp_path, monkeypatch):
+    ids = _ids(server)
+    server.offline(ids[10:], order_delay=0.1)
+    orderable = server.api_getorderproducts
+    monkeypatch.setattr(server, 'api_getorderproducts',
+                        lambda req: [s for s in orderable(req) if s['entityId'] != ids[15]])
+    summary = ordering.recover('key', 'LANDSAT_8_C1', ids, [PRODUCT], str(tmp_path / 'out'), interval=0.1)
+    assert summary['unorderable'] == {ids[15]: [PRODUCT]}
+    assert len(summary['results']) == 19
+
+
+def test_waiting_for_orders_ends_at_the_timeout(server, tmp_path, monkeypatch):
+    ids = _ids(server)
+    server.offline(ids[10:], order_delay=1000)
+    monkeypatch.setattr(ordering, 'ORDER_TIMEOUT', 0.3)
+    summary = ordering.recover('key', 'LANDSAT_8_C1', ids, [PRODUCT], str(tmp_path / 'out'), interval=0.1)
+    assert sorted(summary['pending']) == sorted(ids[10:])
+    assert len(summary['results']) == 10
+
+
+def test_queued_downloads_finish_when_ordering_fails(server, tmp_path, monkeypatch):
+    ids = _ids(server)
+    server.offline(ids[10:])
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('order failed')
+
+    monkeypatch.setattr(ordering, 'order_products', fail)
+    out = tmp_path / 'out'
+    with pytest.raises(RuntimeError):
+        ordering.recover('key', 'LANDSAT_8_C1', ids, [PRODUCT], str(out))
+    assert len(list(out.iterdir())) == 10
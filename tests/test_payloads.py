@@ -0,0 +1,32 @@
+import json
+from urllib.parse import parse_qs
+
+import api
+import payloads
+
+CRITERIA = {'datasetName': 'LANDSAT_8_C1', 'maxResults': 50, 'sortOrder': 'DESC',
+            'temporalFilter': {'dateField': 'search_date', 'startDate': '2019-01-01', 'endDate': '2019-02-01'}}
+
+
+def test_rendered_requests_match_the_payload_function():
+    tpl = payloads.template('search', 'key', ['startingNumber'], **CRITERIA)
+    for starting in (1, 51, 1001):
+        expected = json.loads(payloads.search('key', startingNumber=starting, **CRITERIA))
+        assert json.loads(tpl.render(startingNumber=starting)) == expected
+        form = parse_qs(tpl.form(startingNumber=starting))
+        assert list(form) == ['jsonRequest']
+        assert json.loads(form['jsonRequest'][0]) == expected
+
+
+def test_unset_varying_keys_are_left_out():
+    tpl = payloads.template('idlookup', 'key', ['idList', 'inputField'], datasetName='DS', idList=[])
+    assert json.loads(tpl.render(idList=['a'])) == {'apiKey': 'key', 'datasetName': 'DS', 'idList': ['a']}
+    assert json.loads(payloads.PayloadTemplate({}, ['a']).render(a=1)) == {'a': 1}
+    assert payloads.PayloadTemplate({}, ['a']).render() == '{}'
+
+
+def test_search_pages_walk_the_whole_result(server):
+    pages = list(api.search_pages('key', {'datasetName': 'LANDSAT_8_C1', 'maxResults': 6}))
+    assert [p['data']['firstRecord'] for p in pages] == [1, 7, 13, 19]
+    ids = [r['entityId'] for p in pages for r in p['data']['results']]
+    assert ids == [s['entityId'] for s in server.scenes]
@@ -0,0 +1,37 @@
+import json
+import pstats
+import threading
+
+import profiling
+
+
+def _busy_worker():
+    return sum(i * i for i in range(10000))
+
+
+def test_spans_add_up_their_wall_time():
+    before = profiling.spans().get('test_span', {'count': 0, 'seconds': 0.0})
+    for _ in range(3):
+        with profiling.span('test_span'):
+            pass
+    after = profiling.spans()['test_span']
+    assert after['count'] == before['count'] + 3
+    assert after['seconds'] >= before['seconds']
+
+
+def test_profile_covers_threads_started_after_start(tmp_path):
+    out = str(tmp_path / 'run.prof')
+    profiling.start()
+    try:
+        with profiling.span('download'):
+            thread = threading.Thread(target=_busy_worker)
+            thread.start()
+            thread.join()
+    finally:
+        timings = profiling.stop(out)
+    assert timings['download']['count'] == 1
+    functions = {func[2] for func in pstats.Stats(out).stats}
+    assert '_busy_worker' in functions
+    with open(out + '.spans.json') as f:
+        assert json.load(f) == timings
+    assert profiling.stop(out) == timings
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+
+import mock_server
+import resultspool
+
+
+def _records(n, start=0):
+    return [{'entityId': 'E{}'.format(i)} for i in range(start, start + n)]
+
+
+def test_records_are_read_back_in_order(tmp_path):
+    path = str(tmp_path / 'spool')
+    with resultspool.SpoolWriter(path) as writer:
+        writer.extend(_records(5))
+        writer.finish()
+        with pytest.raises(resultspool.SpoolError):
+            writer.append({})
+    reader = resultspool.SpoolReader(path)
+    assert list(reader.records()) == _records(5)
+    assert reader.complete
+    assert resultspool.info(path) == {'records': 5, 'bytes': reader.position, 'complete': True, 'readers': {}}
+
+
+def test_writer_resumes_from_its_checkpoint(tmp_path):
+    path = str(tmp_path / 'spool')
+    writer = resultspool.SpoolWriter(path)
+    writer.extend(_records(2))
+    writer.checkpoint({'page': 2})
+    # Written but not checkpointed when the writer dies.
+    writer.extend(_records(2, start=100))
+    writer.close()
+    assert list(resultspool.SpoolReader(path).records()) == _records(2)
+    with resultspool.SpoolWriter(path) as writer:
+        assert (writer.state, writer.count) == ({'page': 2}, 2)
+        writer.extend(_records(2, start=2))
+        writer.finish()
+    assert list(resultspool.SpoolReader(path).records()) == _records(4)
+
+
+def test_incomplete_last_record_is_dropped_without_a_checkpoint(tmp_path):
+    path = tmp_path / 'spool'
+    with resultspool.SpoolWriter(str(path)) as writer:
+        writer.extend(_records(3))
+    path.write_bytes(path.read_bytes()[:-3])
+    assert list(resultspool.SpoolReader(str(path)).records()) == _records(2)
+    with resultspool.SpoolWriter(str(path)) as writer:
+        assert writer.count == 2
+        writer.append({'entityId': 'E2'})
+        writer.finish()
+    assert list(resultspool.SpoolReader(str(path)).records()) == _records(3)
+
+
+def test_damaged_records_of_a_complete_spool_raise(tmp_path):
+    path = tmp_path / 'spool'
+    with resultspool.SpoolWriter(str(path)) as writer:
+        writer.extend(_records(3))
+        writer.finish()
+    data = bytearray(path.read_bytes())
+    data[-2] ^= 0xff
+    path.write_bytes(bytes(data))
+    with pytest.raises(resultspool.SpoolError):
+        list(resultspool.SpoolReader(str(path)).records())
+
+
+def test_named_readers_continue_from_their_checkpoint(tmp_path):
+    path = str(tmp_path / 'spool')
+    with resultspool.SpoolWriter(path) as writer:
+        writer.extend(_records(10))
+        writer.finish()
+    batches = resultspool.SpoolReader(path, 'stage').batches(4)
+    assert next(batches) == _records(4)
+    assert next(batches) == _records(4, start=4)
+    # Interrupted while the second batch is processed: it is handed out again.
+    batches.close()
+    assert resultspool.info(path)['readers'] == {'stage': 6}
+    assert list(resultspool.SpoolReader(path, 'stage').batches(4)) == [_records(4, start=4), _records(2, start=8)]
+    assert resultspool.info(path)['readers'] == {'stage': 0}
+
+
+def test_readers_follow_a_spool_being_written(tmp_path):
+    path = str(tmp_path / 'spool')
+    writer = resultspool.SpoolWriter(path)
+    read = []
+    follower = threading.Thread(target=lambda: read.extend(
+        resultspool.SpoolReader(path).batches(100, follow=True, poll=0.01)))
+    follower.start()
+    for i in range(5):
+        writer.extend(_records(3, start=3 * i))
+        writer.checkpoint()
+    writer.finish()
+    writer.close()
+    follower.join(5)
+    assert not follower.is_alive()
+    assert [r for batch in read for r in batch] == _records(15)
+
+
+def test_backfill_stages_pass_records_through_spools(server, tmp_path):
+    scenes, urls = str(tmp_path / 'scenes'), str(tmp_path / 'urls')
+    payload = {'datasetName': 'LANDSAT_8_C1', 'maxResults': 6}
+    assert resultspool.spool_search('key', payload, scenes) == 20
+    assert resultspool.spool_search('key', payload, scenes) == 20
+    assert server.calls['search'] == 4
+    assert resultspool.spool_resolve('key', scenes, urls, [mock_server.PRODUCTS[0]], batch_size=8) == 20
+    assert server.calls['download'] == 3
+    totals = resultspool.spool_download(urls, str(tmp_path / 'out'), batch_size=8)
+    assert totals == {'Downloaded': 20}
+    assert resultspool.info(urls)['readers'] == {'download': 0}
+    assert resultspool.spool_download(urls, str(tmp_path / 'out')) == {}
@@ -0,0 +1,216 @@
+import gzip
+import hashlib
+import io
+import os
+import time
+import zipfile
+import zlib
+
+import pytest
+import urllib3
+
+import dlqueue
+import mock_server
+import rr_proc
+
+
+def _url(server, i=0):
+    return '{}{}/{}?product=STANDARD'.format(server.url, mock_server.FILES_PATH, server.scenes[i]['displayId'])
+
+
+def _content(server):
+    return (server._payload * (server.file_size // len(server._payload) + 1))[:server.file_size]
+
+
+def test_download_is_checked_against_the_header_checksum(server, tmp_path):
+    path = rr_proc.download(_url(server), str(tmp_path), 'scene.tar.gz')
+    with open(path, 'rb') as f:
+        assert f.read() == _content(server)
+    assert os.listdir(str(tmp_path)) == ['scene.tar.gz']
+
+
+def test_corrupt_download_is_removed(server, tmp_path):
+    server.corrupt_rate = 1.0
+    with pytest.raises(rr_proc.ChecksumError):
+        rr_proc.download(_url(server), str(tmp_path), 'scene.tar.gz')
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_download_is_checked_against_a_given_checksum(server, tmp_path):
+    sha256 = hashlib.sha256(_content(server)).hexdigest()
+    assert rr_proc.download(_url(server), str(tmp_path), 'a', checksum='sha256:' + sha256)
+    with pytest.raises(rr_proc.ChecksumError):
+        rr_proc.download(_url(server), str(tmp_path), 'b', checksum='0' * 32)
+    assert os.listdir(str(tmp_path)) == ['a']
+
+
+def test_response_length_takes_precedence_over_the_metadata_size(server, tmp_path):
+    assert rr_proc.download(_url(server), str(tmp_path), 'a', filesize=server.file_size + 1000)
+
+
+def test_truncated_download_is_a_size_mismatch(server, tmp_path):
+    server.file_size = 3 * mock_server.WRITE_CHUNK
+    server.file_md5 = server._file_md5()
+    server.cut_after = mock_server.WRITE_CHUNK
+    with pytest.raises(rr_proc.ChecksumError):
+        rr_proc.download(_url(server), str(tmp_path), 'a')
+    assert os.listdir(str(tmp_path)) == []
+
+
+def _response(body, **headers):
+    import requests
+    r = requests.Response()
+    r.raw = urllib3.HTTPResponse(body=io.BytesIO(body), headers=headers, preload_content=False)
+    return r
+
+
+@pytest.mark.parametrize('size', [0, 1, rr_proc.CHUNK_SIZE, 3 * rr_proc.CHUNK_SIZE + 7])
+def test_stream_to_file_copies_and_hashes_the_body(tmp_path, size):
+    data = os.urandom(size)
+    hasher = hashlib.md5()
+    with open(str(tmp_path / 'out'), 'wb') as f:
+        assert rr_proc._stream_to_file(_response(data), f, hasher, filesize=size) == size
+    assert (tmp_path / 'out').read_bytes() == data
+    assert hasher.hexdigest() == hashlib.md5(data).hexdigest()
+
+
+def test_stream_to_file_decodes_compressed_bodies(tmp_path):
+    data = b'landsat ' * 300000
+    hasher = hashlib.md5()
+    with open(str(tmp_path / 'out'), 'wb') as f:
+        size = rr_proc._stream_to_file(_response(gzip.compress(data), **{'Content-Encoding': 'gzip'}), f, hasher)
+    assert size == len(data)
+    assert (tmp_path / 'out').read_bytes() == data
+
+
+def test_only_available_products_are_resolved(server, monkeypatch):
+    ids = [s['entityId'] for s in server.scenes]
+    server.offline(ids[:5])
+    options = server.api_downloadoptions
+
+    def no_bundles_for_odd_scenes(req):
+        data = options(req)
+        for scene in data:
+            if ids.index(scene['entityId']) % 2:
+                for option in scene['downloadOptions']:
+                    option['available'] = option['available'] and option['productCode'] != 'FR_BUND'
+        return data
+
+    monkeypatch.setattr(server, 'api_downloadoptions', no_bundles_for_odd_scenes)
+    records = rr_proc.resolve_downloads('key', 'LANDSAT_8_C1', ids, ['STANDARD', 'FR_BUND'])
+    assert server.calls['download'] == 2
+    resolved = sorted((r['entityId'], r['product']) for r in records)
+    expected = [(e, 'STANDARD') for e in ids[5:]] + [(e, 'FR_BUND') for e in ids[5:] if ids.index(e) % 2 == 0]
+    assert resolved == sorted(expected)
+    assert all(r['filesize'] == server.file_size and r['datasetName'] == 'LANDSAT_8_C1' for r in records)
+
+
+def test_file_names_come_from_the_server_or_the_product_code():
+    assert rr_proc.product_file_name('LC08_X', 'FR_BUND') == 'LC08_X.zip'
+    assert rr_proc.product_file_name('LC08_X', 'NEW') == 'LC08_X_NEW'
+    assert rr_proc._content_disposition_name({'Content-Disposition': 'attachment; filename="a b.tar"'}) == 'a b.tar'
+    assert rr_proc._content_disposition_name(
+        {'Content-Disposition': "attachment; filename*=UTF-8''..%2Fx%20y.tgz"}) == 'x y.tgz'
+    assert rr_proc._content_disposition_name({}) is None
+
+
+def test_downloads_are_ordered_largest_first():
+    items = [{'id': 'small', 'filesize': 10}, {'id': 'unknown'}, {'id': 'large', 'filesize': '50'}]
+    assert [i['id'] for i in rr_proc.order_by_size(items)] == ['large', 'unknown', 'small']
+
+
+def test_duration_is_predicted_by_simulating_the_queue():
+    items = [{'filesize': s} for s in (40, 30, 20, 10)]
+    assert rr_proc.predict_duration(items, 1, rate=10) == 10
+    assert rr_proc.predict_duration(items, 2, rate=10) == 5
+    assert rr_proc.predict_duration(items, 8, rate=10) == 4
+    assert rr_proc.predict_duration([{}], 2, rate=10) is None
+
+
+def test_disk_space_is_checked_with_a_margin(tmp_path, monkeypatch):
+    free = rr_proc.shutil.disk_usage(str(tmp_path)).free
+    monkeypatch.setattr(rr_proc, 'FREE_SPACE_MARGIN', free // 2)
+    rr_proc.check_disk_space(str(tmp_path), [{'file name': 'a', 'filesize': free // 4}, {'file name': 'b'}])
+    with pytest.raises(rr_proc.DiskSpaceError):
+        rr_proc.check_disk_space(str(tmp_path), [{'file name': 'a', 'filesize': free // 4},
+                                                 {'file name': 'b', 'filesize': free // 2}])
+
+
+def _archives(tmp_path):
+    import tarfile
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'B1.TIF').write_bytes(os.urandom(50000))
+    (src / 'MTL.txt').write_text('GROUP = L1_METADATA_FILE\n')
+    with tarfile.open(str(tmp_path / 'a.tar.gz'), 'w:gz') as tf:
+        for f in src.iterdir():
+            tf.add(str(f), arcname=f.name)
+    with zipfile.ZipFile(str(tmp_path / 'b.zip'), 'w', zipfile.ZIP_DEFLATED) as zf:
+        for f in src.iterdir():
+            zf.write(str(f), arcname=f.name)
+    return src
+
+
+def _corrupt(path):
+    data = bytearray(path.read_bytes())
+    data[len(data) // 3] ^= 0xff
+    path.write_bytes(bytes(data))
+
+
+def test_archives_are_unpacked(tmp_path):
+    src = _archives(tmp_path)
+    for name in ('a.tar.gz', 'b.zip'):
+        result = rr_proc.extract_archive(str(tmp_path / name), str(tmp_path / 'out'))
+        assert result['files'] == 2
+        assert (tmp_path / 'out' / name.split('.')[0] / 'B1.TIF').read_bytes() == (src / 'B1.TIF').read_bytes()
+
+
+@pytest.mark.parametrize('name, error', [('a.tar.gz', (OSError, EOFError, zlib.error)), ('b.zip', zipfile.BadZipFile)])
+def test_corrupt_archives_raise(tmp_path, name, error):
+    _archives(tmp_path)
+    _corrupt(tmp_path / name)
+    with pytest.raises(error):
+        rr_proc.extract_archive(str(tmp_path / name), str(tmp_path / 'out'))
+
+
+def test_post_processor_reports_extractions_and_errors(tmp_path):
+    _archives(tmp_path)
+    (tmp_path / 'c.tar.gz').write_bytes((tmp_path / 'a.tar.gz').read_bytes())
+    _corrupt(tmp_path / 'c.tar.gz')
+    post = rr_proc.PostProcessor(str(tmp_path / 'out'), workers=2)
+    assert post.submit(str(tmp_path / 'src' / 'MTL.txt')) is None
+    for name in ('a.tar.gz', 'b.zip', 'c.tar.gz'):
+        post.submit(str(tmp_path / name))
+    summary = post.close()
+    assert (summary['archives'], summary['errors']) == (2, 1)
+    assert post.errors[0]['archive'].endswith('c.tar.gz')
+
+
+def _expired_records(server, monkeypatch, ttl):
+    monkeypatch.setattr(rr_proc, 'REFRESH_WINDOW', 0.05)
+    ids = [s['entityId'] for s in server.scenes]
+    records = rr_proc.resolve_downloads('key', 'LANDSAT_8_C1', ids, ['STANDARD'])
+    time.sleep(0.2)
+    server.url_ttl = ttl
+    return records
+
+
+def test_expired_urls_of_a_label_are_refreshed_together(server, tmp_path, monkeypatch):
+    dlqueue.attach(dlqueue.DownloadLedger(str(tmp_path / 'ledger.sqlite')))
+    monkeypatch.setattr(rr_proc, 'MAX_DOWNLOADS', 2)
+    records = _expired_records(server, monkeypatch, 0.1)
+    results = rr_proc.download_records(records, str(tmp_path))
+    assert [r['Status'] for r in results] == ['Downloaded'] * 20
+    assert server.calls['download'] == 2
+    assert server.calls['expired'] == 2
+    # Only the new URLs are reused, the expired ones are marked in the ledger.
+    valid = dlqueue.get_ledger().valid('LANDSAT_8_C1', [r['entityId'] for r in records], ['STANDARD'])
+    assert sorted(r['url'] for r in valid.values()) == sorted(r['URL'] for r in results)
+    assert not set(r['url'] for r in records) & set(r['URL'] for r in results)
+
+
+def test_urls_are_refreshed_at_most_max_refreshes_times(server, tmp_path, monkeypatch):
+    records = _expired_records(server, monkeypatch, 0)
+    results = rr_proc.download_records(records, str(tmp_path))
+    assert [r['Status'] for r in results] == ['Failed'] * 20
+    assert server.calls['expired'] == 20 * (rr_proc.MAX_REFRESHES + 1)
@@ -0,0 +1,66 @@
+import os
+import threading
+from datetime import date, timedelta
+from queue import Empty
+
+import scheduler
+
+LANES = [
+    {'name': 'recent', 'share': 0.5, 'max_age_days': 30},
+    {'name': 'realtime', 'share': 0.25, 'tiers': ['RT']},
+    {'name': 'backfill', 'share': 0.25, 'datasets': ['LANDSAT_7']},
+]
+
+
+def test_items_go_to_the_first_matching_lane():
+    q = scheduler.LaneQueue(LANES, workers=4)
+    today = date.today()
+    assert q.classify({'tier': 'T1', 'acquired': today - timedelta(days=30)})['name'] == 'recent'
+    assert q.classify({'tier': 'RT', 'acquired': today - timedelta(days=31)})['name'] == 'realtime'
+    assert q.classify({'tier': 'RT'})['name'] == 'realtime'
+    assert q.classify({'tier': 'T2', 'dataset': 'LANDSAT_8_C1'})['name'] == 'backfill'
+    assert [lane['slots'] for lane in q.lanes] == [2, 1, 1]
+
+
+def test_lanes_get_their_share_and_idle_workers_take_any_work():
+    q = scheduler.LaneQueue([{'name': 'rt', 'share': 0.5, 'tiers': ['RT']}, {'name': 'other', 'share': 0.5}],
+                            workers=2)
+    for i in range(3):
+        q.put((i, {'tier': 'RT'}))
+    q.put((3, {'tier': 'T1'}))
+    taken = [q.get()[0], q.get()[0]]
+    assert taken == [0, 3]
+    # Both lanes are at their share, the first lane with work goes next.
+    assert q.get()[0] == 1
+    assert q.stats()['rt'] == {'slots': 1, 'queued': 1, 'active': 2, 'done': 0}
+
+
+def test_task_done_join_and_cancel():
+    q = scheduler.LaneQueue(workers=2)
+    for i in range(4):
+        q.put((i, {'tier': 'RT' if i % 2 else 'T1', 'entityId': i}))
+    assert [w[0] for w in q.cancel(lambda item: item['entityId'] >= 2)] == [3, 2]
+    assert q.qsize() == 2
+
+    def work():
+        while True:
+            try:
+                q.get(block=False)
+            except Empty:
+                return
+            q.task_done()
+
+    threads = [threading.Thread(target=work) for _ in range(2)]
+    for t in threads:
+        t.start()
+    q.join()
+    for t in threads:
+        t.join()
+    assert q.empty()
+    assert sum(s['done'] for s in q.stats().values()) == 2
+
+
+def test_lanes_are_read_from_yaml():
+    lanes = scheduler.load_lanes(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                              'params', 'lanes.yaml'))
+    assert lanes and all('name' in lane for lane in lanes)
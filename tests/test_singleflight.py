@@ -0,0 +1,103 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import api
+import singleflight
+
+
+def _blocking(release, counter):
+    def fn():
+        counter.append(1)
+        release.wait(5)
+        return len(counter)
+    return fn
+
+
+def test_concurrent_callers_share_one_call():
+    group = singleflight.SingleFlight()
+    release = threading.Event()
+    counter = []
+    fn = _blocking(release, counter)
+    with ThreadPoolExecutor(5) as pool:
+        futures = [pool.submit(group.do, 'key', fn) for _ in range(4)]
+        while group.shared < 3:
+            release.wait(0.01)
+        other = pool.submit(group.do, 'other', lambda: 'other')
+        assert other.result(1) == 'other'
+        release.set()
+        assert [f.result(5) for f in futures] == [1] * 4
+    assert group.do('key', fn) == 2
+
+
+def test_errors_reach_all_waiters():
+    group = singleflight.SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise ValueError('boom')
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(group.do, 'key', fail) for _ in range(2)]
+        while group.shared < 1:
+            release.wait(0.01)
+        release.set()
+        for f in futures:
+            with pytest.raises(ValueError):
+                f.result(5)
+
+
+def test_async_callers_share_one_call():
+    group = singleflight.SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'result'
+
+    async def main():
+        return await asyncio.gather(*[group.do_async('key', fetch) for _ in range(5)])
+
+    assert asyncio.run(main()) == ['result'] * 5
+    assert len(calls) == 1
+    assert group._async_calls == {}
+
+
+def test_async_and_threaded_callers_share_plain_functions():
+    group = singleflight.SingleFlight()
+    release = threading.Event()
+    counter = []
+    fn = _blocking(release, counter)
+
+    async def main():
+        tasks = [asyncio.ensure_future(group.do_async('key', fn)) for _ in range(2)]
+        thread = ThreadPoolExecutor(1).submit(group.do, 'key', fn)
+        while group.shared < 2:
+            await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(*tasks) + [thread.result(5)]
+
+    assert asyncio.run(main()) == [1, 1, 1]
+
+
+def test_identical_api_reads_reach_the_server_once(server, monkeypatch):
+    release = threading.Event()
+    status = server.api_datasetfields
+
+    def slow(req):
+        release.wait(5)
+        return status(req)
+
+    monkeypatch.setattr(server, 'api_datasetfields', slow)
+    with ThreadPoolExecutor(3) as pool:
+        futures = [pool.submit(api.datasetfields, 'key', 'LANDSAT_8_C1') for _ in range(3)]
+        while not server.calls.get('datasetfields'):
+            release.wait(0.01)
+        release.wait(0.2)
+        release.set()
+        assert len(set(len(f.result(5)['data']) for f in futures)) == 1
+    assert server.calls['datasetfields'] == 1
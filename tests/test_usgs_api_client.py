@@ -0,0 +1,41 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _python(code, cwd):
+    proc = subprocess.run([sys.executable, '-c', code], cwd=str(cwd), env=dict(os.environ, PYTHONPATH=ROOT),
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=60)
+    assert proc.returncode == 0, proc.stdout
+    return proc.stdout.split()
+
+
+def test_import_leaves_logging_alone_and_defers_requests_and_yaml(tmp_path):
+    out = _python('import logging, sys, usgs_api_client; '
+                  'print("requests" in sys.modules, "yaml" in sys.modules, len(logging.getLogger().handlers))',
+                  tmp_path)
+    assert out == ['False', 'False', '0']
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_logging_is_configured_once(tmp_path):
+    out = _python('import logging, logsetup; logsetup.configure(); n = len(logging.getLogger().handlers); '
+                  'logsetup.configure(); print(n > 0, len(logging.getLogger().handlers) == n); logsetup.stop()',
+                  tmp_path)
+    assert out == ['True', 'True']
+
+
+def test_configured_logs_go_to_json_files_through_the_queue(tmp_path):
+    _python('import logging, logsetup; logsetup.configure(); log = logging.getLogger("test"); '
+            'item = {"url": "first"}; log.info("Downloading %s", item, extra={"entityId": "LC08"}); '
+            'item["url"] = "second"; log.error("Failed"); logsetup.stop()', tmp_path)
+    with open(str(tmp_path / 'usgs_api_client_debug.log')) as f:
+        records = [json.loads(line) for line in f]
+    assert [(r['level'], r['message']) for r in records] == [('INFO', "Downloading {'url': 'first'}"),
+                                                              ('ERROR', 'Failed')]
+    assert records[0]['entityId'] == 'LC08'
+    with open(str(tmp_path / 'usgs_api_client_error.log')) as f:
+        assert [json.loads(line)['message'] for line in f] == ['Failed']
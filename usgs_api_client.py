@@ -28,17 +28,24 @@ TODO: - Test download method
 
 import json
 import logging
-import logging.config
 import os
 import sys
 from collections import OrderedDict
 
 import click
-import yaml
 
+import acq_mask
 import api
+import cache
 import datamodels
+import deletions
+import dlqueue
+import filters
+import idstore
+import journal
+import logsetup
 import payloads
+import profiling
 import rr_proc
 
 USGS_API_ENDPOINT = api.USGS_API_ENDPOINT
@@ -46,20 +53,35 @@ KEY_FILE = api.KEY_FILE
 PRINT = False
 abs_mod_dir = os.path.dirname(__file__)
 
-with open(os.path.join(abs_mod_dir, 'logging.conf'), 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
 logger = logging.getLogger(__name__)
 
 @click.group(invoke_without_command=True)
+@click.option('--cache/--no-cache', 'use_cache', default=True,
+              help='Reuse recent search and hits responses (see cache.py). Default: on.')
+@click.option('--profile', required=False, type=click.Path(dir_okay=False),
+              help='Profile the run and write pstats data to this file, phase timings to FILE.spans.json.')
 @click.pass_context
-def cli(ctx):
+def cli(ctx, use_cache=True, profile=None):
     # ensure that ctx.obj exists and is a dict (in case `cli()` is called
     # by means other than the `if` block below
     ctx.ensure_object(dict)
+    logsetup.configure()
+    if profile:
+        profiling.start()
+        ctx.call_on_close(lambda: profiling.stop(profile))
+    # Record entityId <-> displayId pairs from all search, metadata and idlookup responses.
+    idstore.attach()
+    # Label download requests and reuse their URLs while they are valid.
+    dlqueue.attach()
+    # Record run progress and download offsets, so that interrupted runs can resume.
+    journal.attach()
+    if use_cache:
+        cache.enable()
+    else:
+        cache.disable()
 
     logger.debug("Starting new USGS Inventory API Client run.")
-    logger.info("USGS API endpoint is {}".format(USGS_API_ENDPOINT))
+    logger.info("USGS API endpoint is %s", USGS_API_ENDPOINT)
     if not os.path.exists(KEY_FILE):
         logger.info("API key file does not exist. Consider running the login command first.")
     else:
@@ -80,6 +102,7 @@ def login(conf_file):
     """
     logger.info('Calling login().')
     if conf_file:
+        import yaml
         with open(conf_file, 'r') as f:
             conf = yaml.safe_load(f)
     else:
@@ -87,10 +110,10 @@ def login(conf_file):
         conf = {}
         conf['username'] = click.prompt('Username')
         conf['password'] = click.prompt('Password', hide_input=True)
-    logger.info("Using username = {}. Password not shown.".format(conf['username']))
+    logger.info("Using username = %s. Password not shown.", conf['username'])
     response = api.login(**conf)
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
-    logger.info("Your new API session key is {}".format(response['data']))
+    logger.debug("Received response: %s", logsetup.body(response))
+    logger.info("Your new API session key is %s", response['data'])
 
 @cli.command()
 @click.argument('apikey', required=False)
@@ -102,7 +125,7 @@ def logout(apikey=None):
     """
     logger.info('Calling logout().')
     response = api.logout(apikey)
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("Received response: %s", logsetup.body(response))
     if response['errorCode'] is None:
         logger.info("API session successfully ended. Key file removed.")
 
@@ -116,9 +139,9 @@ def status():
     """
     logger.info('Calling status().')
     response = api.status()
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("Received response: %s", logsetup.body(response))
     # TODO: The datamodels.Status() use might be overkill. Check later if this is a good idea.
-    logger.info("API status is: {}.".format(datamodels.Status(response['data']['build_date'])))
+    logger.info("API status is: %s.", datamodels.Status(response['data']['build_date']))
 
 @cli.command()
 @click.argument('apikey', required=False)
@@ -131,7 +154,7 @@ def notifications(apikey=None,save=None):
     """
     logger.info('Calling notifications().')
     response = api.notifications(apikey)
-    logger.debug("Received response:\n{}".format(json.dumps(response, indent=4)))
+    logger.debug("Received response: %s", logsetup.body(response))
     n_list = sorted(response['data'], key=lambda k: k['notificationId'])
     if len(n_list) > 0:
         logger.info("Begin system notifications:")
@@ -159,7 +182,7 @@ def cleardownloads(ctx, apikey=None, conf_file=None):
     """
     logger.info("Calling cleardownloads().")
     if conf_file:
-        logger.info("Using conf file {}".format(conf_file))
+        logger.info("Using conf file %s", conf_file)
         conf = load_conf_file(conf_file)
         api.cleardownloads(apikey, conf['labels'])
     else:
@@ -189,29 +212,87 @@ def idlookup(ctx, apikey=None, conf_file=None, save=None):
     Translate from one ID type to another: entityId (Landsat Scene ID) <-> displayId (Landsat Product ID).
     The response contains a dictionary of objects - keys are inputField value,
     values are the corresponding translations.
+    IDs already seen in a search, metadata or idlookup response are translated from the local
+    store (see idstore.py), only the others are sent to the server.
     TODO: format output.
     """
     logger.info("Calling idlookup().")
-    call_api_method("idlookup", apikey, conf_file=conf_file, save=save)
+    logger.info("Using conf file %s", conf_file)
+    conf = load_conf_file(conf_file)
+    data = idstore.lookup(apikey, conf['datasetName'], conf['idList'], conf.get('inputField', 'entityId'))
+    if save:
+        write_to_yaml(data, save)
+        logger.info("Saved response to %s", save)
+    return data
 
 @cli.command()
 @click.pass_context
 @click.argument('conf_file', required=True, type=click.Path(exists=True))
 @click.option('--save', required=False, type=click.Path(exists=False))
 @click.option('--systematic', required=False, type=bool)
-def search(ctx, apikey=None, conf_file=None, save=None, systematic=False):
+@click.option('--check_available', required=False, type=bool,
+              help='Only keep scenes and products reported available by downloadoptions.')
+@click.option('--mask', required=False, type=bool,
+              help='Only keep scenes within the acquisition mask (acq_mask.py).')
+@click.option('--run', required=False, help='Record progress under this run name, see journal.py.')
+def search(ctx, apikey=None, conf_file=None, save=None, systematic=False, check_available=False, mask=False, run=None):
     """
     Perform a product search using supplied criteria.
     Valid API key is required for this request - use login() to obtain.
     See params/search.yaml for the structure of payload.
     The request returns a SearchResponse() object - see datamodels.py.
+    With --run, an unfinished run keeps its search dates and reuses the response it already fetched.
     """
     if systematic:
         logger.info("Running daily systematic search().")
-        rr_proc.update_search_params(conf_file)
+        rr_proc.update_search_params(conf_file, run=run)
     logger.info("Calling search().")
-    call_api_method("search", apikey, conf_file=conf_file, save=save)
-    rr_proc.search_to_dl(save, save)
+    if run:
+        conf = load_conf_file(conf_file)
+        jrnl = journal.get_journal()
+        jrnl.stage(run, 'search')
+        response = jrnl.page(run, conf.get('startingNumber', 1), lambda: api.search(apikey, conf))
+        if save:
+            write_to_yaml(response['data'], save)
+            logger.info("Saved response to %s", save)
+    else:
+        call_api_method("search", apikey, conf_file=conf_file, save=save)
+    rr_proc.search_to_dl(save, save, dataset_name=load_conf_file(conf_file)['datasetName'], apiKey=apikey,
+                         check_available=check_available, mask=acq_mask.ACQ_MASK if mask else None)
+
+@cli.command()
+@click.pass_context
+@click.argument('conf_file', required=True, type=click.Path(exists=True))
+@click.option('--save', required=False, type=click.Path(exists=False))
+@click.option('--save_dir', required=False, type=click.Path(file_okay=False),
+              help='Also write the results of each dataset to DATASETNAME.yaml in this directory.')
+@click.option('--workers', required=False, type=int, help='Number of concurrent searches. Default: multisearch.MAX_WORKERS.')
+def multisearch(ctx, apikey=None, conf_file=None, save=None, save_dir=None, workers=None):
+    """
+    Search several datasets concurrently, each with its own criteria and optional rate budget.
+    See params/multisearch.yaml for the structure of conf_file.
+    The results are saved per dataset: {datasetName: {datasetName, totalHits, results}}.
+    The files written to save_dir can be passed to search_to_dl() like search responses.
+    """
+    import multisearch as ms
+    logger.info("Using conf file %s", conf_file)
+    searches = ms.load_searches(load_conf_file(conf_file))
+    summary = {}
+    output = {}
+    for name, result in ms.search_datasets(apikey, searches, workers=workers, summary=summary):
+        output.setdefault(name, {'datasetName': name, 'results': []})['results'].append(result)
+    for name, entry in summary.items():
+        output.setdefault(name, {'datasetName': name, 'results': []})['totalHits'] = entry['totalHits']
+        logger.info("%s: %s of %s results in %s pages.", name, entry['results'], entry['totalHits'], entry['pages'])
+    if save:
+        write_to_yaml(output, save)
+        logger.info("Saved response to %s", save)
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+        for name, data in output.items():
+            write_to_yaml(data, os.path.join(save_dir, '{}.yaml'.format(name)))
+        logger.info("Saved %s dataset results to %s", len(output), save_dir)
+    return output
 
 @cli.command()
 @click.pass_context
@@ -227,6 +308,26 @@ def hits(ctx, apikey=None, conf_file=None, save=None):
     logger.info("Calling hits().")
     call_api_method("hits", apikey, conf_file=conf_file, save=save)
 
+@cli.command()
+@click.pass_context
+@click.argument('conf_file', required=True, type=click.Path(exists=True))
+@click.option('--save', required=False, type=click.Path(exists=False))
+def check_filter(ctx, apikey=None, conf_file=None, save=None):
+    """
+    Validate and compile the additionalCriteria of a search or hits conf file.
+    Field IDs are checked against datasetfields of the dataset (cached, see filters.py).
+    search and hits always send the compiled criteria; --save writes the conf file with them.
+    """
+    conf = load_conf_file(conf_file)
+    fields = filters.dataset_field_ids(apikey, conf['datasetName'])
+    compiled = filters.compile_payload(conf, fields)
+    logger.info("Criteria are valid. Size: %s -> %s bytes, hash %s", len(json.dumps(conf.get('additionalCriteria'))),
+                len(json.dumps(compiled.get('additionalCriteria'))), filters.canonical_hash(compiled.get('additionalCriteria')))
+    if save:
+        write_to_yaml(compiled, save)
+        logger.info("Saved compiled conf to %s", save)
+    return compiled
+
 @cli.command()
 @click.pass_context
 @click.argument('conf_file', required=True, type=click.Path(exists=True))
@@ -283,6 +384,55 @@ def download(ctx, apikey=None, conf_file=None, save=None):
     logger.info("Calling download().")
     call_api_method("download", apikey, conf_file=conf_file, save=save)
 
+@cli.command()
+@click.pass_context
+@click.argument('conf_file', required=True, type=click.Path(exists=True))
+@click.option('--save', required=True, type=click.Path(exists=False))
+@click.option('--run', required=False, help='Record progress under this run name, see journal.py.')
+def resolve(ctx, apikey=None, conf_file=None, save=None, run=None):
+    """
+    Get download URLs for products that are available for download.
+    The conf_file has the structure of params/download.yaml (e.g. the output of search --save).
+    Availability is checked with downloadoptions first, so no URLs are requested for
+    products the server cannot deliver.
+    The saved file is the input for get_products.
+    With --run, scenes resolved before the run was interrupted are not resolved again.
+    """
+    logger.info("Resolving available downloads.")
+    conf = load_conf_file(conf_file)
+    if run:
+        journal.get_journal().stage(run, 'resolve')
+    records = rr_proc.resolve_downloads(apikey, conf['datasetName'], conf['entityIds'], conf['products'], run=run)
+    write_to_yaml(records, save)
+    logger.info("Saved %s download URLs to %s", len(records), save)
+
+@cli.command()
+@click.pass_context
+@click.argument('conf_file', required=True, type=click.Path(exists=True))
+@click.option('--save_dir', required=True, type=click.Path(file_okay=False))
+@click.option('--save', required=False, type=click.Path(exists=False), help='Write the orders and download results to this file.')
+@click.option('--timeout', required=False, type=float, help='Seconds to wait for ordered products. Default: ordering.ORDER_TIMEOUT.')
+@click.option('--poll', required=False, type=float, help='Initial seconds between availability checks. Default: ordering.POLL_INTERVAL.')
+def order(ctx, apikey=None, conf_file=None, save_dir=None, save=None, timeout=None, poll=None):
+    """
+    Download the products listed in conf_file, ordering those that are not available.
+    The input file (conf_file) has the structure of params/download.yaml.
+    Available products are downloaded at once. Unavailable products are ordered in batches
+    and downloaded to save_dir as the orders complete.
+    """
+    import ordering
+    logger.info("Using conf file %s", conf_file)
+    conf = load_conf_file(conf_file)
+    summary = ordering.recover(apikey, conf['datasetName'], conf['entityIds'], conf['products'], save_dir,
+                               timeout=timeout, interval=poll)
+    dlqueue.clear_completed(apikey)
+    logger.info("%s orders submitted, %s downloads processed, %s scenes still pending, %s scenes cannot be ordered.",
+                len(summary['orders']), len(summary['results']), len(summary['pending']), len(summary['unorderable']))
+    if save:
+        write_to_yaml(summary, save)
+        logger.info("Saved summary to %s", save)
+    return summary
+
 @cli.command()
 @click.pass_context
 @click.argument('conf_file', required=True, type=click.Path(exists=True))
@@ -312,19 +462,226 @@ def deletionsearch(ctx, apikey=None, conf_file=None, save=None):
     logger.info("Calling deletionsearch().")
     call_api_method("deletionsearch", apikey, conf_file=conf_file, save=save)
 
+@cli.command()
+@click.pass_context
+@click.argument('conf_file', required=True, type=click.Path(exists=True))
+@click.option('--pending', required=False, multiple=True, type=click.Path(exists=True),
+              help='Pending download list to remove deleted scenes from. Can be repeated.')
+@click.option('--purge', required=False, type=bool, help='Also forget ID translations and remove archived files.')
+@click.option('--archive_dir', required=False, type=click.Path(exists=True, file_okay=False),
+              help='Directory with downloaded products, used with --purge.')
+@click.option('--save', required=False, type=click.Path(exists=False))
+def sync_deletions(ctx, apikey=None, conf_file=None, pending=None, purge=False, archive_dir=None, save=None):
+    """
+    Synchronise scenes deleted from a dataset since the last run.
+    The conf_file has the structure of params/deletionsearch.yaml; temporalFilter startDate is
+    only used on the first run, later runs continue from the last deletion date seen.
+    Deleted scenes are recorded in the local ID store, removed from the pending download lists
+    and from the queues of running downloads.
+    """
+    logger.info("Synchronising deleted scenes.")
+    conf = load_conf_file(conf_file)
+    start_date = (conf.get('temporalFilter') or {}).get('startDate')
+    summary = deletions.sync_deletions(apikey, conf['datasetName'], start_date=start_date, pending=list(pending),
+                                       purge=purge, archive_dir=archive_dir)
+    if save:
+        write_to_yaml(summary, save)
+        logger.info("Saved summary to %s", save)
+    return summary
+
 @cli.command()
 @click.pass_context
 @click.argument('conf_file', required=True, type=click.Path(exists=True))
 @click.option('--save_dir', required=False, type=click.Path(exists=False))
-def get_products(ctx, conf_file=None, save_dir=None, prod_types=None):
+@click.option('--lanes', required=False, type=click.Path(exists=True), help='YAML file with download lanes, see params/lanes.yaml.')
+@click.option('--extract_dir', required=False, type=click.Path(file_okay=False), help='Test and unpack downloaded archives here.')
+@click.option('--extract_workers', required=False, type=int, help='Number of extraction processes. Default: number of CPUs.')
+@click.option('--run', required=False, help='Record progress under this run name and finish the run, see journal.py.')
+def get_products(ctx, conf_file=None, save_dir=None, prod_types=None, lanes=None, extract_dir=None, extract_workers=None,
+                 run=None):
     """
     Download products listed in the supplied conf_file.
     Valid API key is required for this request - use login() to obtain.
     The input file (conf_file) is the output of download() API method.
     Files are saved in save_dir.
-    """
+    Near-real-time (RT) scenes are downloaded ahead of T1/T2 backfill unless
+    other priority lanes are given with --lanes.
+    With --extract_dir, archives are tested and unpacked in parallel processes
+    while the remaining downloads continue.
+    Files downloaded before an interruption are not downloaded again, partial ones are resumed.
+    With --run, the run is finished once all products have been processed.
+    """
+    import scheduler
     logger.info("Trying to download found products.")
-    rr_proc.download_files(conf_file, save_dir, prod_types)
+    if run:
+        journal.get_journal().stage(run, 'download')
+    rr_proc.download_files(conf_file, save_dir, prod_types, lanes=scheduler.load_lanes(lanes) if lanes else None,
+                           extract_dir=extract_dir, extract_workers=extract_workers)
+    dlqueue.clear_completed(None)
+    if run:
+        journal.get_journal().finish(run)
+
+@cli.command()
+@click.option('--all', 'include_cleared', is_flag=True, help='Include labels already cleared.')
+@click.option('--clear', is_flag=True, help='Clear our labels whose downloads have all finished.')
+@click.option('--save', required=False, type=click.Path(exists=False))
+def downloads(include_cleared=False, clear=False, save=None):
+    """
+    Show the labelled download requests made by this client (see dlqueue.py): per label,
+    the number of URLs, completed and failed downloads and the total size.
+    With --clear, labels whose downloads have all finished are removed from the download queue.
+    """
+    if clear:
+        dlqueue.clear_completed(None)
+    state = dlqueue.get_ledger().state(include_cleared)
+    for label in state:
+        logger.info("%s (%s, %s): %s of %s downloaded, %s failed, %s bytes%s", label['label'], label['datasetName'],
+                    label['dateEntered'], label['totalComplete'], label['downloadCount'], label['failed'],
+                    label['downloadSize'], ', cleared' if label['cleared'] else '')
+    if not state:
+        logger.info("No download labels found.")
+    if save:
+        write_to_yaml(state, save)
+        logger.info("Saved response to %s", save)
+    return state
+
+@cli.command()
+@click.option('--save', required=False, type=click.Path(exists=False))
+def runs(save=None):
+    """
+    Show the unfinished runs recorded in the run journal (see journal.py) with their stage,
+    search dates and progress, and the number of partial downloads that can be resumed.
+    """
+    state, partial = journal.get_journal().state()
+    for run in state:
+        logger.info("%s: stage %s, started %s, updated %s, %s pages, %s scenes resolved, params %s", run['run'],
+                    run['stage'], run['started'], run['updated'], run['pages'], run['resolved'], run['params'])
+    if not state:
+        logger.info("No unfinished runs.")
+    logger.info("%s partial downloads.", partial)
+    if save:
+        write_to_yaml({'runs': state, 'partial': partial}, save)
+        logger.info("Saved response to %s", save)
+    return state
+
+@cli.command()
+@click.pass_context
+@click.argument('conf_file', required=True, type=click.Path(exists=True))
+@click.argument('spool_file', required=True, type=click.Path(dir_okay=False))
+def backfill_search(ctx, apikey=None, conf_file=None, spool_file=None):
+    """
+    Search with the criteria in conf_file (see params/search.yaml) and write the scenes found to
+    the record spool spool_file (see resultspool.py). An interrupted search resumes at the
+    next page when run again.
+    """
+    import resultspool
+    logger.info("Using conf file %s", conf_file)
+    count = resultspool.spool_search(apikey, load_conf_file(conf_file), spool_file)
+    logger.info("%s scenes in %s", count, spool_file)
+
+@cli.command()
+@click.pass_context
+@click.argument('scenes_file', required=True, type=click.Path(dir_okay=False))
+@click.argument('spool_file', required=True, type=click.Path(dir_okay=False))
+@click.option('--products', required=True, multiple=True, help='Product code to resolve, may be repeated.')
+@click.option('--follow', is_flag=True, help='Wait for scenes until the backfill-search spool is complete.')
+def backfill_resolve(ctx, apikey=None, scenes_file=None, spool_file=None, products=None, follow=False):
+    """
+    Resolve the download URLs of the products of the scenes in the spool scenes_file (written
+    by backfill-search) and write them to the spool spool_file, the input of backfill-download.
+    """
+    import resultspool
+    count = resultspool.spool_resolve(apikey, scenes_file, spool_file, list(products), follow=follow)
+    logger.info("%s download URLs in %s", count, spool_file)
+
+@cli.command()
+@click.pass_context
+@click.argument('spool_file', required=True, type=click.Path(dir_okay=False))
+@click.option('--save_dir', required=True, type=click.Path(file_okay=False))
+@click.option('--failed', required=False, type=click.Path(dir_okay=False), help='Spool for the records of failed downloads.')
+@click.option('--follow', is_flag=True, help='Wait for URLs until the backfill-resolve spool is complete.')
+@click.option('--lanes', required=False, type=click.Path(exists=True), help='YAML file with download lanes, see params/lanes.yaml.')
+@click.option('--extract_dir', required=False, type=click.Path(file_okay=False), help='Test and unpack downloaded archives here.')
+def backfill_download(ctx, apikey=None, spool_file=None, save_dir=None, failed=None, follow=False, lanes=None,
+                      extract_dir=None):
+    """
+    Download the products in the spool spool_file (written by backfill-resolve) to save_dir, one
+    batch at a time. An interrupted run resumes at the first unfinished batch.
+    """
+    import resultspool
+    import scheduler
+    totals = resultspool.spool_download(spool_file, save_dir, lanes=scheduler.load_lanes(lanes) if lanes else None,
+                                        extract_dir=extract_dir, apiKey=apikey, follow=follow, failed_path=failed)
+    dlqueue.clear_completed(apikey)
+    logger.info("Downloads per status: %s", totals)
+    return totals
+
+@cli.command()
+@click.argument('spool_file', required=True, type=click.Path(exists=True, dir_okay=False))
+def backfill_status(spool_file):
+    """
+    Show the number of records in a backfill spool, whether it is complete and the records
+    left for each stage reading it.
+    """
+    import resultspool
+    status = resultspool.info(spool_file)
+    logger.info("%s: %s records, %s bytes, %s", spool_file, status['records'], status['bytes'],
+                'complete' if status['complete'] else 'still being written')
+    for name, left in status['readers'].items():
+        logger.info("Reader %s: %s records left", name, left)
+    return status
+
+@cli.command()
+@click.argument('spool_dir', required=True, type=click.Path(file_okay=False))
+@click.option('--workers', required=False, type=int, default=4, help='Number of jobs to run concurrently.')
+@click.option('--poll', required=False, type=float, default=1.0, help='Seconds between spool directory scans.')
+def serve(spool_dir, workers=4, poll=1.0):
+    """
+    Run as a long-lived worker processing jobs queued in spool_dir.
+    The worker keeps the HTTP session and API key between jobs, so queued
+    steps do not pay the start-up costs of a new process.
+    Queue jobs with the submit command. Stop the worker with SIGTERM or Ctrl+C.
+    """
+    import daemon
+    logger.info("Starting worker on spool directory %s.", spool_dir)
+    daemon.Worker(spool_dir, run_job, workers=workers, poll=poll).run()
+
+@cli.command(context_settings={'ignore_unknown_options': True})
+@click.argument('spool_dir', required=True, type=click.Path(file_okay=False))
+@click.argument('args', nargs=-1, required=True, type=click.UNPROCESSED)
+def submit(spool_dir, args):
+    """
+    Queue a command for a worker started with serve.
+    ARGS is the command line to run, e.g.:
+    submit /var/spool/usgs search /abs/path/search.yaml --save /abs/path/out.yaml
+    Use absolute paths, the worker does not run in the current directory.
+    """
+    import daemon
+    job_id = daemon.submit(spool_dir, args)
+    click.echo(job_id)
+
+@cli.command()
+@click.argument('spool_dir', required=True, type=click.Path(exists=True, file_okay=False))
+def jobs(spool_dir):
+    """
+    Show the worker status and the queued, running and finished jobs in spool_dir.
+    """
+    import daemon
+    status = daemon.job_status(spool_dir)
+    worker = status.pop('worker', None)
+    if worker:
+        logger.info("Worker PID %s updated %s: %s running, %s done, %s failed.", worker['pid'], worker['updated'], len(worker['running']), worker['done'], worker['failed'])
+    else:
+        logger.info("No worker status found in %s.", spool_dir)
+    for state, job_ids in status.items():
+        logger.info("%s: %s", state, ', '.join(job_ids) if job_ids else '-')
+
+def run_job(args):
+    """
+    Run a command line (list of arguments, without the program name) in this process.
+    Used by the serve worker. Returns the return value of the command.
+    """
+    return cli.main(args=list(args), prog_name='usgs_api_client', standalone_mode=False)
 
 def print_dict_items(d):
     """
@@ -332,12 +689,13 @@ def print_dict_items(d):
     Avoid using this for responses with complex 'data' elements.
     """
     for k, v in d.items():
-        logger.info("{}: {}".format(k, v))
+        logger.info("%s: %s", k, v)
 
 def load_conf_file(conf_file):
     """
     Open a YAML file and return its contents as a data structure.
     """
+    import yaml
     with open(conf_file, 'r') as f:
         return yaml.safe_load(f)
 
@@ -345,7 +703,8 @@ def write_to_yaml(data, file_name):
     """
     Write the provided dictionary to YAML file.
     """
-    with open(file_name, 'w') as outfile:
+    import yaml
+    with profiling.span('save'), open(file_name, 'w') as outfile:
         yaml.dump(data, outfile, default_flow_style=False)
 
 def call_api_method(method_name, apikey=None, conf_file=None, save=None):
@@ -353,9 +712,9 @@ def call_api_method(method_name, apikey=None, conf_file=None, save=None):
     Call method from api.py module by name, log and optionally save the response to a file.
     """
     if conf_file:
-        logger.info("Using conf file {}".format(conf_file))
+        logger.info("Using conf file %s", conf_file)
         response = vars(api)[method_name](apikey, load_conf_file(conf_file))
         if save:
             write_to_yaml(response['data'], save)
-            logger.info("Saved response to {}".format(save))
+            logger.info("Saved response to %s", save)
         return response